@@ -0,0 +1,113 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the cost of rendering a message for each of its recipients.
+
+An individual delivery copies the message for every recipient, changes the
+copy's headers and payload, and flattens it.  This compares deep copying the
+whole message and flattening it from scratch with copying only the outer
+message and reusing the flattened text of its subparts, for a plain text
+message and for multipart messages with attachments of increasing size.
+
+Run it with the Python interpreter Mailman is installed in:
+
+    $ python delivery_benchmark.py [recipients]
+
+The messages are built in memory, so no Mailman configuration is needed.
+"""
+
+import sys
+import copy
+import time
+
+from email import message_from_string
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from io import StringIO
+from mailman.email.message import Message
+from mailman.mta.base import _SharingGenerator, _copy_outer
+from mailman.mta.connection import encode_message
+
+
+RECIPIENTS = 1000
+ATTACHMENTS = (0, 10000, 100000, 1000000)
+
+
+def make_message(size):
+    if size == 0:
+        msg = MIMEText('Some text.\n' * 50)
+    else:
+        msg = MIMEMultipart()
+        msg.attach(MIMEText('Some text.\n' * 50))
+        msg.attach(MIMEApplication(bytes(range(256)) * (size // 256)))
+    msg['From'] = 'anne@example.org'
+    msg['To'] = 'test@example.com'
+    msg['Subject'] = 'A test'
+    # Parse it, as the outgoing runner's messages are.
+    return message_from_string(msg.as_string(), Message)
+
+
+def personalize(msg, recipient):
+    del msg['To']
+    msg['To'] = recipient
+    msg['X-Mailman-Copy'] = 'yes'
+
+
+def deep_copy(msg, recipients):
+    for recipient in recipients:
+        message_copy = copy.deepcopy(msg)
+        personalize(message_copy, recipient)
+        encode_message(message_copy.as_string())
+
+
+def shared_copy(msg, recipients):
+    shared = {id(part): [part, None]
+              for part in msg.walk()
+              if part is not msg}
+    for recipient in recipients:
+        message_copy = _copy_outer(msg)
+        personalize(message_copy, recipient)
+        fp = StringIO()
+        generator = _SharingGenerator(
+            fp, mangle_from_=False, maxheaderlen=0, policy=msg.policy,
+            shared=shared)
+        generator.flatten(message_copy)
+        encode_message(fp.getvalue())
+
+
+def timed(function, msg, recipients):
+    start = time.perf_counter()
+    function(msg, recipients)
+    return (time.perf_counter() - start) / len(recipients) * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else RECIPIENTS
+    recipients = ['member{}@example.org'.format(i) for i in range(count)]
+    print('{:>10}  {:>14}  {:>14}  {:>8}'.format(
+        'attachment', 'deepcopy (ms)', 'shared (ms)', 'speedup'))
+    for size in ATTACHMENTS:
+        msg = make_message(size)
+        deep = timed(deep_copy, msg, recipients)
+        shared = timed(shared_copy, msg, recipients)
+        print('{:>10}  {:>14.3f}  {:>14.3f}  {:>7.1f}x'.format(
+            size, deep, shared, deep / shared))
+
+
+if __name__ == '__main__':
+    main()
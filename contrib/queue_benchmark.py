@@ -0,0 +1,81 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the cost of listing a queue against its depth.
+
+A queue runner asks its switchboard for the queue's files on every pass
+through its loop.  This compares a full scan of the queue directory with the
+switchboard's incremental index, both for the whole queue and for a fixed
+size batch of its oldest entries, for queues of increasing depth.
+
+Run it with the Python interpreter Mailman is installed in:
+
+    $ python queue_benchmark.py [depth ...]
+
+The queue entries are empty files in a temporary directory, so no Mailman
+configuration is needed.
+"""
+
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+from mailman.core.switchboard import Switchboard
+
+
+DEPTHS = (100, 1000, 10000, 50000)
+PASSES = 20
+BATCH = 100
+
+
+def fill(directory, depth):
+    now = time.time()
+    for i in range(depth):
+        digest = hashlib.sha1(str(i).encode('ascii')).hexdigest()
+        filename = '{}+{}.pck'.format(now + i / 1000000, digest)
+        with open(os.path.join(directory, filename), 'wb'):
+            pass
+
+
+def timed(function):
+    start = time.perf_counter()
+    for i in range(PASSES):
+        function()
+    return (time.perf_counter() - start) / PASSES * 1000
+
+
+def main():
+    depths = [int(arg) for arg in sys.argv[1:]] or DEPTHS
+    print('{:>8}  {:>12}  {:>12}  {:>12}'.format(
+        'depth', 'scan (ms)', 'index (ms)', 'batch (ms)'))
+    for depth in depths:
+        with tempfile.TemporaryDirectory() as directory:
+            fill(directory, depth)
+            switchboard = Switchboard('benchmark', directory)
+            # Seed the index, as a runner's first pass does.
+            assert len(switchboard.files) == depth
+            scan = timed(switchboard.get_files)
+            index = timed(lambda: switchboard.files)
+            batch = timed(lambda: switchboard.get_batch(BATCH))
+            print('{:>8}  {:>12.3f}  {:>12.3f}  {:>12.3f}'.format(
+                depth, scan, index, batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,12 @@
 
 """Global events."""
 
-from mailman.app import domain, membership, moderator, subscriptions
+from mailman.app import (
+    domain, membership, moderator, recipients, subscriptions)
+from mailman.chains import headers
 from mailman.core import i18n, switchboard
 from mailman.languages import manager as language_manager
+from mailman.model import bans, roster
 from mailman.styles import manager as style_manager
 from mailman.utilities import passwords
 from public import public
@@ -30,12 +33,23 @@ from zope import event
 def initialize():
     """Initialize global event subscribers."""
     event.subscribers.extend([
+        bans.handle_ListDeletingEvent,
         domain.handle_DomainDeletingEvent,
+        headers.handle_ConfigurationUpdatedEvent,
         i18n.handle_ConfigurationUpdatedEvent,
         language_manager.handle_ConfigurationUpdatedEvent,
         membership.handle_SubscriptionEvent,
         moderator.handle_ListDeletingEvent,
         passwords.handle_ConfigurationUpdatedEvent,
+        recipients.handle_AddressLinkEvent,
+        recipients.handle_ListDeletingEvent,
+        recipients.handle_MembershipChangeEvent,
+        recipients.handle_PreferencesChangeEvent,
+        recipients.handle_PreferredAddressChangeEvent,
+        roster.handle_AddressLinkEvent,
+        roster.handle_ListDeletingEvent,
+        roster.handle_MembershipChangeEvent,
+        roster.handle_PreferredAddressChangeEvent,
         style_manager.handle_ConfigurationUpdatedEvent,
         subscriptions.handle_ListDeletingEvent,
         subscriptions.handle_SubscriptionConfirmationNeededEvent,
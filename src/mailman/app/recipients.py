@@ -0,0 +1,194 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the mailing lists' regular recipients.
+
+The regular recipients of a mailing list are kept in a file under
+`$cache_dir/recipients/<list_id>`, as the sorted email addresses, one per
+line, so that every runner process shares them.  The file starts with the
+tokens it was calculated under: one for the mailing list and one for all of
+them.  Whenever something happens that may change a list's recipients, the
+tokens are replaced once the transaction commits, and the cached file becomes
+stale.  Each process also keeps the recipients it last read in memory, for as
+long as the tokens don't change.
+"""
+
+import os
+import shutil
+
+from lazr.config import as_boolean
+from mailman.config import config
+from mailman.interfaces.listmanager import ListDeletingEvent
+from mailman.interfaces.member import MembershipChangeEvent
+from mailman.interfaces.preferences import PreferencesChangeEvent
+from mailman.interfaces.user import (
+    AddressLinkEvent, PreferredAddressChangeEvent)
+from mailman.model.member import Member
+from mailman.utilities.filesystem import (
+    new_token, read_token, write_atomically)
+from public import public
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+
+
+# The preferences which decide whether a member is a regular recipient.
+PREFERENCES = ('delivery_mode', 'delivery_status')
+PENDING_KEY = 'mailman.recipients'
+
+# Map list ids to the tokens and the recipients this process last read.
+_recipients = {}
+
+
+def _path(*parts):
+    return os.path.join(config.CACHE_DIR, 'recipients', *parts)
+
+
+def _tokens(list_id):
+    return '{} {}'.format(
+        read_token(_path('token')),
+        read_token(_path(list_id, 'token')))
+
+
+@public
+def get_recipients(mlist):
+    """Return the regular recipients of the mailing list.
+
+    The recipients are calculated from the list's membership, unless they
+    have been cached since the last change to them.
+
+    :param mlist: The mailing list.
+    :type mlist: `IMailingList`
+    :return: The email addresses of the mailing list's regular members whose
+        delivery is enabled.  The caller is free to change the set.
+    :rtype: set
+    """
+    if not as_boolean(config.mailman.cache_recipients):
+        return mlist.regular_members.recipients
+    list_id = mlist.list_id
+    tokens = _tokens(list_id)
+    cached = _recipients.get(list_id)
+    if cached is not None and cached[0] == tokens:
+        return set(cached[1])
+    path = _path(list_id, 'recipients')
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    if len(lines) > 0 and lines[0] == tokens:
+        recipients = frozenset(lines[1:])
+    else:
+        recipients = frozenset(mlist.regular_members.recipients)
+        # The tokens were read before the recipients were calculated, so if
+        # they changed in the meantime, the file is already stale.
+        write_atomically(path, '\n'.join([tokens] + sorted(recipients)))
+    _recipients[list_id] = (tokens, recipients)
+    return set(recipients)
+
+
+@public
+def invalidate(list_id=None):
+    """Invalidate the cached recipients.
+
+    This takes effect immediately.  Use it outside of a transaction; the
+    event handlers below wait until the transaction commits instead.
+
+    :param list_id: The list id of the mailing list whose recipients are
+        invalidated.  If not given, the recipients of all mailing lists are.
+    :type list_id: str
+    """
+    if list_id is None:
+        new_token(_path('token'))
+        _recipients.clear()
+    else:
+        new_token(_path(list_id, 'token'))
+        _recipients.pop(list_id, None)
+        try:
+            os.remove(_path(list_id, 'recipients'))
+        except FileNotFoundError:
+            pass
+
+
+@public
+def clear():
+    """Remove all the cached recipients."""
+    shutil.rmtree(_path(), ignore_errors=True)
+    _recipients.clear()
+
+
+def _invalidate_on_commit(list_id=None):
+    # Changes are tracked even while the cache is turned off, so that it can
+    # safely be turned back on.  Invalidating the recipients before the
+    # transaction commits would let another process cache them again from
+    # the old membership.
+    config.db.store.info.setdefault(PENDING_KEY, set()).add(list_id)
+
+
+@listens_for(Session, 'after_commit')
+def _after_commit(session):
+    pending = session.info.pop(PENDING_KEY, set())
+    if None in pending:
+        invalidate()
+    else:
+        for list_id in pending:
+            invalidate(list_id)
+
+
+@public
+def handle_MembershipChangeEvent(event):
+    if isinstance(event, MembershipChangeEvent):
+        _invalidate_on_commit(event.mlist.list_id)
+
+
+@public
+def handle_ListDeletingEvent(event):
+    if isinstance(event, ListDeletingEvent):
+        _invalidate_on_commit(event.mailing_list.list_id)
+
+
+@public
+def handle_AddressLinkEvent(event):
+    # The address's user may bring its own preferences and memberships.
+    if isinstance(event, AddressLinkEvent):
+        _invalidate_on_commit()
+
+
+@public
+def handle_PreferencesChangeEvent(event):
+    if not isinstance(event, PreferencesChangeEvent):
+        return
+    if event.name not in PREFERENCES:
+        return
+    preferences = event.preferences
+    # The preference is in the middle of being set, so don't let looking up
+    # its owner flush it.
+    store = config.db.store
+    with store.no_autoflush:
+        if preferences.address is not None or preferences.user is not None:
+            # The preferences of an address or a user can change the
+            # recipients of any number of mailing lists.
+            _invalidate_on_commit()
+        elif preferences.id is not None:
+            for list_id, in store.query(Member.list_id).filter(
+                    Member.preferences_id == preferences.id):
+                _invalidate_on_commit(list_id)
+
+
+@public
+def handle_PreferredAddressChangeEvent(event):
+    if isinstance(event, PreferredAddressChangeEvent):
+        _invalidate_on_commit()
@@ -0,0 +1,171 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the cache of the mailing lists' regular recipients."""
+
+import os
+import unittest
+
+from mailman.app import recipients
+from mailman.app.lifecycle import create_list
+from mailman.app.recipients import clear, get_recipients
+from mailman.config import config
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus
+from mailman.interfaces.usermanager import IUserManager
+from mailman.testing.helpers import configuration, set_preferred
+from mailman.testing.layers import ConfigLayer
+from zope.component import getUtility
+
+
+class TestRecipientCache(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        cache = configuration('mailman', cache_recipients='yes')
+        cache.__enter__()
+        self.addCleanup(cache.__exit__)
+        self.addCleanup(clear)
+        self._mlist = create_list('ant@example.com')
+        self._user_manager = getUtility(IUserManager)
+        self._anne = self._subscribe('anne@example.com')
+        config.db.commit()
+        self._path = os.path.join(
+            config.CACHE_DIR, 'recipients', 'ant.example.com', 'recipients')
+
+    def _subscribe(self, email):
+        address = self._user_manager.create_address(email)
+        return self._mlist.subscribe(address)
+
+    def test_disabled(self):
+        with configuration('mailman', cache_recipients='no'):
+            self.assertEqual(get_recipients(self._mlist),
+                             {'anne@example.com'})
+        self.assertFalse(os.path.exists(self._path))
+
+    def test_changes_while_disabled(self):
+        get_recipients(self._mlist)
+        with configuration('mailman', cache_recipients='no'):
+            self._subscribe('bart@example.com')
+            config.db.commit()
+        self.assertEqual(get_recipients(self._mlist),
+                         {'anne@example.com', 'bart@example.com'})
+
+    def test_cached(self):
+        self._subscribe('cris@example.com')
+        self._subscribe('bart@example.com')
+        config.db.commit()
+        self.assertEqual(
+            get_recipients(self._mlist),
+            {'anne@example.com', 'bart@example.com', 'cris@example.com'})
+        # The recipients are kept sorted, after the tokens they were
+        # calculated under.
+        with open(self._path, 'r', encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(lines[1:], [
+            'anne@example.com', 'bart@example.com', 'cris@example.com'])
+        # Another process reads the file instead of calculating them again.
+        recipients._recipients.clear()
+        with open(self._path, 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join([lines[0], 'dave@example.com']))
+        self.assertEqual(get_recipients(self._mlist), {'dave@example.com'})
+
+    def test_caller_owns_the_set(self):
+        get_recipients(self._mlist).remove('anne@example.com')
+        self.assertEqual(get_recipients(self._mlist), {'anne@example.com'})
+
+    def test_stale_file(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path, 'w', encoding='utf-8') as fp:
+            fp.write('old tokens\ndave@example.com')
+        self.assertEqual(get_recipients(self._mlist), {'anne@example.com'})
+
+    def test_subscription(self):
+        get_recipients(self._mlist)
+        self._subscribe('bart@example.com')
+        # Nothing changes until the transaction commits.
+        self.assertEqual(get_recipients(self._mlist), {'anne@example.com'})
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist),
+                         {'anne@example.com', 'bart@example.com'})
+
+    def test_unsubscription(self):
+        get_recipients(self._mlist)
+        self._anne.unsubscribe()
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), set())
+
+    def test_member_preferences(self):
+        bee = create_list('bee@example.com')
+        bee.subscribe(self._anne.address)
+        config.db.commit()
+        get_recipients(self._mlist)
+        get_recipients(bee)
+        self._anne.preferences.delivery_status = DeliveryStatus.by_user
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), set())
+        # The other mailing list's recipients are still cached.
+        self.assertIn('bee.example.com', recipients._recipients)
+        self.assertEqual(get_recipients(bee), {'anne@example.com'})
+
+    def test_address_preferences(self):
+        get_recipients(self._mlist)
+        self._anne.address.preferences.delivery_mode = (
+            DeliveryMode.plaintext_digests)
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), set())
+
+    def test_other_preferences(self):
+        get_recipients(self._mlist)
+        self._anne.preferences.acknowledge_posts = True
+        config.db.commit()
+        self.assertIn('ant.example.com', recipients._recipients)
+        self.assertTrue(os.path.exists(self._path))
+
+    def test_preferred_address(self):
+        user = self._user_manager.make_user('bart@example.com')
+        set_preferred(user)
+        self._mlist.subscribe(user)
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist),
+                         {'anne@example.com', 'bart@example.com'})
+        address = user.register('brat@example.com')
+        address.verified_on = address.registered_on
+        user.preferred_address = address
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist),
+                         {'anne@example.com', 'brat@example.com'})
+
+    def test_link_address(self):
+        get_recipients(self._mlist)
+        user = self._user_manager.create_user()
+        user.preferences.delivery_status = DeliveryStatus.by_user
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), {'anne@example.com'})
+        # Anne's address now inherits the user's preferences.
+        user.link(self._anne.address)
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), set())
+
+    def test_unlink_address(self):
+        user = self._user_manager.create_user()
+        user.preferences.delivery_status = DeliveryStatus.by_user
+        user.link(self._anne.address)
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), set())
+        user.unlink(self._anne.address)
+        config.db.commit()
+        self.assertEqual(get_recipients(self._mlist), {'anne@example.com'})
@@ -19,6 +19,7 @@
 
 import os
 import sys
+import time
 import click
 import signal
 import socket
@@ -27,11 +28,14 @@ import logging
 from datetime import timedelta
 from enum import Enum
 from flufl.lock import Lock, NotLockedError, TimeOutError
-from lazr.config import as_boolean
+from lazr.config import as_boolean, as_timedelta
+from mailman.bin.runner import make_runner
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.initialize import initialize
 from mailman.core.logging import reopen
+from mailman.core.switchboard import SLICES_FILE
+from mailman.utilities.filesystem import write_atomically
 from mailman.utilities.options import I18nCommand, validate_runner_spec
 from mailman.version import MAILMAN_VERSION_FULL
 from public import public
@@ -41,6 +45,8 @@ DOT = '.'
 LOCK_LIFETIME = timedelta(days=1, hours=6)
 SECONDS_IN_A_DAY = 86400
 SUBPROC_START_WAIT = timedelta(seconds=20)
+# How often the master looks for exited runners while it autoscales any.
+POLL_INTERVAL = 1
 
 # Environment variables to forward into subprocesses.
 PRESERVE_ENVS = (
@@ -246,6 +252,33 @@ class PIDWatcher:
         """
         return self._pids.pop(pid, None)
 
+    def runners(self, name, first_slice=0):
+        """Return the process ids of a runner's subprocesses.
+
+        :param name: The runner name.
+        :type name: str
+        :param first_slice: Only the subprocesses managing this slice or a
+            higher numbered one are returned.
+        :type first_slice: int
+        :return: The process ids of the runner's subprocesses.
+        :rtype: list
+        """
+        return [pid for pid, info in list(self._pids.items())
+                if info[0] == name and info[1] >= first_slice]
+
+    def resize(self, pid, count):
+        """Change the slice count of existing process information.
+
+        :param pid: The process id.  The watcher must already be tracking this
+            process id.
+        :type pid: int
+        :param count: The new slice count.
+        :type count: int
+        :raise KeyError: if the process id is not being tracked.
+        """
+        name, slice_number, old_count, restarts = self._pids[pid]
+        self._pids[pid] = (name, slice_number, count, restarts)
+
 
 @public
 class Loop:
@@ -256,6 +289,13 @@ class Loop:
         self._restartable = restartable
         self._config_file = config_file
         self._kids = PIDWatcher()
+        # The current number of instances of each runner, the time each
+        # autoscaled runner's queue is due to be looked at next, and the new
+        # number of instances of the runners being rescaled.
+        self._instances = {}
+        self._autoscaled = {}
+        self._rescaling = {}
+        self._stopping = False
 
     def install_signal_handlers(self):
         """Install various signals handlers for control from the master."""
@@ -284,18 +324,23 @@ class Loop:
         # SIGTERM is what init will kill this process with when changing run
         # levels.  It's also the signal 'mailman stop' uses.
         def sigterm_handler(signum, frame):                       # noqa: E306
+            self._stopping = True
             for pid in self._kids:
                 os.kill(pid, signal.SIGTERM)
             log.info('Master watcher caught SIGTERM.  Exiting.')
         signal.signal(signal.SIGTERM, sigterm_handler)
         # SIGINT is what control-C gives.
         def sigint_handler(signum, frame):                        # noqa: E306
+            self._stopping = True
             for pid in self._kids:
                 os.kill(pid, signal.SIGINT)
             log.info('Master watcher caught SIGINT.  Restarting.')
         signal.signal(signal.SIGINT, sigint_handler)
+        # SIGUSR2 tells runners that their number of instances changed.  The
+        # runners inherit this, so that they ignore it until they're ready.
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
 
-    def _start_runner(self, spec):
+    def _start_runner(self, spec, recover=True):
         """Start a runner.
 
         All arguments are passed to the process.
@@ -303,19 +348,39 @@ class Loop:
         :param spec: A runner spec, in a format acceptable to
             bin/runner's --runner argument, e.g. name:slice:count
         :type spec: string
+        :param recover: Whether the runner recovers the backup files in its
+            slice of the queue when it starts.
+        :type recover: bool
         :return: The process id of the child runner.
         :rtype: int
         """
+        forking = config.mailman.runner_start == 'fork'
+        if forking:
+            # The child must not share the master's database connections.  The
+            # master doesn't need them anymore, so close them before forking
+            # and let the child open its own.
+            config.db.store.remove()
+            config.db.engine.dispose()
         pid = os.fork()
         if pid:
             # Parent.
             return pid
         # Child.
+        if forking:
+            # Never return into the master's code, or the child would clean up
+            # after the master when it exits.
+            status = self._run_forked(spec, recover)
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
         #
         # Set the environment variable which tells the runner that it's
         # running under bin/master control.  This subtly changes the error
         # behavior of bin/runner.
         env = {'MAILMAN_UNDER_MASTER_CONTROL': '1'}
+        if not recover:
+            env['MAILMAN_RUNNER_NO_RECOVER'] = '1'
         # Craft the command line arguments for the exec() call.
         rswitch = '--runner=' + spec
         # Always pass the explicit path to the configuration file to the
@@ -345,6 +410,46 @@ class Loop:
         # We should never get here.
         raise RuntimeError('os.execle() failed')
 
+    def _run_forked(self, spec, recover=True):
+        """Run a runner in a child forked from the master without exec.
+
+        The master has already initialized the system, so the runner starts
+        right away, sharing the master's imported code and loaded
+        configuration.
+
+        :param spec: A runner spec, e.g. name:slice:count
+        :type spec: string
+        :param recover: Whether the runner recovers the backup files in its
+            slice of the queue when it starts.
+        :type recover: bool
+        :return: The exit status of the child runner.
+        :rtype: int
+        """
+        # The child inherits the master's signal handlers, which pass the
+        # signals on to the master's children.  The runner installs its own.
+        for signum in (signal.SIGALRM, signal.SIGHUP, signal.SIGUSR1,
+                       signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        # See bin/runner.
+        os.environ['MAILMAN_UNDER_MASTER_CONTROL'] = '1'
+        if not recover:
+            os.environ['MAILMAN_RUNNER_NO_RECOVER'] = '1'
+        reopen()
+        log = logging.getLogger('mailman.runner')
+        name, slice_number, count = spec.split(':')
+        try:
+            runner = make_runner(name, int(slice_number), int(count))
+            runner.set_signals()
+            log.info('{} runner started.'.format(runner.name))
+            runner.run()
+            log.info('{} runner exiting.'.format(runner.name))
+            return runner.status
+        except SystemExit as error:
+            return 0 if error.code is None else error.code
+        except Exception:
+            log.exception('Uncaught runner exception: {}'.format(spec))
+            return 1
+
     def start_runners(self, runner_names=None):
         """Start all the configured runners.
 
@@ -369,19 +474,159 @@ class Loop:
             runner_config = getattr(config, section_name)
             if not as_boolean(runner_config.start):
                 continue
-            # Find out how many runners to instantiate.  This must be a power
-            # of 2.
+            # Find out how many runners to instantiate.
             count = int(runner_config.instances)
-            assert (count & (count - 1)) == 0, (
-                'Runner "{0}", not a power of 2: {1}'.format(name, count))
-            for slice_number in range(count):
-                # runner name, slice #, # of slices, restart count
-                info = (name, slice_number, count, 0)
-                spec = '{0}:{1:d}:{2:d}'.format(name, slice_number, count)
-                pid = self._start_runner(spec)
-                log = logging.getLogger('mailman.runner')
-                log.debug('[{0:d}] {1}'.format(pid, spec))
-                self._kids.add(pid, info)
+            assert count > 0, (
+                'Runner "{0}", bad number of instances: {1}'.format(
+                    name, count))
+            if int(runner_config.max_instances) > count:
+                self._autoscaled[name] = time.time()
+            self._start_instances(name, count)
+
+    def _start_instances(self, name, count, first_slice=0):
+        """Start the instances of a runner.
+
+        :param name: The runner name.
+        :type name: str
+        :param count: The number of instances, each managing its own slice of
+            the runner's queue.
+        :type count: int
+        :param first_slice: The first slice to start an instance for.  When
+            this isn't 0, the instances managing the lower numbered slices are
+            already running, and the new instances leave the backup files for
+            them.
+        :type first_slice: int
+        """
+        log = logging.getLogger('mailman.runner')
+        if first_slice == 0 and name in config.switchboards:
+            # The instances read their slice count from here when they start,
+            # so one left by an earlier master must be replaced.
+            self._write_slices(name, count)
+        self._instances[name] = count
+        for slice_number in range(first_slice, count):
+            # runner name, slice #, # of slices, restart count
+            info = (name, slice_number, count, 0)
+            spec = '{0}:{1:d}:{2:d}'.format(name, slice_number, count)
+            pid = self._start_runner(spec, recover=(first_slice == 0))
+            log.debug('[{0:d}] {1}'.format(pid, spec))
+            self._kids.add(pid, info)
+
+    def _pick_instances(self, name):
+        """Pick the number of instances an autoscaled runner should have.
+
+        :param name: The runner name.
+        :type name: str
+        :return: The number of instances.
+        :rtype: int
+        """
+        section = getattr(config, 'runner.' + name)
+        lowest = int(section.instances)
+        highest = int(section.max_instances)
+        depth_limit = int(section.scale_up_depth)
+        age_limit = as_timedelta(section.scale_up_age).total_seconds()
+        current = self._instances[name]
+        # Entries which were delayed don't need a runner until they're due.
+        now = time.time()
+        times = [float(filebase.split('+', 1)[0])
+                 for filebase in config.switchboards[name].get_files()]
+        due = [when for when in times if when <= now]
+        depth = len(due)
+        age = now - due[0] if due else 0
+        # Add enough runners for the depth of the queue, and at least one more
+        # if entries wait too long.
+        wanted = -(-depth // depth_limit)
+        if age > age_limit:
+            wanted = max(wanted, current + 1)
+        if wanted > current:
+            return min(wanted, highest)
+        # Remove runners one at a time, and only once they are clearly not
+        # needed, so that the number of runners doesn't flap.
+        if (current > lowest and
+                depth <= depth_limit * (current - 1) / 2 and
+                age <= age_limit / 2):
+            return current - 1
+        return current
+
+    def _autoscale(self):
+        """Rescale the autoscaled runners whose queues are due a look."""
+        log = logging.getLogger('mailman.runner')
+        now = time.time()
+        for name, due in self._autoscaled.items():
+            if due > now or name in self._rescaling:
+                continue
+            section = getattr(config, 'runner.' + name)
+            interval = as_timedelta(section.autoscale_interval)
+            self._autoscaled[name] = now + interval.total_seconds()
+            count = self._pick_instances(name)
+            if count == self._instances[name]:
+                continue
+            current = self._instances[name]
+            log.info('Rescaling runner {0} from {1:d} to {2:d} instances'
+                     .format(name, current, count))
+            if len(self._kids.runners(name)) == 0:
+                self._start_instances(name, count)
+            elif count > current:
+                # The running instances only give up the entries moving into
+                # the new slices, so only the new slices need new instances.
+                self._resize_instances(name, count)
+                self._start_instances(name, count, current)
+            else:
+                # The entries of the removed slices are only taken over by
+                # the remaining instances once the removed slices' instances
+                # have exited, each after its current entry.
+                pids = self._kids.runners(name, count)
+                if len(pids) == 0:
+                    self._resize_instances(name, count)
+                    continue
+                self._rescaling[name] = count
+                for pid in pids:
+                    os.kill(pid, signal.SIGTERM)
+
+    def _resize_instances(self, name, count):
+        """Tell the running instances of a runner their new slice count.
+
+        :param name: The runner name.
+        :type name: str
+        :param count: The new number of instances.
+        :type count: int
+        """
+        self._instances[name] = count
+        self._write_slices(name, count)
+        for pid in self._kids.runners(name):
+            self._kids.resize(pid, count)
+            os.kill(pid, signal.SIGUSR2)
+
+    def _write_slices(self, name, count):
+        """Write the slice count for a runner's instances to read.
+
+        :param name: The runner name.
+        :type name: str
+        :param count: The number of instances.
+        :type count: int
+        """
+        queue_directory = config.switchboards[name].queue_directory
+        write_atomically(
+            os.path.join(queue_directory, SLICES_FILE), str(count))
+
+    def _wait(self):
+        """Wait for a runner subprocess to exit.
+
+        While any runners are autoscaled, their queues are looked at in the
+        meantime.
+
+        :return: The process id and exit status of the subprocess.
+        :rtype: 2-tuple
+        :raise ChildProcessError: if there are no runner subprocesses.
+        """
+        if not self._autoscaled:
+            return os.wait()
+        while True:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid != 0:
+                return pid, status
+            if not self._stopping:
+                self._autoscale()
+            time.sleep(POLL_INTERVAL)
 
     def _pause(self):
         """Sleep until a signal is received."""
@@ -398,10 +643,12 @@ class Loop:
         """
         log = logging.getLogger('mailman.runner')
         log.info('Master started')
-        self._pause()
+        # Autoscaled runners are watched right away.
+        if not self._autoscaled:
+            self._pause()
         while True:
             try:
-                pid, status = os.wait()
+                pid, status = self._wait()
             except ChildProcessError:
                 # No children?  We're done.
                 break
@@ -425,6 +672,17 @@ class Loop:
             # command line switch was not given.  This lets us better handle
             # runaway restarts (e.g.  if the subprocess had a syntax error!)
             rname, slice_number, count, restarts = self._kids.pop(pid)
+            if slice_number >= self._rescaling.get(rname, count):
+                # Resize the remaining instances once the last of the removed
+                # ones has exited.
+                log.debug('Runner {0} (pid: {1:d}) exited for rescaling'
+                          .format(rname, pid))
+                new_count = self._rescaling[rname]
+                if len(self._kids.runners(rname, new_count)) == 0:
+                    del self._rescaling[rname]
+                    if not self._stopping:
+                        self._resize_instances(rname, new_count)
+                continue
             config_name = 'runner.' + rname
             restart = False
             if why == signal.SIGUSR1 and self._restartable:
@@ -445,6 +703,8 @@ Master detected subprocess exit
                 log.info("""\
 Runner {0} reached maximum restart limit of {1:d}, not restarting.""",
                          rname, max_restarts)
+                # Autoscaling would start it again.
+                self._autoscaled.pop(rname, None)
             # Now perhaps restart the process unless it exited with a
             # SIGTERM or we aren't restarting.
             if restart:
@@ -66,8 +66,8 @@ def make_runner(name, slice, range, once=False):
         class Once(runner_class):
             def _do_periodic(self):
                 self.stop()
-        return Once(name, slice)
-    return runner_class(name, slice)
+        return Once(name, slice, range)
+    return runner_class(name, slice, range)
 
 
 @click.command(
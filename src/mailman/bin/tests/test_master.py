@@ -18,6 +18,8 @@
 """Test master watcher utilities."""
 
 import os
+import time
+import signal
 import tempfile
 import unittest
 
@@ -28,9 +30,12 @@ from flufl.lock import Lock, TimeOutError
 from io import StringIO
 from mailman.bin import master
 from mailman.config import config
+from mailman.core.switchboard import SLICES_FILE
+from mailman.testing.helpers import specialized_message_from_string as mfs
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.filesystem import write_atomically
 from pkg_resources import resource_filename
-from unittest.mock import patch
+from unittest.mock import call, patch
 
 
 class FakeLock:
@@ -126,3 +131,206 @@ Exiting.
             # We created a non-restartable loop.
             start_mock.assert_called_once_with([('in', 1, 1)])
             loop_mock.assert_called_once_with()
+
+
+class FakeRunner:
+    name = 'fake'
+
+    def __init__(self, status):
+        self.status = status
+        self.signals_set = False
+        self.environ = None
+
+    def set_signals(self):
+        self.signals_set = True
+
+    def run(self):
+        self.environ = os.environ.get('MAILMAN_UNDER_MASTER_CONTROL')
+
+
+class TestForkedRunners(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._resources = ExitStack()
+        self.addCleanup(self._resources.close)
+        # Running a forked runner in this process resets the signal handlers.
+        for signum in (signal.SIGALRM, signal.SIGHUP, signal.SIGUSR1,
+                       signal.SIGTERM, signal.SIGINT):
+            self._resources.callback(
+                signal.signal, signum, signal.getsignal(signum))
+        self._resources.enter_context(patch.dict(os.environ))
+        os.environ.pop('MAILMAN_UNDER_MASTER_CONTROL', None)
+        config.push('fork', """
+        [mailman]
+        runner_start: fork
+        """)
+        self._resources.callback(config.pop, 'fork')
+
+    def test_run_forked(self):
+        runner = FakeRunner(signal.SIGUSR1)
+        signal.signal(signal.SIGHUP, lambda *args: None)
+        with patch('mailman.bin.master.make_runner',
+                   return_value=runner) as make_mock:
+            status = master.Loop()._run_forked('in:1:4')
+        make_mock.assert_called_once_with('in', 1, 4)
+        self.assertEqual(status, signal.SIGUSR1)
+        self.assertTrue(runner.signals_set)
+        self.assertEqual(runner.environ, '1')
+        self.assertEqual(signal.getsignal(signal.SIGHUP), signal.SIG_DFL)
+
+    def test_run_forked_undefined_runner(self):
+        with patch('mailman.bin.runner.sys.stderr', StringIO()):
+            status = master.Loop()._run_forked('nonesuch:0:1')
+        self.assertEqual(status, signal.SIGTERM)
+
+    def test_start_runner(self):
+        # The child runs the runner without exec'ing bin/runner and exits
+        # with its status.
+        with patch('mailman.bin.master.make_runner',
+                   return_value=FakeRunner(3)):
+            pid = master.Loop()._start_runner('in:0:1')
+        pid, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 3)
+
+
+class TestAutoscale(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        config.push('autoscale', """
+        [runner.out]
+        instances: 1
+        max_instances: 4
+        scale_up_depth: 2
+        scale_up_age: 1h
+        """)
+        self.addCleanup(config.pop, 'autoscale')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._loop = master.Loop()
+        self._loop._autoscaled['out'] = 0
+        self._loop._instances['out'] = 1
+
+    def _enqueue(self, count):
+        for i in range(count):
+            config.switchboards['out'].enqueue(self._msg, foo=i)
+
+    def test_scale_up_with_depth(self):
+        self._enqueue(5)
+        self.assertEqual(self._loop._pick_instances('out'), 3)
+
+    def test_scale_up_limit(self):
+        self._enqueue(9)
+        self.assertEqual(self._loop._pick_instances('out'), 4)
+
+    def test_scale_up_with_age(self):
+        self._enqueue(1)
+        with patch('mailman.bin.master.time') as time_mock:
+            time_mock.time.return_value = time.time() + 7200
+            self.assertEqual(self._loop._pick_instances('out'), 2)
+
+    def test_scale_down_one_at_a_time(self):
+        self._loop._instances['out'] = 3
+        self.assertEqual(self._loop._pick_instances('out'), 2)
+        self._loop._instances['out'] = 1
+        self.assertEqual(self._loop._pick_instances('out'), 1)
+
+    def test_no_flapping(self):
+        # Two entries keep two runners busy enough.
+        self._loop._instances['out'] = 2
+        self._enqueue(2)
+        self.assertEqual(self._loop._pick_instances('out'), 2)
+
+    def _slices(self):
+        path = os.path.join(
+            config.switchboards['out'].queue_directory, SLICES_FILE)
+        with open(path, 'r', encoding='utf-8') as fp:
+            return fp.read()
+
+    def test_rescale_up(self):
+        # The running instance is told the new number of slices, and only the
+        # instances for the new slices are started.  They leave the backup
+        # files alone.
+        self._loop._kids.add(100, ('out', 0, 1, 0))
+        self._loop._kids.add(200, ('in', 0, 1, 0))
+        self._enqueue(5)
+        specs = []
+
+        def start_runner(spec, recover=True):
+            specs.append((spec, recover))
+            return 300 + len(specs)
+
+        with ExitStack() as resources:
+            kill_mock = resources.enter_context(
+                patch('mailman.bin.master.os.kill'))
+            resources.enter_context(patch.object(
+                self._loop, '_start_runner', side_effect=start_runner))
+            self._loop._autoscale()
+        kill_mock.assert_called_once_with(100, signal.SIGUSR2)
+        self.assertEqual(self._slices(), '3')
+        self.assertEqual(specs, [('out:1:3', False), ('out:2:3', False)])
+        self.assertEqual(self._loop._instances['out'], 3)
+        self.assertEqual(sorted(self._loop._kids), [100, 200, 301, 302])
+        self.assertEqual(self._loop._kids.pop(100), ('out', 0, 3, 0))
+        self.assertEqual(self._loop._rescaling, {})
+
+    def test_slices_written_on_start(self):
+        # A slice count left behind by an earlier master is replaced when
+        # the instances are started.
+        write_atomically(os.path.join(
+            config.switchboards['out'].queue_directory, SLICES_FILE), '4')
+        with patch.object(self._loop, '_start_runner', return_value=100):
+            self._loop._start_instances('out', 1)
+        self.assertEqual(self._slices(), '1')
+
+    def test_given_up_not_restarted(self):
+        # A runner which reached its maximum number of restarts isn't
+        # started again by autoscaling.
+        self._loop._kids.add(100, ('out', 0, 1, 10))
+        self._enqueue(5)
+        with ExitStack() as resources:
+            start_mock = resources.enter_context(
+                patch.object(self._loop, '_start_runner'))
+            resources.enter_context(patch.object(
+                self._loop, '_wait', side_effect=[
+                    (100, 1 << 8), ChildProcessError]))
+            self._loop.loop()
+            self._loop._autoscale()
+        start_mock.assert_not_called()
+        self.assertEqual(self._loop._autoscaled, {})
+
+    def test_rescale_down(self):
+        # Only the instance of the removed slice is stopped, and once it has
+        # exited, the remaining ones are told the new number of slices.
+        self._loop._instances['out'] = 3
+        for slice_number in range(3):
+            self._loop._kids.add(
+                100 + slice_number, ('out', slice_number, 3, 0))
+        self._loop._kids.add(200, ('in', 0, 1, 0))
+        with ExitStack() as resources:
+            kill_mock = resources.enter_context(
+                patch('mailman.bin.master.os.kill'))
+            start_mock = resources.enter_context(
+                patch.object(self._loop, '_start_runner'))
+            resources.enter_context(patch.object(
+                self._loop, '_wait', side_effect=[
+                    (102, signal.SIGTERM << 8), ChildProcessError]))
+            self._loop._autoscale()
+            kill_mock.assert_called_once_with(102, signal.SIGTERM)
+            self.assertEqual(self._loop._rescaling, {'out': 2})
+            kill_mock.reset_mock()
+            self._loop.loop()
+        self.assertEqual(sorted(kill_mock.call_args_list), [
+            call(100, signal.SIGUSR2), call(101, signal.SIGUSR2)])
+        start_mock.assert_not_called()
+        self.assertEqual(self._slices(), '2')
+        self.assertEqual(self._loop._instances['out'], 2)
+        self.assertEqual(sorted(self._loop._kids), [100, 101, 200])
+        self.assertEqual(self._loop._kids.pop(101), ('out', 1, 2, 0))
+        self.assertEqual(self._loop._rescaling, {})
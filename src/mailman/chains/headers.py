@@ -21,19 +21,28 @@ import re
 import logging
 
 from email.header import Header
+from functools import lru_cache
 from itertools import count
 from mailman.chains.base import Chain, Link
 from mailman.config import config
 from mailman.core.i18n import _
+from mailman.database.transaction import dbconnection
 from mailman.interfaces.chain import LinkAction
+from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from mailman.interfaces.rules import IRule
+from mailman.model.mailinglist import HeaderMatch
+from mailman.utilities.patterns import combine_patterns
 from public import public
+from weakref import WeakKeyDictionary
 from zope.interface import implementer
 
 
 log = logging.getLogger('mailman.error')
 _RULE_COUNTER = count(1)
 
+# The scans of the messages going through the header-match chain.
+_scans = WeakKeyDictionary()
+
 
 def _make_rule_name(suffix):
     # suffix may be None, since it comes from the 'name' parameter given in
@@ -64,9 +73,10 @@ def make_link(header, pattern, chain=None, suffix=None):
     :rtype: `ILink`
     """
     rule_name = _make_rule_name(suffix)
-    if rule_name in config.rules:
-        rule = config.rules[rule_name]
-    else:
+    rule = config.rules.get(rule_name)
+    if rule is None or (rule.header, rule.pattern) != (header, pattern):
+        # The header check has changed since its rule was created.
+        config.rules.pop(rule_name, None)
         rule = HeaderMatchRule(header, pattern, suffix)
     if chain is None:
         return Link(rule)
@@ -97,30 +107,128 @@ class HeaderMatchRule:
 
     def check(self, mlist, msg, msgdata):
         """See `IRule`."""
-        # Collect all the headers in all subparts.
-        headers = []
-        for p in msg.walk():
-            headers.extend(p.get_all(self.header, []))
-        for value in headers:
-            if isinstance(value, Header):
-                value = value.encode()
+        # The header-match chain scans each message once for all of its
+        # rules.  Outside of the chain, scan it just for this one.
+        scan = _scans.get(msg)
+        if scan is None or self not in scan:
+            scan = HeaderMatchEngine([self]).scan(msg)
+        try:
+            value = scan.match(self)
+        except re.error as error:
+            log.error(
+                "Invalid regexp '{}' in header_matches for {}: {}".format(
+                    self.pattern, mlist.list_id, error.msg))
+            return False
+        if value is None:
+            return False
+        msgdata['moderation_sender'] = msg.sender
+        with _.defer_translation():
+            # This will be translated at the point of use.
+            msgdata.setdefault('moderation_reasons', []).append(
+                (_('Header "{}" matched a header rule'), str(value)))
+        return True
+
+
+@lru_cache(maxsize=1024)
+def _compile(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+# The patterns of the rules checking a header are only combined again when
+# they change.
+_combine = lru_cache(maxsize=256)(combine_patterns)
+
+
+@public
+class HeaderMatchEngine:
+    """Match the header rules against a message all at once.
+
+    The rules are grouped by the header they check.  Each message's headers
+    are collected in a single pass over all of its parts, and the patterns of
+    every rule checking a header are tried at once by a combined pattern.
+    Only when it matches are the rules' own patterns tried, to find out which
+    of them hit.
+    """
+
+    def __init__(self, rules):
+        self._rules = {}
+        for rule in rules:
+            self._rules.setdefault(rule.header.lower(), []).append(rule)
+
+    def scan(self, msg):
+        """Start matching the rules against a message.
+
+        :param msg: The message.
+        :type msg: `Message`
+        :return: The scan of the message, whose `match()` method tells
+            whether a rule matches it.
+        """
+        return _MessageScan(self, msg)
+
+    def match(self, header, values):
+        """Match the rules checking a header against its values.
+
+        :param header: The lower cased header name.
+        :type header: str
+        :param values: The header's values in the message.
+        :type values: list of str
+        :return: The value each rule matched, or None if it didn't match, or
+            the `re.error` raised by its pattern.
+        :rtype: dict
+        """
+        rules = self._rules.get(header, [])
+        results = dict.fromkeys(rules)
+        if len(values) == 0:
+            return results
+        combined, patterns = _combine(tuple(rule.pattern for rule in rules))
+        if combined is not None and not any(
+                combined.search(value) for value in values):
+            # Only the rules left out of the combined pattern can match.
+            rules = [rule for rule in rules if rule.pattern not in patterns]
+        for rule in rules:
             try:
-                mo = re.search(self.pattern, value, re.IGNORECASE)
+                compiled = _compile(rule.pattern)
             except re.error as error:
-                log.error(
-                    "Invalid regexp '{}' in header_matches for {}: {}".format(
-                        self.pattern, mlist.list_id, error.msg))
-                return False
-            else:
-                if mo:
-                    msgdata['moderation_sender'] = msg.sender
-                    with _.defer_translation():
-                        # This will be translated at the point of use.
-                        msgdata.setdefault('moderation_reasons', []).append(
-                            (_('Header "{}" matched a header rule'),
-                             str(value)))
-                    return True
-        return False
+                results[rule] = error
+                continue
+            for value in values:
+                if compiled.search(value):
+                    results[rule] = value
+                    break
+        return results
+
+
+class _MessageScan:
+    """The matching of the engine's rules against a message."""
+
+    def __init__(self, engine, msg):
+        self._engine = engine
+        # Collect all the headers in all subparts, by lower cased name.
+        self._headers = {}
+        for part in msg.walk():
+            for name, value in part.items():
+                if isinstance(value, Header):
+                    value = value.encode()
+                self._headers.setdefault(name.lower(), []).append(value)
+        self._results = {}
+
+    def __contains__(self, rule):
+        return rule in self._engine._rules.get(rule.header.lower(), [])
+
+    def match(self, rule):
+        """Return the header value the rule matched, if any.
+
+        :raises re.error: When the rule's pattern is invalid.
+        """
+        header = rule.header.lower()
+        results = self._results.get(header)
+        if results is None:
+            results = self._results[header] = self._engine.match(
+                header, self._headers.get(header, []))
+        result = results[rule]
+        if isinstance(result, re.error):
+            raise result
+        return result
 
 
 @public
@@ -137,6 +245,11 @@ class HeaderMatchChain(Chain):
         # configuration file, the database, and any explicitly added header
         # checks (via the .extend() method).
         self._extended_links = []
+        # The links are compiled into plans, which are reused for as long as
+        # the configuration and the mailing list's header matches stay the
+        # same.  The site links are shared by every mailing list's plan.
+        self._site_links = None
+        self._plans = {}
 
     def extend(self, header, pattern):
         """Extend the existing header matches.
@@ -146,6 +259,7 @@ class HeaderMatchChain(Chain):
             match is not anchored and is done case-insensitively.
         """
         self._extended_links.append(make_link(header, pattern))
+        self.invalidate()
 
     def flush(self):
         """See `IMutableChain`."""
@@ -155,9 +269,18 @@ class HeaderMatchChain(Chain):
             if rule_name.startswith('header-match-'):
                 del config.rules[rule_name]
         self._extended_links = []
+        self.invalidate()
 
-    def get_links(self, mlist, msg, msgdata):
-        """See `IChain`."""
+    def invalidate(self):
+        """Recompile the links of every mailing list the next time.
+
+        This happens when the configuration is pushed or popped, or when the
+        chain is extended or flushed.
+        """
+        self._site_links = None
+        self._plans.clear()
+
+    def _get_site_links(self):
         # First return all the configuration file links.
         for index, line in enumerate(
                 config.antispam.header_checks.splitlines()):
@@ -177,11 +300,70 @@ class HeaderMatchChain(Chain):
         # file.  For security considerations, this takes precedence over
         # list-specific matches.
         yield Link('any', LinkAction.jump, config.antispam.jump_chain)
+
+    @dbconnection
+    def _get_header_matches(self, store, mlist):
+        # The header matches may be changed by other processes, so they are
+        # read on every call, but without loading them as objects.
+        return tuple(store.query(
+            HeaderMatch.header, HeaderMatch.pattern, HeaderMatch.chain).filter(
+            HeaderMatch.mailing_list_id == mlist.id).order_by(
+            HeaderMatch._position))
+
+    def _get_compiled(self, mlist):
+        site_links = self._site_links
+        if site_links is None:
+            site_links = self._site_links = tuple(self._get_site_links())
+        header_matches = self._get_header_matches(mlist)
+        plan = self._plans.get(mlist.list_id)
+        if (plan is not None and
+                plan[0] is site_links and
+                plan[1] == header_matches):
+            return plan[2:]
+        links = list(site_links)
         # Then return all the list-specific header matches.
-        for index, entry in enumerate(mlist.header_matches):
+        for index, (header, pattern, chain) in enumerate(header_matches):
             # Jump to the default antispam chain if the entry chain is None.
-            chain = (config.antispam.jump_chain
-                     if entry.chain is None
-                     else entry.chain)
+            if chain is None:
+                chain = config.antispam.jump_chain
             rule_name = '{}-{}'.format(mlist.list_id, index)
-            yield make_link(entry.header, entry.pattern, chain, rule_name)
+            links.append(make_link(header, pattern, chain, rule_name))
+        links = tuple(links)
+        engine = HeaderMatchEngine(
+            link.rule for link in links
+            if isinstance(link.rule, HeaderMatchRule))
+        self._plans[mlist.list_id] = (
+            site_links, header_matches, links, engine)
+        return links, engine
+
+    def get_plan(self, mlist):
+        """Return the compiled links for the mailing list.
+
+        :param mlist: The mailing list.
+        :type mlist: `IMailingList`
+        :return: The links of the site-wide header checks followed by the
+            mailing list's header matches.
+        :rtype: tuple of `ILink`
+        """
+        links, engine = self._get_compiled(mlist)
+        return links
+
+    def get_links(self, mlist, msg, msgdata):
+        """See `IChain`."""
+        links, engine = self._get_compiled(mlist)
+        # The message is scanned once for all the rules, for as long as the
+        # links are being iterated over.
+        _scans[msg] = engine.scan(msg)
+        try:
+            yield from links
+        finally:
+            _scans.pop(msg, None)
+
+
+@public
+def handle_ConfigurationUpdatedEvent(event):
+    if not isinstance(event, ConfigurationUpdatedEvent):
+        return
+    chain = event.config.chains.get('header-match')
+    if chain is not None:
+        chain.invalidate()
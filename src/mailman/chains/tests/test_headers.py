@@ -17,11 +17,13 @@
 
 """Test the header chain."""
 
+import re
 import unittest
 
 from email import message_from_bytes
 from mailman.app.lifecycle import create_list
-from mailman.chains.headers import HeaderMatchRule, make_link
+from mailman.chains.headers import (
+    HeaderMatchEngine, HeaderMatchRule, make_link)
 from mailman.config import config
 from mailman.core.chains import process
 from mailman.email.message import Message
@@ -32,6 +34,7 @@ from mailman.testing.helpers import (
     LogFileMark, configuration, event_subscribers,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from unittest.mock import patch
 
 
 class TestHeaderChain(unittest.TestCase):
@@ -425,3 +428,134 @@ body
         self.assertEqual(msgdata['moderation_reasons'],
                          [('Header "{}" matched a header rule',
                            'Bad subject')])
+
+
+class TestHeaderChainPlan(unittest.TestCase):
+    """Test the compiled links of the header chain."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._chain = config.chains['header-match']
+        self._header_matches = IHeaderMatchList(self._mlist)
+        self._header_matches.append('Foo', 'a+')
+
+    def _checks(self):
+        return [(link.rule.header, link.rule.pattern)
+                for link in self._chain.get_plan(self._mlist)
+                if link.rule.name != 'any']
+
+    def test_reused(self):
+        self.assertIs(self._chain.get_plan(self._mlist),
+                      self._chain.get_plan(self._mlist))
+
+    def test_header_matches_added(self):
+        plan = self._chain.get_plan(self._mlist)
+        self._header_matches.append('Bar', 'b+')
+        self.assertIsNot(self._chain.get_plan(self._mlist), plan)
+        self.assertEqual(self._checks(), [('foo', 'a+'), ('bar', 'b+')])
+
+    def test_header_match_changed(self):
+        # The rule of a changed header match is replaced.
+        self._chain.get_plan(self._mlist)
+        self._header_matches[0].pattern = 'b+'
+        self.assertEqual(self._checks(), [('foo', 'b+')])
+        self.assertEqual(
+            config.rules['header-match-test.example.com-0'].pattern, 'b+')
+
+    def test_configuration(self):
+        plan = self._chain.get_plan(self._mlist)
+        with configuration('antispam', header_checks='Bar: b+'):
+            self.assertEqual(self._checks(), [('Bar', 'b+'), ('foo', 'a+')])
+        self.assertIsNot(self._chain.get_plan(self._mlist), plan)
+        self.assertEqual(self._checks(), [('foo', 'a+')])
+
+    def test_extend(self):
+        self._chain.get_plan(self._mlist)
+        self._chain.extend('Bar', 'b+')
+        self.addCleanup(self._chain.flush)
+        self.assertEqual(self._checks(), [('Bar', 'b+'), ('foo', 'a+')])
+        self._chain.flush()
+        self.assertEqual(self._checks(), [('foo', 'a+')])
+
+
+class TestHeaderMatchEngine(unittest.TestCase):
+    """Test matching many header rules at once."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Subject: A message
+Message-ID: <ant>
+X-Spam: spammy spam
+X-Spam: ham
+
+A message body.
+""")
+
+    def _match(self, *checks):
+        rules = [HeaderMatchRule(header, pattern)
+                 for header, pattern in checks]
+        for rule in rules:
+            self.addCleanup(config.rules.pop, rule.name)
+        scan = HeaderMatchEngine(rules).scan(self._msg)
+        results = []
+        for rule in rules:
+            try:
+                results.append(scan.match(rule))
+            except re.error:
+                results.append('error')
+        return results
+
+    def test_match(self):
+        self.assertEqual(
+            self._match(('x-spam', 'sp.m'), ('X-SPAM', '^ham'),
+                        ('x-spam', 'eggs'), ('subject', 'message'),
+                        ('x-eggs', '.*')),
+            ['spammy spam', 'ham', None, 'A message', None])
+
+    def test_back_reference(self):
+        self.assertEqual(
+            self._match(('x-spam', r'(m)\1'), ('x-spam', r'(a)\1')),
+            ['spammy spam', None])
+
+    def test_global_flags(self):
+        self.assertEqual(
+            self._match(('x-spam', '(?x) s p a m m y'), ('x-spam', 'eggs')),
+            ['spammy spam', None])
+
+    def test_invalid_pattern(self):
+        self.assertEqual(
+            self._match(('x-spam', '+spam'), ('x-spam', 'spam')),
+            ['error', 'spammy spam'])
+
+    def test_all_hits_recorded(self):
+        # Every matching rule is still recorded under its own name.
+        header_matches = IHeaderMatchList(self._mlist)
+        header_matches.append('X-Spam', 'spam')
+        header_matches.append('X-Spam', 'ham')
+        msgdata = {}
+        with configuration('antispam', header_checks="""
+            X-Spam: spammy
+            X-Spam: eggs
+            X-Spam: ^ham
+            """, jump_chain='discard'):             # noqa: E125
+            process(self._mlist, self._msg, msgdata,
+                    start_chain='header-match')
+        self.assertEqual(msgdata['rule_hits'],
+                         ['header-match-config-1', 'header-match-config-3'])
+        self.assertEqual(msgdata['rule_misses'], ['header-match-config-2'])
+
+    def test_walked_once(self):
+        header_matches = IHeaderMatchList(self._mlist)
+        for pattern in ('eggs', 'bacon', 'beans'):
+            header_matches.append('X-Spam', pattern)
+        header_matches.append('Subject', 'toast')
+        with patch.object(self._msg, 'walk', wraps=self._msg.walk) as walk:
+            process(self._mlist, self._msg, {}, start_chain='header-match')
+        self.assertEqual(walk.call_count, 1)
@@ -82,23 +82,25 @@ def display_members(ctx, mlist, role, regular, digest, nomail, outfp):
         # click should enforce a valid member role.
         roster = mlist.get_roster(MemberRole[role])
     # Print; outfp will be either the file or stdout to print to.
-    addresses = list(roster.addresses)
-    if len(addresses) == 0:
+    if roster.member_count == 0:
         print(_('$mlist.list_id has no members'), file=outfp)
         return
+    # Let the database filter the members on their delivery mode and status.
+    delivery_modes = None
+    if regular:
+        delivery_modes = [DeliveryMode.regular]
+    if digest is not None:
+        delivery_modes = [
+            mode for mode in digest_types
+            if delivery_modes is None or mode in delivery_modes
+            ]
+    if delivery_modes is None and nomail is None:
+        addresses = roster.addresses
+    else:
+        addresses = (
+            member.address for member in roster.get_delivery_members(
+                delivery_modes, None if nomail is None else status_types))
     for address in sorted(addresses, key=attrgetter('email')):
-        if regular:
-            member = roster.get_member(address.email)
-            if member.delivery_mode != DeliveryMode.regular:
-                continue
-        if digest is not None:
-            member = roster.get_member(address.email)
-            if member.delivery_mode not in digest_types:
-                continue
-        if nomail is not None:
-            member = roster.get_member(address.email)
-            if member.delivery_status not in status_types:
-                continue
         print(formataddr((address.display_name, address.original_email)),
               file=outfp)
 
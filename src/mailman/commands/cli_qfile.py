@@ -63,6 +63,12 @@ def qfile(doprint, interactive, qfile):
                 m.append(pickle.load(fp))
             except EOFError:
                 break
+            # Since queue file schema version 4, the pickled metadata and
+            # message attributes are followed by the message's body, and its
+            # headers too unless they are among the attributes.
+            if len(m) == 2 and all(isinstance(obj, dict) for obj in m):
+                m.append(fp.read().decode('utf-8', 'replace'))
+                break
     if doprint:
         print(_('[----- start pickle -----]'))
         for i, obj in enumerate(m):
@@ -17,9 +17,10 @@
 
 """Internationalization."""
 
+import threading
 import mailman.messages
 
-from flufl.i18n import PackageStrategy, registry
+from flufl.i18n import Application, PackageStrategy
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from public import public
 
@@ -27,19 +28,117 @@ from public import public
 public(_=None)
 
 
+class _SharedCatalogs:
+    """A catalog strategy which loads each catalog once for all threads."""
+
+    def __init__(self, strategy):
+        self.name = strategy.name
+        self._strategy = strategy
+        self._catalogs = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, language_code=None):
+        with self._lock:
+            catalog = self._catalogs.get(language_code)
+            if catalog is None:
+                catalog = self._strategy(language_code)
+                self._catalogs[language_code] = catalog
+            return catalog
+
+
+@public
+class ThreadLocalApplication(Application):
+    """An application whose translation contexts are private to each thread.
+
+    `flufl.i18n.Application` keeps one stack of translation contexts, which
+    doesn't work when runners process messages in several threads.  This
+    keeps a plain `Application` for each thread and hands everything over to
+    the current thread's.  The default language is shared by all threads.
+    """
+
+    def __init__(self, strategy):
+        # Don't chain up; the applications of the threads hold all the state.
+        self._catalog_strategy = _SharedCatalogs(strategy)
+        self._language = None
+        self._local = threading.local()
+
+    @property
+    def _application(self):
+        """The current thread's application."""
+        local = self._local
+        application = getattr(local, 'application', None)
+        if application is None:
+            application = Application(self._catalog_strategy)
+            local.application = application
+            local.language = None
+        if local.language != self._language:
+            if self._language is None:
+                del application.default
+            else:
+                application.default = self._language
+            local.language = self._language
+        return application
+
+    @property
+    def name(self):
+        """See `flufl.i18n.Application`."""
+        return self._catalog_strategy.name
+
+    @property
+    def default(self):
+        """See `flufl.i18n.Application`."""
+        return self._language
+
+    @default.setter
+    def default(self, language_code):
+        # Load the catalog, so that a bad language code fails right away.
+        self._catalog_strategy(language_code)
+        self._language = language_code
+
+    @default.deleter
+    def default(self):
+        self._language = None
+
+    def get(self, language_code):
+        """See `flufl.i18n.Application`."""
+        return self._application.get(language_code)
+
+    def defer(self):
+        """See `flufl.i18n.Application`."""
+        self._application.defer()
+
+    def push(self, language_code):
+        """See `flufl.i18n.Application`."""
+        self._application.push(language_code)
+
+    def pop(self):
+        """See `flufl.i18n.Application`."""
+        self._application.pop()
+
+    @property
+    def current(self):
+        """See `flufl.i18n.Application`."""
+        return self._application.current
+
+    @property
+    def code(self):
+        """See `flufl.i18n.Application`."""
+        return self._application.code
+
+
 @public
 def initialize(application=None):
     """Initialize the i18n subsystem.
 
-    :param application: An optional `flufl.i18n.Application` instance to use
+    :param application: An optional `ThreadLocalApplication` instance to use
         as the translation context.  This primarily exists to support the
         testing environment.
-    :type application: `flufl.i18n.Application`
+    :type application: `ThreadLocalApplication`
     """
     global _
     if application is None:
-        strategy = PackageStrategy('mailman', mailman.messages)
-        application = registry.register(strategy)
+        application = ThreadLocalApplication(
+            PackageStrategy('mailman', mailman.messages))
     _ = application._
 
 
@@ -17,18 +17,22 @@
 
 """The process runner base class."""
 
+import os
 import time
 import signal
 import logging
 import traceback
 
-from contextlib import suppress
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, suppress
 from io import StringIO
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.core.logging import reopen
-from mailman.core.switchboard import Switchboard
+from mailman.core.switchboard import (
+    SLICES_FILE, Switchboard, group_commit, switchboard_options)
+from mailman.database.transaction import savepoint
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.runner import (
@@ -45,31 +49,52 @@ elog = logging.getLogger('mailman.error')
 rlog = logging.getLogger('mailman.runner')
 
 
+class _Batch:
+    """The queue entries processed in one database transaction."""
+
+    def __init__(self):
+        # The entries to retire once the transaction is committed.
+        self.processed = []
+        # The entries which were shunted, to retire either way.
+        self.shunted = []
+        # Whether an entry failed, which ends the batch.
+        self.failed = False
+
+
 @public
 @implementer(IRunner)
 class Runner:
     is_queue_runner = True
 
-    def __init__(self, name, slice=None):
+    def __init__(self, name, slice=None, numslices=None):
         """Create a runner.
 
         :param slice: The slice number for this runner.  This is passed
             directly to the underlying `ISwitchboard` object.  This is ignored
             for runners that don't manage a queue.
         :type slice: int or None
+        :param numslices: The number of slices the queue is split into.  If
+            not given, this is the runner's configured number of instances.
+        :type numslices: int or None
         """
         # Grab the configuration section.
         self.name = name
         section = getattr(config, 'runner.' + name)
         substitutions = config.paths
         substitutions['name'] = name
-        numslices = int(section.instances)
+        if numslices is None:
+            numslices = int(section.instances)
         # Check whether the runner is queue runner or not; non-queue runner
         # should not have queue_directory or switchboard instance.
         if self.is_queue_runner:
             self.queue_directory = expand(section.path, None, substitutions)
+            # The instances the master adds to a running queue leave the
+            # backup files alone, since other instances may still be
+            # processing them.
+            recover = os.environ.get('MAILMAN_RUNNER_NO_RECOVER') is None
             self.switchboard = Switchboard(
-                name, self.queue_directory, slice, numslices, True)
+                name, self.queue_directory, slice, numslices, recover,
+                **switchboard_options(section))
         else:
             self.queue_directory = None
             self.switchboard = None
@@ -78,9 +103,15 @@ class Runner:
         self.sleep_float = (86400 * self.sleep_time.days +
                             self.sleep_time.seconds +
                             self.sleep_time.microseconds / 1.0e6)
+        self.wakeup = section.wakeup
+        self.batch_size = int(section.batch_size)
+        self.workers = int(section.workers)
+        # The worker threads are started on demand.
+        self._workers = None
         self.max_restarts = int(section.max_restarts)
         self.start = as_boolean(section.start)
         self._stop = False
+        self._resized = False
         self.status = 0
 
     def __repr__(self):
@@ -96,6 +127,12 @@ class Runner:
             reopen()
             rlog.info('{} runner caught SIGHUP.  Reopening logs.'.format(
                 self.name))
+        elif signum == signal.SIGUSR2:
+            # The master changed the number of instances of this runner.  Our
+            # slice of the queue is resized before the next look at it.
+            self._resized = True
+            rlog.info('{} runner caught SIGUSR2.  Resizing slice.'.format(
+                self.name))
         elif signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
             self.stop()
             self.status = signum
@@ -119,6 +156,12 @@ class Runner:
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGUSR1, self.signal_handler)
+        signal.signal(signal.SIGUSR2, self.signal_handler)
+        # The master may have resized the queue before the handler was
+        # installed, so look at the slice count it asks for once anyway.
+        if (self.switchboard is not None and
+                'MAILMAN_UNDER_MASTER_CONTROL' in os.environ):
+            self._resized = True
 
     def stop(self):
         """See `IRunner`."""
@@ -129,6 +172,8 @@ class Runner:
         # Start the main loop for this runner.
         with suppress(KeyboardInterrupt, RunnerInterrupt):
             while True:
+                if self._resized:
+                    self._resize()
                 # Once through the loop that processes all the files in the
                 # queue directory.
                 filecnt = self._one_iteration()
@@ -143,75 +188,263 @@ class Runner:
                 self._snooze(filecnt)
         self._clean_up()
 
+    def _resize(self):
+        """Split the queue into the number of slices the master asks for.
+
+        This is only done between looks at the queue, when none of our
+        entries are being processed.
+        """
+        self._resized = False
+        path = os.path.join(self.queue_directory, SLICES_FILE)
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                numslices = int(fp.read())
+        except FileNotFoundError:
+            # The queue was never resized.
+            return
+        self.switchboard.resize(numslices)
+
     def _one_iteration(self):
         """See `IRunner`."""
         me = self.__class__.__name__
         dlog.debug('[%s] starting oneloop', me)
-        # List all the files in our queue directory.  The switchboard is
+        # List all the due files in our queue directory.  The switchboard is
         # guaranteed to hand us the files in FIFO order.
-        files = self.switchboard.files
-        for filebase in files:
+        files = self.switchboard.get_batch()
+        # Entries enqueued while processing are committed as a group if their
+        # queues are configured for it.  A processed entry is only retired
+        # once everything enqueued on its behalf is durable.
+        with group_commit() as committer:
+            if self.workers > 1:
+                self._dispatch(files, committer)
+            else:
+                self._process_batches(files, committer)
+        dlog.debug('[%s] ending oneloop: %s', me, len(files))
+        return len(files)
+
+    def _process_batches(self, files, committer):
+        """Process the entries in batches in this thread.
+
+        Each batch is a single database transaction.  The processed entries
+        of a batch are only retired once the batch is committed.
+        """
+        me = self.__class__.__name__
+        batch = _Batch()
+        for count, filebase in enumerate(files, 1):
             dlog.debug('[%s] processing filebase: %s', me, filebase)
+            self._process_one_entry(filebase, batch)
+            # An entry which failed ends the batch, so that the transaction
+            # can be cleaned up before anything else is added to it.
+            if (count % self.batch_size != 0 and count < len(files)
+                    and not batch.failed and not self._short_circuit()):
+                continue
+            self._end_batch(batch, committer)
+            batch = _Batch()
+            dlog.debug('[%s] checking short circuit', me)
+            if self._short_circuit():
+                dlog.debug('[%s] short circuiting', me)
+                break
+
+    def _dispatch(self, files, committer):
+        """Process the entries in worker threads.
+
+        The entries are dequeued in this thread and handed to the workers.
+        All entries for a mailing list go to the same worker, so they are
+        still processed in order.  Each entry is processed in its own
+        database transaction, in the worker's own session, and retired here
+        when it is done.  What the workers enqueue joins this thread's group
+        commit.
+        """
+        me = self.__class__.__name__
+        if self._workers is None:
+            self._workers = [
+                ThreadPoolExecutor(max_workers=1)
+                for i in range(self.workers)
+                ]
+        in_flight = set()
+        for filebase in files:
+            dlog.debug('[%s] dispatching filebase: %s', me, filebase)
+            entry = self._dequeue(filebase)
+            if entry is not None:
+                msg, msgdata = entry
+                lane = hash(msgdata.get('listid')) % len(self._workers)
+                in_flight.add(self._workers[lane].submit(
+                    self._process_in_worker, filebase, msg, msgdata,
+                    committer))
+            # Don't let more entries than necessary wait in memory.
+            if len(in_flight) >= 2 * len(self._workers):
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                self._retire(done, committer)
+            dlog.debug('[%s] checking short circuit', me)
+            if self._short_circuit():
+                dlog.debug('[%s] short circuiting', me)
+                break
+        # Wait for everything that was dispatched, even when stopping.
+        done, not_done = wait(in_flight)
+        self._retire(done, committer)
+
+    def _process_in_worker(self, filebase, msg, msgdata, committer):
+        """Process one dequeued entry in a worker thread.
+
+        If the entry's transaction can't be committed, it is rolled back, and
+        the entry is put back in the queue to be processed again.
+
+        :return: The entry's batch.
+        :rtype: `_Batch`
+        """
+        batch = _Batch()
+        try:
+            with group_commit(committer):
+                self._process_dequeued(filebase, msg, msgdata, batch)
+            if batch.failed:
+                config.db.abort()
+            else:
+                config.db.commit()
+        except Exception as error:
+            self._log(error)
+            config.db.abort()
+            if filebase not in batch.shunted:
+                elog.error('Transaction failed, requeuing entry: %s',
+                           filebase)
+                self.switchboard.restore(filebase)
+                batch.processed = []
+        return batch
+
+    def _retire(self, done, committer):
+        """Retire the entries processed by the workers."""
+        me = self.__class__.__name__
+        for future in done:
             try:
-                # Ask the switchboard for the message and metadata objects
-                # associated with this queue file.
-                msg, msgdata = self.switchboard.dequeue(filebase)
+                batch = future.result()
             except Exception as error:
-                # This used to just catch email.Errors.MessageParseError, but
-                # other problems can occur in message parsing, e.g.
-                # ValueError, and exceptions can occur in unpickling too.  We
-                # don't want the runner to die, so we just log and skip this
-                # entry, but preserve it for analysis.
                 self._log(error)
-                elog.error('Skipping and preserving unparseable message: %s',
-                           filebase)
-                self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
                 continue
-            try:
-                dlog.debug('[%s] processing onefile', me)
-                self._process_one_file(msg, msgdata)
+            for filebase in batch.processed + batch.shunted:
                 dlog.debug('[%s] finishing filebase: %s', me, filebase)
-                self.switchboard.finish(filebase)
+                committer.defer(self.switchboard.finish, filebase)
+        # Other work we want to do each time through the loop.
+        dlog.debug('[%s] doing periodic', me)
+        self._do_periodic()
+        config.db.commit()
+        committer.commit_if_due()
+
+    def _end_batch(self, batch, committer):
+        """Commit the batch's transaction and retire its entries.
+
+        If the transaction can't be committed, it is rolled back, and the
+        processed entries are put back in the queue to be processed again.
+        """
+        me = self.__class__.__name__
+        if batch.failed and not self._use_savepoints:
+            # The failed entry's changes can only be rolled back with the
+            # whole transaction, which holds nothing else.
+            config.db.abort()
+        # Other work we want to do each time through the loop.
+        dlog.debug('[%s] doing periodic', me)
+        self._do_periodic()
+        dlog.debug('[%s] committing transaction', me)
+        try:
+            config.db.commit()
+        except Exception as error:
+            self._log(error)
+            config.db.abort()
+            for filebase in batch.processed:
+                elog.error('Transaction failed, requeuing entry: %s',
+                           filebase)
+                self.switchboard.restore(filebase)
+            batch.processed = []
+        for filebase in batch.processed + batch.shunted:
+            dlog.debug('[%s] finishing filebase: %s', me, filebase)
+            committer.defer(self.switchboard.finish, filebase)
+        committer.commit_if_due()
+
+    @property
+    def _use_savepoints(self):
+        # The entries of a batch are processed in savepoints, so that a
+        # failure only rolls back the failed entry.  A single entry has the
+        # whole transaction to itself.
+        return self.batch_size > 1 and self.workers <= 1
+
+    def _process_one_entry(self, filebase, batch):
+        """Dequeue and process, or shunt, one queue entry."""
+        entry = self._dequeue(filebase)
+        if entry is None:
+            batch.failed = True
+        else:
+            msg, msgdata = entry
+            self._process_dequeued(filebase, msg, msgdata, batch)
+
+    def _dequeue(self, filebase):
+        """Dequeue one queue entry, preserving it if it can't be read.
+
+        :return: The message and metadata, or None.
+        """
+        try:
+            # Ask the switchboard for the message and metadata objects
+            # associated with this queue file.
+            msg, msgdata = self.switchboard.dequeue(filebase)
+        except FileNotFoundError:
+            # Another instance of this runner got to the entry first, as can
+            # happen while the master changes the number of instances.
+            return None
+        except Exception as error:
+            # This used to just catch email.Errors.MessageParseError, but
+            # other problems can occur in message parsing, e.g.
+            # ValueError, and exceptions can occur in unpickling too.  We
+            # don't want the runner to die, so we just log and skip this
+            # entry, but preserve it for analysis.
+            self._log(error)
+            elog.error('Skipping and preserving unparseable message: %s',
+                       filebase)
+            self.switchboard.finish(filebase, preserve=True)
+            return None
+        return msg, msgdata
+
+    def _process_dequeued(self, filebase, msg, msgdata, batch):
+        """Process, or shunt, one dequeued queue entry.
+
+        In a batch of several entries, the entry's changes to the database
+        are made in a savepoint, so that a failure rolls back only this
+        entry.  The entry's file base is added to the batch, to be retired
+        when the batch ends.  The membership lookups made while processing
+        the entry are cached until it is done.
+        """
+        # Avoid circular imports.
+        from mailman.model.roster import member_cache
+        try:
+            dlog.debug('[%s] processing onefile', self.__class__.__name__)
+            with member_cache(), (
+                    savepoint() if self._use_savepoints else ExitStack()):
+                self._process_one_file(msg, msgdata)
+            batch.processed.append(filebase)
+        except Exception as error:
+            # All runners that implement _dispose() must guarantee that
+            # exceptions are caught and dealt with properly.  Still, there
+            # may be a bug in the infrastructure, and we do not want those
+            # to cause messages to be lost.  Any uncaught exceptions will
+            # cause the message to be stored in the shunt queue for human
+            # intervention.
+            self._log(error)
+            batch.failed = True
+            # Put a marker in the metadata for unshunting.
+            msgdata['whichq'] = self.switchboard.name
+            # It is possible that shunting can throw an exception, e.g. a
+            # permissions problem or a MemoryError due to a really large
+            # message.  Try to be graceful.
+            try:
+                shunt = config.switchboards['shunt']
+                new_filebase = shunt.enqueue(msg, msgdata)
+                elog.error('SHUNTING: %s', new_filebase)
+                batch.shunted.append(filebase)
             except Exception as error:
-                # All runners that implement _dispose() must guarantee that
-                # exceptions are caught and dealt with properly.  Still, there
-                # may be a bug in the infrastructure, and we do not want those
-                # to cause messages to be lost.  Any uncaught exceptions will
-                # cause the message to be stored in the shunt queue for human
-                # intervention.
+                # The message wasn't successfully shunted.  Log the
+                # exception and try to preserve the original queue entry
+                # for possible analysis.
                 self._log(error)
-                # Put a marker in the metadata for unshunting.
-                msgdata['whichq'] = self.switchboard.name
-                # It is possible that shunting can throw an exception, e.g. a
-                # permissions problem or a MemoryError due to a really large
-                # message.  Try to be graceful.
-                try:
-                    shunt = config.switchboards['shunt']
-                    new_filebase = shunt.enqueue(msg, msgdata)
-                    elog.error('SHUNTING: %s', new_filebase)
-                    self.switchboard.finish(filebase)
-                except Exception as error:
-                    # The message wasn't successfully shunted.  Log the
-                    # exception and try to preserve the original queue entry
-                    # for possible analysis.
-                    self._log(error)
-                    elog.error(
-                        'SHUNTING FAILED, preserving original entry: %s',
-                        filebase)
-                    self.switchboard.finish(filebase, preserve=True)
-                config.db.abort()
-            # Other work we want to do each time through the loop.
-            dlog.debug('[%s] doing periodic', me)
-            self._do_periodic()
-            dlog.debug('[%s] committing transaction', me)
-            config.db.commit()
-            dlog.debug('[%s] checking short circuit', me)
-            if self._short_circuit():
-                dlog.debug('[%s] short circuiting', me)
-                break
-        dlog.debug('[%s] ending oneloop: %s', me, len(files))
-        return len(files)
+                elog.error(
+                    'SHUNTING FAILED, preserving original entry: %s',
+                    filebase)
+                self.switchboard.finish(filebase, preserve=True)
 
     def _process_one_file(self, msg, msgdata):
         """See `IRunner`."""
@@ -279,7 +512,10 @@ class Runner:
 
     def _clean_up(self):
         """See `IRunner`."""
-        pass
+        if self._workers is not None:
+            for worker in self._workers:
+                worker.shutdown()
+            self._workers = None
 
     def _dispose(self, mlist, msg, msgdata):
         """See `IRunner`."""
@@ -293,7 +529,17 @@ class Runner:
         """See `IRunner`."""
         if filecnt or self.sleep_float <= 0:
             return
-        time.sleep(self.sleep_float)
+        timeout = self.sleep_float
+        if self.switchboard is not None:
+            # Don't sleep past the time the next delayed entry is due.
+            due = self.switchboard.next_due()
+            if due is not None:
+                timeout = max(min(timeout, due - time.time()), 0)
+        if self.wakeup == 'notify' and self.switchboard is not None:
+            # Wake up as soon as there's something new in our slice.
+            self.switchboard.wait(timeout)
+        else:
+            time.sleep(timeout)
 
     def _short_circuit(self):
         """See `IRunner`."""
@@ -15,35 +15,59 @@
 # You should have received a copy of the GNU General Public License along with
 # GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Queuing and dequeuing message/metadata pickle files.
+"""Queuing and dequeuing message/metadata queue files.
 
-Messages are represented as email.message.Message objects (or an instance ofa
+Messages are represented as email.message.Message objects (or an instance of a
 subclass).  Metadata is represented as a Python dictionary.  For every
-message/metadata pair in a queue, a single file containing two pickles is
-written.  First, the message is written to the pickle, then the metadata
-dictionary is written.
+message/metadata pair in a queue, a single file is written.  It starts with a
+short header of two pickles, the metadata dictionary and a dictionary of any
+extra attributes of the message object, followed by the message's RFC 5322
+bytes.  Dequeued messages are only parsed as far as they are used.
+
+Large sets of recipients are not pickled with the metadata.  They are written
+to a file beside the entry's, one sorted address per line, and dequeued as a
+`RecipientFile` which reads them from there.  When such recipients are
+enqueued again, the file is linked into the new queue instead of being written
+again.
+
+Files written with queue file schema version 3 or earlier contain a pickle of
+the message object followed by a pickle of the metadata.  They can still be
+dequeued.
+
+Queues can be configured for group commit, in which case entries enqueued
+inside a `group_commit()` block are made durable together, with a single sync,
+instead of one at a time.  Until then they remain invisible temporary files.
 """
 
 import os
 import time
 import email
+import bisect
 import pickle
 import hashlib
 import logging
+import itertools
+import threading
 
+from collections.abc import Set
+from contextlib import contextmanager, suppress
+from email.generator import BytesGenerator
+from io import BytesIO
+from lazr.config import as_timedelta
 from mailman.config import config
-from mailman.email.message import Message
+from mailman.email.message import (
+    BODY_ATTRIBUTES, HEADER_END, LazyMessage, Message)
 from mailman.interfaces.configuration import ConfigurationUpdatedEvent
 from mailman.interfaces.switchboard import ISwitchboard
-from mailman.utilities.filesystem import makedirs
+from mailman.utilities.filesystem import makedirs, watch_directory
 from mailman.utilities.string import expand
 from public import public
 from zope.interface import implementer
 
 
-# 20 bytes of all bits set, maximum hashlib.sha.digest() value.  We do it this
-# way for Python 2/3 compatibility.
-shamax = int('0xffffffffffffffffffffffffffffffffffffffff', 16)
+# The multiplier of the 64-bit linear congruential generator which drives the
+# jump consistent hash of queue entries onto slices.
+JUMP_MULTIPLIER = 2862933555777941757
 # Small increment to add to time in case two entries have the same time.  This
 # prevents skipping one of two entries with the same time until the next pass.
 DELTA = .0001
@@ -51,17 +75,500 @@ DELTA = .0001
 # In order to prevent loops and a message flood, when the count reaches this
 # value, we move the file to the bad queue as a .psv.
 MAX_BAK_COUNT = 3
+# Recipient sets with at least this many addresses are written to a file of
+# their own instead of being pickled with the metadata.
+MAX_INLINE_RECIPIENTS = 1000
+# How much of a recipient file to read at a time.
+RECIPIENTS_CHUNK = 65536
 
 elog = logging.getLogger('mailman.error')
 
 
+# The file in a queue directory holding the number of slices the master last
+# split the queue into.
+public(SLICES_FILE='slices')
+
+
+@public
+def slice_of(digest, numslices):
+    """Return the slice of a queue which an entry belongs to.
+
+    Entries are spread over the slices by the jump consistent hash of their
+    digests.  When a queue is split into one more slice, the only entries
+    which change slices are those moving into the new one, and when it is
+    split into one fewer, the only ones are those of the removed slice.
+
+    :param digest: The hex digest part of the entry's file base.
+    :type digest: str
+    :param numslices: The number of slices the queue is split into.
+    :type numslices: int
+    :return: The entry's slice number, in [0..`numslices`).
+    :rtype: int
+    """
+    key = int(digest[:16], 16)
+    bucket = -1
+    jump = 0
+    while jump < numslices:
+        bucket = jump
+        key = (key * JUMP_MULTIPLIER + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def _message_bytes(msg):
+    """Return the RFC 5322 bytes of a message, without folding its headers.
+
+    Folding would change the values of long headers, e.g. those of attached
+    messages, when the bytes are parsed again.
+    """
+    fp = BytesIO()
+    try:
+        BytesGenerator(fp, mangle_from_=False, maxheaderlen=0).flatten(msg)
+    except (KeyError, LookupError, UnicodeEncodeError):
+        # See Message.as_string().
+        return msg.as_string().encode('utf-8', 'surrogateescape')
+    return fp.getvalue()
+
+
+# The default values of the message attributes which aren't saved with its
+# bytes, since a lazy message has them anyway.
+_DEFAULT_ATTRIBUTES = dict(
+    _unixfrom=None, _charset=None, _default_type='text/plain', defects=[])
+
+
+# The message attributes which are never saved with its bytes: the policy,
+# which is always the default one, and those of a lazy message which only
+# tell how far it is parsed.
+_UNSAVED_ATTRIBUTES = (
+    BODY_ATTRIBUTES | {'policy', '_raw', '_body_start', '_parsed_headers'})
+# The header attributes which are restored from the message's bytes when the
+# headers are written as bytes.
+_PARSED_HEADER_ATTRIBUTES = frozenset(('_headers', 'defects'))
+
+
+def _message_parts(msg):
+    """Return the bytes of a message and its attributes to save with them.
+
+    The body is always saved as bytes, and so are the headers if they are a
+    lazy message's original, unchanged bytes.  Otherwise the headers are
+    saved with the other attributes, since what Mailman sets there, e.g.
+    Header instances or long values, doesn't survive a round trip through
+    bytes unchanged.  The attributes also hold the message's class, unless
+    it is `Message`, and the attributes which Mailman sets, such as
+    `original_size`.
+
+    :return: The bytes and the attributes.
+    :rtype: 2-tuple of (bytes-like object, dict)
+    """
+    if isinstance(msg, LazyMessage) and msg.raw_body() is not None:
+        message_class = msg._message_class
+        headers = msg.raw_headers()
+        raw = msg.raw_body() if headers is None else msg._raw
+    else:
+        raw = _message_bytes(msg)
+        # This is the class of the message a lazy one stands for.
+        message_class = getattr(msg, '_message_class', type(msg))
+        headers = None
+        match = HEADER_END.search(raw)
+        raw = b'' if match is None else raw[match.end():]
+    unsaved = (_UNSAVED_ATTRIBUTES if headers is None
+               else _UNSAVED_ATTRIBUTES | _PARSED_HEADER_ATTRIBUTES)
+    attributes = {
+        name: value for name, value in vars(msg).items()
+        if name not in unsaved
+        and not (name in _DEFAULT_ATTRIBUTES and
+                 value == _DEFAULT_ATTRIBUTES[name])
+        }
+    if message_class is not Message:
+        attributes['__class__'] = message_class
+    return raw, attributes
+
+
+def _lazy_message(raw, attributes):
+    """Return the message saved as bytes and attributes."""
+    attributes = attributes.copy()
+    message_class = attributes.pop('__class__', Message)
+    msg = LazyMessage.for_class(message_class)(
+        raw, headers_included=('_headers' not in attributes))
+    msg.__dict__.update(attributes)
+    return msg
+
+
+def _write_entry(fp, raw, attributes, data):
+    """Write a queue entry, whose message attributes are already pickled."""
+    pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+    fp.write(attributes)
+    fp.write(raw)
+
+
+def _read_entry(fp):
+    """Read a queue entry.
+
+    :return: 3-tuple of the message, the message's extra attributes and the
+        metadata.  The message is its raw bytes, unless the entry was written
+        with queue file schema version 3 or earlier, in which case it is the
+        unpickled message object or text.
+    """
+    first = pickle.load(fp)
+    if isinstance(first, dict):
+        attributes = pickle.load(fp)
+        return fp.read(), attributes, first
+    return first, {}, pickle.load(fp)
+
+
+@public
+class RecipientFile(Set):
+    """The recipients of a queue entry, stored in a file beside it.
+
+    The addresses are read from the file as they are iterated over.  They are
+    all loaded into memory only if membership is tested.  The file is only
+    open while it is being read, so once their queue entry is finished, the
+    recipients can only be read if they were loaded.
+    """
+
+    def __init__(self, path, count):
+        self.path = path
+        self._count = count
+        self._members = None
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        # The results of set operations are plain sets.
+        return set(iterable)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._members is not None:
+            yield from sorted(self._members)
+            return
+        try:
+            fp = open(self.path, 'rb')
+        except FileNotFoundError as error:
+            raise FileNotFoundError(
+                error.errno, 'The queue entry of these recipients is finished',
+                self.path) from None
+        with fp:
+            rest = b''
+            while True:
+                chunk = fp.read(RECIPIENTS_CHUNK)
+                if len(chunk) == 0:
+                    break
+                lines = (rest + chunk).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8')
+        if len(rest) > 0:
+            yield rest.decode('utf-8')
+
+    def __contains__(self, address):
+        if self._members is None:
+            self._members = frozenset(self)
+        return address in self._members
+
+    def __reduce__(self):
+        # Anywhere else, these are just a set of recipients.
+        return set, (list(self),)
+
+    def __repr__(self):
+        return '<RecipientFile {} ({} recipients)>'.format(
+            self.path, self._count)
+
+    def link(self, path):
+        """Link the recipients to another path.
+
+        :param path: The new path.
+        :type path: str
+        :return: True if the file was linked, False if its contents have to
+            be copied instead, e.g. because the path is on another file system
+            or the queue entry is finished.  In the latter case, copying only
+            works if the recipients were loaded.
+        :rtype: bool
+        """
+        try:
+            os.link(self.path, path)
+        except OSError:
+            return False
+        return True
+
+
+def _write_recipients(path, recipients, sync):
+    """Write the recipients of a queue entry to their own file.
+
+    :return: The number of recipients written, without duplicates.
+    :rtype: int
+    """
+    if isinstance(recipients, RecipientFile):
+        if recipients.link(path):
+            return len(recipients)
+        # The addresses are already unique and sorted.
+        addresses = recipients
+    else:
+        addresses = sorted(set(recipients))
+    count = 0
+    try:
+        with open(path, 'wb') as fp:
+            for address in addresses:
+                fp.write(address.encode('utf-8'))
+                fp.write(b'\n')
+                count += 1
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+    except BaseException:
+        # Don't leave a partial file behind, e.g. when the recipients of a
+        # finished queue entry can't be read.
+        with suppress(FileNotFoundError):
+            os.remove(path)
+        raise
+    return count
+
+
+def _fsync_path(path):
+    """Make a file or directory durable, given its path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _GroupCommit:
+    """Queue entries written, but not yet made durable and visible.
+
+    Other threads can join the group, so its methods hold a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # The nesting level of group_commit() blocks.
+        self.depth = 0
+        # 3-tuples of (temporary file, final file name, other files which must
+        # be durable before the entry becomes visible).
+        self.entries = []
+        # Callables to run once the pending entries have been committed.
+        self.deferred = []
+        # The time.time() at which the pending entries must be committed.
+        self.deadline = None
+
+    def add(self, switchboard, tmpfile, filename, others=()):
+        with self._lock:
+            self.entries.append((tmpfile, filename, tuple(others)))
+            deadline = time.time() + switchboard.group_commit_window
+            if self.deadline is None or deadline < self.deadline:
+                self.deadline = deadline
+            if len(self.entries) >= switchboard.group_commit_max:
+                self.commit()
+
+    def defer(self, function, *args):
+        """Call the function once all pending entries are durable.
+
+        If there are no pending entries, the function is called right away.
+        This is used to retire a source queue entry only after everything
+        that was enqueued while processing it has been safely committed.
+        """
+        with self._lock:
+            if len(self.entries) == 0:
+                function(*args)
+            else:
+                self.deferred.append((function, args))
+
+    def commit_if_due(self):
+        """Commit the pending entries if the commit window has closed."""
+        with self._lock:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.commit()
+
+    def commit(self):
+        """Make all pending entries durable and visible."""
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        entries, self.entries = self.entries, []
+        deferred, self.deferred = self.deferred, []
+        self.deadline = None
+        if len(entries) > 0:
+            # None of the files have been synced yet, so the file system can
+            # write them out together.  Only once they are durable are they
+            # renamed into place, preserving the guarantee that a visible .pck
+            # file is always complete.
+            synced = []
+            directories = set()
+            failed = False
+            for tmpfile, filename, others in entries:
+                try:
+                    for path in (tmpfile,) + others:
+                        _fsync_path(path)
+                except OSError:
+                    elog.exception('Group commit failed for: %s', filename)
+                    failed = True
+                else:
+                    synced.append((tmpfile, filename))
+                    directories.update(
+                        os.path.dirname(path) for path in others)
+            # The other files aren't renamed into place, so they must already
+            # be in their directories.
+            for directory in directories:
+                _fsync_path(directory)
+            directories = set()
+            for tmpfile, filename in synced:
+                try:
+                    os.rename(tmpfile, filename)
+                except OSError:
+                    elog.exception('Group commit failed for: %s', filename)
+                    failed = True
+                else:
+                    directories.add(os.path.dirname(filename))
+            # Make the renames themselves durable before anything depending
+            # on them happens.
+            for directory in directories:
+                _fsync_path(directory)
+            if failed:
+                # Don't retire the source entries; they'll be recovered from
+                # their backup files and processed again.
+                return
+        for function, args in deferred:
+            function(*args)
+
+
+class _ThreadState(threading.local):
+    def __init__(self):
+        # Group commits are private to each thread.
+        self.pending = _GroupCommit()
+
+
+_state = _ThreadState()
+
+
+class _QueueIndex:
+    """An in-memory FIFO index of the entries in a queue slice."""
+
+    def __init__(self, entries):
+        # Map file bases to their sort keys, which are 2-tuples of the
+        # entry's time and its file base, so that entries with the same time
+        # still sort consistently.
+        self._keys = {
+            filebase: (when, filebase)
+            for filebase, when in entries
+            }
+        # The sort keys in FIFO order.  Removed entries are only dropped from
+        # here lazily, so a key is current only if it is the very object
+        # mapped to its file base; an entry which is removed and added again
+        # gets a new key.
+        self._order = sorted(self._keys.values())
+        # The file bases of all the entries in FIFO order, built on demand and
+        # kept until the entries change.
+        self._files = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, filebase, when):
+        if filebase in self._keys:
+            return
+        key = (when, filebase)
+        self._keys[filebase] = key
+        self._files = None
+        # New entries almost always sort last.
+        if len(self._order) == 0 or key >= self._order[-1]:
+            self._order.append(key)
+        else:
+            bisect.insort(self._order, key)
+
+    def discard(self, filebase):
+        if self._keys.pop(filebase, None) is not None:
+            self._files = None
+
+    def files(self):
+        """Return the file bases of all the entries, in FIFO order.
+
+        The same list is returned until the entries change, so it must not be
+        modified.
+        """
+        if self._files is None:
+            self._files = self.first()
+        return self._files
+
+    def first(self, count=None, until=None):
+        """Return up to `count` of the oldest file bases, in FIFO order.
+
+        If `until` is given, only the entries due by then are returned.
+        """
+        if len(self._order) > 2 * len(self._keys):
+            self._order = [key for key in self._order if self._current(key)]
+        if count is None:
+            count = len(self._keys)
+        filebases = []
+        for key in self._order:
+            if len(filebases) >= count:
+                break
+            if until is not None and key[0] > until:
+                # The rest of the entries aren't due yet.
+                break
+            if self._current(key):
+                filebases.append(key[1])
+        return filebases
+
+    def next_due(self, after):
+        """Return the time of the first entry due after `after`, or None."""
+        start = bisect.bisect_right(self._order, (after,))
+        for key in itertools.islice(self._order, start, None):
+            if key[0] > after and self._current(key):
+                return key[0]
+        return None
+
+    def _current(self, key):
+        return self._keys.get(key[1]) is key
+
+
+@public
+@contextmanager
+def group_commit(group=None):
+    """Context manager for committing queue entries as a group.
+
+    Entries enqueued inside this block to a queue with group commit enabled
+    are written but not synced.  They are committed together when the
+    queue's `group_commit_max` or `group_commit_window` is reached, and
+    always by the time the outermost block exits.  Queues without group
+    commit behave as usual.  The object bound by the `with` statement can
+    `defer()` work until the entries are committed.  Only entries enqueued by
+    the thread which entered the block, and by threads which joined it, are
+    part of the group.
+
+    :param group: The object bound by another thread's `group_commit()`
+        block, to join that group instead of starting one.  The group must
+        outlive this block.
+    """
+    if group is not None:
+        # Enqueue into the other thread's group for the rest of the block.
+        own = _state.pending
+        _state.pending = group
+        try:
+            yield group
+        finally:
+            _state.pending = own
+        return
+    pending = _state.pending
+    pending.depth += 1
+    try:
+        yield pending
+    finally:
+        pending.depth -= 1
+        if pending.depth == 0:
+            pending.commit()
+
+
 @public
 @implementer(ISwitchboard)
 class Switchboard:
     """See `ISwitchboard`."""
 
     def __init__(self, name, queue_directory,
-                 slice=None, numslices=1, recover=False):
+                 slice=None, numslices=1, recover=False,
+                 group_commit_max=0, group_commit_window=0,
+                 rescan_interval=None):
         """Create a switchboard object.
 
         :param name: The queue name.
@@ -72,25 +579,36 @@ class Switchboard:
             None, it must be [0..`numslices`).
         :type slice: int or None
         :param numslices: The total number of slices to split this queue
-            directory into.  It must be a power of 2.
+            directory into.
         :type numslices: int
         :param recover: True if backup files should be recovered.
         :type recover: bool
+        :param group_commit_max: The maximum number of entries to commit as a
+            group, or 0 to sync every entry as it is enqueued.
+        :type group_commit_max: int
+        :param group_commit_window: The maximum number of seconds an entry
+            may wait for its group to be committed.
+        :type group_commit_window: float
+        :param rescan_interval: When changes to the queue directory can only
+            be noticed by its modification time, the longest time in seconds
+            between full scans of it, or None.
+        :type rescan_interval: float or None
         """
-        assert (numslices & (numslices - 1)) == 0, (
-            'Not a power of 2: {}'.format(numslices))
+        assert numslices > 0, 'Bad number of slices: {}'.format(numslices)
         self.name = name
         self.queue_directory = queue_directory
+        self.group_commit_max = group_commit_max
+        self.group_commit_window = group_commit_window
+        self.rescan_interval = rescan_interval
         # If configured to, create the directory if it doesn't yet exist.
         if config.create_paths:
             makedirs(self.queue_directory, 0o770)
-        # Fast track for no slices
-        self._lower = None
-        self._upper = None
-        # BAW: test performance and end-cases of this algorithm
-        if numslices != 1:
-            self._lower = ((shamax + 1) * slice) / numslices
-            self._upper = (((shamax + 1) * (slice + 1)) / numslices) - 1
+        # The index of our slice's .pck files, and the watcher that keeps it
+        # up to date.  Both are set up on demand.
+        self._index = None
+        self._watcher = None
+        self._slice = slice
+        self._numslices = numslices
         if recover:
             self.recover_backup_files()
 
@@ -104,22 +622,26 @@ class Switchboard:
         data = _metadata.copy()
         data.update(_kws)
         list_id = data.get('listid', '--nolist--')
-        # Get some data for the input to the sha hash.
-        now = repr(time.time())
-        if data.get('_plaintext'):
-            protocol = 0
-            msgsave = pickle.dumps(str(_msg), protocol)
+        # Get some data for the input to the sha hash.  Entries which are to
+        # be processed later are simply given a later time.
+        now = repr(time.time() + max(data.get('_delay', 0), 0))
+        plaintext = bool(data.get('_plaintext'))
+        if plaintext:
+            raw = str(_msg).encode('utf-8', 'surrogateescape')
+            attributes = {}
         else:
-            protocol = pickle.HIGHEST_PROTOCOL
-            msgsave = pickle.dumps(_msg, protocol)
+            raw, attributes = _message_parts(_msg)
+        attributes = pickle.dumps(attributes, pickle.HIGHEST_PROTOCOL)
         # The list-id field is a string but the input to the hash function must
-        # be bytes.
-        hashfood = msgsave + list_id.encode('utf-8') + now.encode('utf-8')
+        # be bytes.  The pickled attributes may hold the message's headers.
+        hashfood = hashlib.sha1(raw)
+        hashfood.update(attributes)
+        hashfood.update(list_id.encode('utf-8') + now.encode('utf-8'))
         # Encode the current time into the file name for FIFO sorting.  The
         # file name consists of two parts separated by a '+': the received
-        # time for this message (i.e. when it first showed up on this system)
-        # and the sha hex digest.
-        filebase = now + '+' + hashlib.sha1(hashfood).hexdigest()
+        # time for this message (i.e. when it first showed up on this system,
+        # or when it is due if it was delayed) and the sha hex digest.
+        filebase = now + '+' + hashfood.hexdigest()
         filename = os.path.join(self.queue_directory, filebase + '.pck')
         tmpfile = filename + '.tmp'
         # Always add the metadata schema version number
@@ -129,16 +651,34 @@ class Switchboard:
         for k in list(data):
             if k.startswith('_'):
                 del data[k]
-        # We have to tell the dequeue() method whether to parse the message
-        # object or not.
-        data['_parsemsg'] = (protocol == 0)
-        # Write to the pickle file the message object and metadata.
+        # We have to tell the dequeue() method whether the message was
+        # enqueued as text or not.
+        data['_parsemsg'] = plaintext
+        # Write the queue file.  Inside a group commit, leave the syncing and
+        # renaming to the group.
+        pending = _state.pending
+        deferred = (self.group_commit_max > 0 and pending.depth > 0)
+        # Write large sets of recipients to their own file, which must be
+        # complete before the queue file appears.  The group syncs it too.
+        others = []
+        recipients = data.get('recipients')
+        if (isinstance(recipients, RecipientFile) or (
+                isinstance(recipients, (set, frozenset, list, tuple)) and
+                len(recipients) >= MAX_INLINE_RECIPIENTS)):
+            rcpfile = os.path.join(self.queue_directory, filebase + '.rcp')
+            data['_recipients'] = _write_recipients(
+                rcpfile, recipients, not deferred)
+            del data['recipients']
+            others.append(rcpfile)
         with open(tmpfile, 'wb') as fp:
-            fp.write(msgsave)
-            pickle.dump(data, fp, protocol)
-            fp.flush()
-            os.fsync(fp.fileno())
-        os.rename(tmpfile, filename)
+            _write_entry(fp, raw, attributes, data)
+            if not deferred:
+                fp.flush()
+                os.fsync(fp.fileno())
+        if deferred:
+            pending.add(self, tmpfile, filename, others)
+        else:
+            os.rename(tmpfile, filename)
         return filebase
 
     def dequeue(self, filebase):
@@ -152,9 +692,15 @@ class Switchboard:
             # process crashes uncleanly the .bak file will be used to
             # re-instate the .pck file in order to try again.
             os.rename(filename, backfile)
-            msg = pickle.load(fp)
-            data = pickle.load(fp)
+            if self._index is not None:
+                # Our own rename needn't make the queue directory be
+                # scanned again.
+                self._index.discard(filebase)
+                self._watcher.acknowledge()
+            msg, attributes, data = _read_entry(fp)
         if data.get('_parsemsg'):
+            if isinstance(msg, bytes):
+                msg = msg.decode('utf-8', 'surrogateescape')
             # Calculate the original size of the text now so that we won't
             # have to generate the message later when we do size restriction
             # checking.
@@ -162,6 +708,12 @@ class Switchboard:
             msg = email.message_from_string(msg, Message)
             msg.original_size = original_size
             data['original_size'] = original_size
+        elif isinstance(msg, bytes):
+            msg = _lazy_message(msg, attributes)
+        if '_recipients' in data:
+            data['recipients'] = RecipientFile(
+                os.path.join(self.queue_directory, filebase + '.rcp'),
+                data.pop('_recipients'))
         return msg, data
 
     def finish(self, filebase, preserve=False):
@@ -184,17 +736,128 @@ class Switchboard:
         except EnvironmentError:
             elog.exception(
                 'Failed to unlink/preserve backup file: %s', bakfile)
+        # The entry's recipients go wherever the entry does.
+        rcpfile = os.path.join(self.queue_directory, filebase + '.rcp')
+        if os.path.exists(rcpfile):
+            try:
+                if preserve:
+                    os.rename(
+                        rcpfile, os.path.join(bad_dir, filebase + '.rcp'))
+                else:
+                    os.unlink(rcpfile)
+            except EnvironmentError:
+                elog.exception(
+                    'Failed to unlink/preserve recipients file: %s', rcpfile)
+        if self._index is not None:
+            # Apply our own changes to the index, so that they don't make the
+            # queue directory be scanned again.
+            self._index.discard(filebase)
+            self._watcher.acknowledge()
 
     @property
     def files(self):
         """See `ISwitchboard`."""
-        return self.get_files()
+        self._update_index()
+        return self._index.files()
 
-    def get_files(self, extension='.pck'):
+    def get_batch(self, count=None):
         """See `ISwitchboard`."""
-        times = {}
-        lower = self._lower
-        upper = self._upper
+        self._update_index()
+        return self._index.first(count, until=time.time())
+
+    def next_due(self):
+        """See `ISwitchboard`."""
+        self._update_index()
+        return self._index.next_due(time.time())
+
+    def _in_slice(self, digest):
+        """Is the entry with the given hex digest in our slice?"""
+        # Fast track for no slices
+        return (self._slice is None or self._numslices == 1 or
+                slice_of(digest, self._numslices) == self._slice)
+
+    def resize(self, numslices):
+        """Split the queue into a different number of slices.
+
+        Our slice keeps its number.  When the queue is split into more
+        slices, our slice only loses the entries which move into the new
+        ones.  When it is split into fewer, it only gains entries of the
+        removed slices, whose backup files are then recovered, so this must
+        only be done once nothing processes those slices anymore.
+
+        :param numslices: The new number of slices.
+        :type numslices: int
+        """
+        assert numslices > 0, 'Bad number of slices: {}'.format(numslices)
+        assert self._slice is None or self._slice < numslices, (
+            'Slice {} removed'.format(self._slice))
+        growing = numslices < self._numslices
+        self._numslices = numslices
+        # Look at the whole queue directory again next time.
+        self._index = None
+        if growing:
+            self.recover_backup_files()
+
+    def _update_index(self):
+        """Bring the index up to date with the queue directory."""
+        if self._watcher is None:
+            # Start watching before the directory is scanned, so that no
+            # change can fall in between.
+            self._watcher = watch_directory(
+                self.queue_directory, self.rescan_interval)
+            changes = None
+        else:
+            changes = self._watcher.wait(0)
+        self._apply_changes(changes)
+
+    def _apply_changes(self, names):
+        """Apply the changes reported by the watcher to the index.
+
+        :param names: The names of the files in the queue directory which
+            have changed, or None if the changes are unknown.  In the latter
+            case, the queue directory is scanned again.
+        :return: The number of entries added to the index.
+        :rtype: int
+        """
+        if names is None or self._index is None:
+            self._index = _QueueIndex(self._scan('.pck'))
+            return len(self._index)
+        added = 0
+        for name in names:
+            filebase, ext = os.path.splitext(name)
+            if ext != '.pck' or '+' not in filebase:
+                continue
+            when, digest = filebase.split('+', 1)
+            if not self._in_slice(digest):
+                continue
+            if os.path.exists(os.path.join(self.queue_directory, name)):
+                self._index.add(filebase, float(when))
+                added += 1
+            else:
+                self._index.discard(filebase)
+        return added
+
+    def wait(self, timeout):
+        """See `ISwitchboard`."""
+        if self._watcher is None:
+            # Entries added before the watch was set up would be missed, so
+            # the caller must look at the queue again now.
+            self._update_index()
+            return True
+        deadline = time.time() + timeout
+        while True:
+            changes = self._watcher.wait(max(deadline - time.time(), 0))
+            if changes is not None and len(changes) == 0:
+                return False
+            if self._apply_changes(changes) > 0:
+                return True
+
+    def _scan(self, extension):
+        """Scan the queue directory for our slice's files.
+
+        :return: 2-tuples of the file base and its time, in no particular
+            order.
+        """
         for f in os.listdir(self.queue_directory):
             # By ignoring anything that doesn't end in .pck, we ignore
             # tempfiles and avoid a race condition.
@@ -202,14 +865,17 @@ class Switchboard:
             if ext != extension:
                 continue
             when, digest = filebase.split('+', 1)
-            # Throw out any files which don't match our bitrange.  BAW: test
-            # performance and end-cases of this algorithm.  MAS: both
-            # comparisons need to be <= to get complete range.
-            if lower is None or (lower <= int(digest, 16) <= upper):
-                key = float(when)
-                while key in times:
-                    key += DELTA
-                times[key] = filebase
+            # Throw out any files which don't belong to our slice.
+            if self._in_slice(digest):
+                yield filebase, float(when)
+
+    def get_files(self, extension='.pck'):
+        """See `ISwitchboard`."""
+        times = {}
+        for filebase, key in self._scan(extension):
+            while key in times:
+                key += DELTA
+            times[key] = filebase
         # FIFO sort
         return [times[k] for k in sorted(times)]
 
@@ -222,37 +888,41 @@ class Switchboard:
         # file.  When the count reaches MAX_BAK_COUNT, we move the .bak file
         # to a .psv file in the bad queue.
         for filebase in self.get_files('.bak'):
-            src = os.path.join(self.queue_directory, filebase + '.bak')
-            dst = os.path.join(self.queue_directory, filebase + '.pck')
-            with open(src, 'rb+') as fp:
-                try:
-                    # Throw away the message object.
-                    pickle.load(fp)
-                    data_pos = fp.tell()
-                    data = pickle.load(fp)
-                except Exception as error:
-                    # If unpickling throws any exception, just log and
-                    # preserve this entry
-                    elog.error('Unpickling .bak exception: %s\n'
-                               'Preserving file: %s', error, filebase)
+            self.restore(filebase)
+
+    def restore(self, filebase):
+        """See `ISwitchboard`."""
+        src = os.path.join(self.queue_directory, filebase + '.bak')
+        dst = os.path.join(self.queue_directory, filebase + '.pck')
+        with open(src, 'rb+') as fp:
+            try:
+                msg, attributes, data = _read_entry(fp)
+            except Exception as error:
+                # If unpickling throws any exception, just log and
+                # preserve this entry
+                elog.error('Unpickling .bak exception: %s\n'
+                           'Preserving file: %s', error, filebase)
+                self.finish(filebase, preserve=True)
+            else:
+                data['_bak_count'] = data.get('_bak_count', 0) + 1
+                # Rewrite the whole entry, upgrading legacy ones to the
+                # current format.
+                if isinstance(msg, str):
+                    msg = msg.encode('utf-8', 'surrogateescape')
+                elif not isinstance(msg, bytes):
+                    msg, attributes = _message_parts(msg)
+                fp.seek(0)
+                _write_entry(fp, msg, pickle.dumps(
+                    attributes, pickle.HIGHEST_PROTOCOL), data)
+                fp.truncate()
+                fp.flush()
+                os.fsync(fp.fileno())
+                if data['_bak_count'] >= MAX_BAK_COUNT:
+                    elog.error('.bak file max count, preserving file: %s',
+                               filebase)
                     self.finish(filebase, preserve=True)
                 else:
-                    data['_bak_count'] = data.get('_bak_count', 0) + 1
-                    fp.seek(data_pos)
-                    if data.get('_parsemsg'):
-                        protocol = 0
-                    else:
-                        protocol = 1
-                    pickle.dump(data, fp, protocol)
-                    fp.truncate()
-                    fp.flush()
-                    os.fsync(fp.fileno())
-                    if data['_bak_count'] >= MAX_BAK_COUNT:
-                        elog.error('.bak file max count, preserving file: %s',
-                                   filebase)
-                        self.finish(filebase, preserve=True)
-                    else:
-                        os.rename(src, dst)
+                    os.rename(src, dst)
 
 
 @public
@@ -271,4 +941,23 @@ def handle_ConfigurationUpdatedEvent(event):
             substitutions = config.paths
             substitutions['name'] = name
             path = expand(conf.path, None, substitutions)
-            config.switchboards[name] = Switchboard(name, path)
+            config.switchboards[name] = Switchboard(
+                name, path, **switchboard_options(conf))
+
+
+@public
+def switchboard_options(section):
+    """The keyword arguments for a runner's switchboard.
+
+    These are the group commit settings, and the runner's sleep time as the
+    interval between full scans of its queue.
+
+    :param section: The runner's configuration section.
+    :return: The keyword arguments for the `Switchboard` constructor.
+    :rtype: dict
+    """
+    window = as_timedelta(section.group_commit_window)
+    return dict(group_commit_max=int(section.group_commit_max),
+                group_commit_window=window.total_seconds(),
+                rescan_interval=as_timedelta(
+                    section.sleep_time).total_seconds())
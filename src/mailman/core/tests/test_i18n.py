@@ -0,0 +1,76 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test internationalization."""
+
+import unittest
+import threading
+
+from mailman.core.i18n import _
+from mailman.testing.layers import ConfigLayer
+
+
+class TestTranslationContexts(unittest.TestCase):
+    layer = ConfigLayer
+
+    def test_contexts_are_thread_local(self):
+        codes = []
+
+        def translate():
+            codes.append(_.code)
+            with _.using('fr'):
+                codes.append(_.code)
+                entered.set()
+                leave.wait()
+        entered = threading.Event()
+        leave = threading.Event()
+        thread = threading.Thread(target=translate)
+        with _.using('xx'):
+            thread.start()
+            entered.wait()
+            # The other thread's context doesn't change this thread's.
+            self.assertEqual(_.code, 'xx')
+            leave.set()
+            thread.join()
+        self.assertEqual(codes, [_.default, 'fr'])
+
+    def test_default_is_shared(self):
+        # Changing the default language changes it for the threads which
+        # already translated something too.
+        original = '$mlist.display_name mailing list probe message'
+        translated = []
+        translate = threading.Event()
+        done = threading.Event()
+
+        def translate_twice():
+            for i in range(2):
+                translate.wait()
+                translate.clear()
+                translated.append(_(original))
+                done.set()
+        thread = threading.Thread(target=translate_twice)
+        thread.start()
+        default = _.default
+        self.addCleanup(setattr, _, 'default', default)
+        for language in ('en', 'xx'):
+            _.default = language
+            translate.set()
+            done.wait()
+            done.clear()
+        thread.join()
+        self.assertEqual(translated[0], original)
+        self.assertNotEqual(translated[1], original)
@@ -17,13 +17,18 @@
 
 """Test some Runner base class behavior."""
 
+import os
+import signal
 import unittest
+import threading
 
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.core.runner import Runner
+from mailman.core.switchboard import SLICES_FILE
 from mailman.interfaces.member import DeliveryMode
 from mailman.interfaces.runner import RunnerCrashEvent
+from mailman.interfaces.usermanager import IUserManager
 from mailman.runners.virgin import VirginRunner
 from mailman.testing.helpers import (
     LogFileMark, configuration, event_subscribers, get_queue_messages,
@@ -31,6 +36,10 @@ from mailman.testing.helpers import (
     specialized_message_from_string as mfs,
     subscribe)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.filesystem import write_atomically
+from sqlalchemy import or_
+from unittest.mock import patch
+from zope.component import getUtility
 
 
 class CrashingRunner(Runner):
@@ -38,6 +47,42 @@ class CrashingRunner(Runner):
         raise RuntimeError('borked')
 
 
+class ForwardingRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        config.switchboards['virgin'].enqueue(msg, msgdata)
+        return False
+
+
+class RegisteringRunner(Runner):
+    def _dispose(self, mlist, msg, msgdata):
+        getUtility(IUserManager).create_address(msg.sender)
+        if msg.sender.startswith('bart'):
+            raise RuntimeError('borked')
+        return False
+
+
+class LookingUpRunner(Runner):
+    def __init__(self, *args, **kws):
+        super().__init__(*args, **kws)
+        self.members = []
+
+    def _dispose(self, mlist, msg, msgdata):
+        for i in range(3):
+            self.members.append(mlist.members.get_member(msg.sender))
+        return False
+
+
+class RecordingRunner(Runner):
+    def __init__(self, *args, **kws):
+        super().__init__(*args, **kws)
+        self.processed = []
+
+    def _dispose(self, mlist, msg, msgdata):
+        self.processed.append(
+            (mlist.list_id, msgdata['n'], threading.current_thread()))
+        return False
+
+
 class TestRunner(unittest.TestCase):
     """Test the Runner base class behavior."""
 
@@ -118,3 +163,354 @@ Message-ID: <ant>
         # The list's -request address is the original sender.
         self.assertEqual(item.msgdata['original_sender'],
                          'test-request@example.com')
+
+    @configuration('runner.virgin', group_commit_max=10)
+    def test_group_commit(self):
+        # Entries enqueued by a runner into a group committed queue become
+        # visible at the end of the runner's batch, and only then are the
+        # processed entries removed.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for i in range(3):
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        finished = []
+        real_finish = runner.switchboard.finish
+
+        def finish(filebase, preserve=False):
+            # All the forwarded entries are visible by the time the first
+            # entry is finished.
+            finished.append(len(config.switchboards['virgin'].files))
+            real_finish(filebase, preserve)
+        runner.switchboard.finish = finish
+        runner.run()
+        self.assertEqual(finished, [3, 3, 3])
+        get_queue_messages('in', expected_count=0)
+        get_queue_messages('virgin', expected_count=3)
+
+    @configuration('runner.in', batch_size=3)
+    def test_batch(self):
+        # The entries are processed in batches, with one database commit per
+        # batch.
+        runner = make_testable_runner(ForwardingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for i in range(5):
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        with patch.object(config.db, 'commit',
+                          wraps=config.db.commit) as commit:
+            runner.run()
+        self.assertEqual(commit.call_count, 2)
+        get_queue_messages('in', expected_count=0)
+        get_queue_messages('virgin', expected_count=5)
+
+    @configuration('runner.in', batch_size=3)
+    def test_member_cache(self):
+        # The membership lookups are cached while each entry is processed,
+        # but not from one entry to the next, even in a batch.
+        member = subscribe(self._mlist, 'Anne')
+        config.db.commit()
+        runner = make_testable_runner(LookingUpRunner, 'in')
+        msg = mfs("""\
+From: aperson@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for i in range(2):
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        with patch('mailman.model.roster.or_', wraps=or_) as lookup:
+            runner.run()
+        self.assertEqual(lookup.call_count, 2)
+        self.assertEqual(runner.members, [member] * 6)
+
+    @configuration('runner.in', batch_size=3)
+    def test_batch_with_failure(self):
+        # A failing entry is shunted, and only its changes to the database
+        # are rolled back.
+        runner = make_testable_runner(RegisteringRunner, 'in')
+        for sender in ('anne', 'bart', 'cris'):
+            msg = mfs("""\
+From: {}@example.com
+To: test@example.com
+
+""".format(sender))
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        runner.run()
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        self.assertIsNone(user_manager.get_address('bart@example.com'))
+        self.assertIsNotNone(user_manager.get_address('cris@example.com'))
+        get_queue_messages('in', expected_count=0)
+        items = get_queue_messages('shunt', expected_count=1)
+        self.assertEqual(items[0].msg.sender, 'bart@example.com')
+
+    @configuration('runner.in', batch_size=3)
+    def test_batch_commit_failure(self):
+        # When the batch's transaction can't be committed, it is rolled back
+        # and the batch's entries are processed again.
+        config.db.commit()
+        runner = make_testable_runner(RegisteringRunner, 'in')
+        for sender in ('anne', 'cris'):
+            msg = mfs("""\
+From: {}@example.com
+To: test@example.com
+
+""".format(sender))
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        real_commit = config.db.commit
+        failures = [RuntimeError('Database went away')]
+
+        def commit():
+            if len(failures) > 0:
+                raise failures.pop()
+            real_commit()
+        mark = LogFileMark('mailman.error')
+        with patch.object(config.db, 'commit', side_effect=commit):
+            runner.run()
+        self.assertIn('Database went away', mark.read())
+        # Had the first attempt not been rolled back, creating the addresses
+        # again would have failed.
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        self.assertIsNotNone(user_manager.get_address('cris@example.com'))
+        get_queue_messages('in', expected_count=0)
+        get_queue_messages('shunt', expected_count=0)
+
+    def test_single_entry_without_savepoint(self):
+        # An entry processed in a transaction of its own doesn't need a
+        # savepoint; if it fails, the whole transaction is rolled back.
+        runner = make_testable_runner(RegisteringRunner, 'in')
+        for sender in ('anne', 'bart'):
+            msg = mfs("""\
+From: {}@example.com
+To: test@example.com
+
+""".format(sender))
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        with patch('mailman.core.runner.savepoint') as savepoint:
+            runner.run()
+        savepoint.assert_not_called()
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        self.assertIsNone(user_manager.get_address('bart@example.com'))
+        get_queue_messages('in', expected_count=0)
+        items = get_queue_messages('shunt', expected_count=1)
+        self.assertEqual(items[0].msg.sender, 'bart@example.com')
+
+    @configuration('runner.in', workers=3)
+    def test_workers(self):
+        # Entries are processed in worker threads, but the entries for each
+        # mailing list are still processed in order.
+        create_list('ant@example.com')
+        config.db.commit()
+        runner = make_testable_runner(RecordingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for n in range(10):
+            for list_id in ('test.example.com', 'ant.example.com'):
+                config.switchboards['in'].enqueue(msg, listid=list_id, n=n)
+        runner.run()
+        get_queue_messages('in', expected_count=0)
+        self.assertEqual(len(runner.processed), 20)
+        for list_id in ('test.example.com', 'ant.example.com'):
+            self.assertEqual(
+                [n for processed_list_id, n, thread in runner.processed
+                 if processed_list_id == list_id],
+                list(range(10)))
+        for list_id, n, thread in runner.processed:
+            self.assertIsNot(thread, threading.main_thread())
+
+    @configuration('runner.in', workers=2)
+    def test_workers_with_failure(self):
+        # Each worker commits its own changes to the database, and a failing
+        # entry is shunted.
+        config.db.commit()
+        runner = make_testable_runner(RegisteringRunner, 'in')
+        for sender in ('anne', 'bart', 'cris'):
+            msg = mfs("""\
+From: {}@example.com
+To: test@example.com
+
+""".format(sender))
+            config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        runner.run()
+        config.db.abort()
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        self.assertIsNone(user_manager.get_address('bart@example.com'))
+        self.assertIsNotNone(user_manager.get_address('cris@example.com'))
+        get_queue_messages('in', expected_count=0)
+        items = get_queue_messages('shunt', expected_count=1)
+        self.assertEqual(items[0].msg.sender, 'bart@example.com')
+
+    @configuration('runner.in', workers=2)
+    @configuration('runner.virgin', group_commit_max=10)
+    def test_workers_group_commit(self):
+        # What the workers enqueue joins the runner's group commit.
+        class CheckingRunner(ForwardingRunner):
+            def _dispose(self, mlist, msg, msgdata):
+                super()._dispose(mlist, msg, msgdata)
+                visible.append(len(config.switchboards['virgin'].files))
+                return False
+        visible = []
+        create_list('ant@example.com')
+        config.db.commit()
+        runner = make_testable_runner(CheckingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for list_id in ('test.example.com', 'ant.example.com'):
+            config.switchboards['in'].enqueue(msg, listid=list_id)
+        runner.run()
+        self.assertEqual(visible, [0, 0])
+        get_queue_messages('in', expected_count=0)
+        get_queue_messages('virgin', expected_count=2)
+
+    @configuration('runner.in', workers=2)
+    def test_workers_commit_failure(self):
+        # When a worker can't commit an entry's transaction, it is rolled
+        # back and the entry is processed again.
+        config.db.commit()
+        runner = make_testable_runner(RegisteringRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+
+""")
+        config.switchboards['in'].enqueue(msg, listid='test.example.com')
+        real_commit = config.db.commit
+        failures = [RuntimeError('Database went away')]
+
+        def commit():
+            if (threading.current_thread() is not threading.main_thread()
+                    and len(failures) > 0):
+                raise failures.pop()
+            real_commit()
+        mark = LogFileMark('mailman.error')
+        with patch.object(config.db, 'commit', side_effect=commit):
+            runner.run()
+        self.assertEqual(len(failures), 0)
+        self.assertIn('requeuing entry', mark.read())
+        config.db.abort()
+        user_manager = getUtility(IUserManager)
+        self.assertIsNotNone(user_manager.get_address('anne@example.com'))
+        get_queue_messages('in', expected_count=0)
+        get_queue_messages('shunt', expected_count=0)
+
+    def test_entry_taken_by_another_instance(self):
+        # While the master changes the number of instances of a runner, two
+        # instances can both try to take an entry.  The one which loses just
+        # skips it.
+        runner = make_testable_runner(RecordingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        filebase = config.switchboards['in'].enqueue(
+            msg, listid='test.example.com', n=0)
+        files = runner.switchboard.get_batch()
+        config.switchboards['in'].dequeue(filebase)
+        with patch.object(runner.switchboard, 'get_batch',
+                          return_value=files):
+            runner._one_iteration()
+        self.assertEqual(runner.processed, [])
+        self.assertEqual(
+            config.switchboards['in'].get_files('.bak'), [filebase])
+        get_queue_messages('bad', expected_count=0)
+
+    def test_resize(self):
+        # The master tells the runner's instances to split their queue into
+        # a different number of slices, and they do before the next look at
+        # the queue.
+        runner = RecordingRunner('in', 0, 2)
+
+        def do_periodic():
+            runner._stop = (len(runner.switchboard.get_batch()) == 0)
+        runner._do_periodic = do_periodic
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        for n in range(20):
+            config.switchboards['in'].enqueue(
+                msg, listid='test.example.com', n=n)
+        write_atomically(
+            os.path.join(runner.queue_directory, SLICES_FILE), '1')
+        runner.signal_handler(signal.SIGUSR2, None)
+        runner.run()
+        self.assertEqual(len(runner.processed), 20)
+        get_queue_messages('in', expected_count=0)
+
+    def test_resize_before_signals(self):
+        # A resize which the master asked for before the runner installed
+        # its signal handlers isn't lost.
+        runner = RecordingRunner('in', 0, 2)
+        write_atomically(
+            os.path.join(runner.queue_directory, SLICES_FILE), '1')
+        with patch.dict('os.environ', MAILMAN_UNDER_MASTER_CONTROL='1'), \
+                patch('mailman.core.runner.signal.signal'):
+            runner.set_signals()
+        runner._stop = True
+        runner.run()
+        self.assertEqual(runner.switchboard._numslices, 1)
+
+    def test_no_resize_outside_master(self):
+        runner = RecordingRunner('in', 0, 2)
+        write_atomically(
+            os.path.join(runner.queue_directory, SLICES_FILE), '1')
+        with patch('mailman.core.runner.signal.signal'):
+            runner.set_signals()
+        runner._stop = True
+        runner.run()
+        self.assertEqual(runner.switchboard._numslices, 2)
+
+    def test_snooze_waits_for_notification(self):
+        runner = make_testable_runner(CrashingRunner, 'in')
+        with patch.object(runner.switchboard, 'wait') as wait:
+            runner._snooze(0)
+        wait.assert_called_once_with(runner.sleep_float)
+
+    @configuration('runner.in', wakeup='sleep')
+    def test_snooze_sleeps(self):
+        runner = make_testable_runner(CrashingRunner, 'in')
+        with patch('mailman.core.runner.time.sleep') as sleep:
+            runner._snooze(0)
+        sleep.assert_called_once_with(runner.sleep_float)
+
+    @configuration('runner.in', sleep_time='1h')
+    def test_snooze_until_due(self):
+        # The runner doesn't sleep past the time a delayed entry is due.
+        runner = make_testable_runner(CrashingRunner, 'in')
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        runner.switchboard.enqueue(msg, _delay=60)
+        with patch.object(runner.switchboard, 'wait') as wait:
+            runner._snooze(0)
+        timeout = wait.call_args[0][0]
+        self.assertGreater(timeout, 0)
+        self.assertLessEqual(timeout, 60)
+        get_queue_messages('in', expected_count=1)
@@ -18,13 +18,24 @@
 """Switchboard tests."""
 
 import os
+import time
+import pickle
+import hashlib
 import unittest
 
+from email.header import Header
+from email.mime.message import MIMEMessage
 from mailman.config import config
+from mailman.core.switchboard import (
+    RecipientFile, Switchboard, _QueueIndex, _fsync_path, group_commit,
+    slice_of)
+from mailman.email.message import (
+    LazyMessage, MultipartDigestMessage, UserNotification)
 from mailman.testing.helpers import (
-    LogFileMark,
+    LogFileMark, configuration,
     specialized_message_from_string as mfs)
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.filesystem import _PollingWatcher
 from unittest.mock import patch
 
 
@@ -71,3 +82,658 @@ Message-ID: <ant>
         bad_dir = config.switchboards['bad'].queue_directory
         psvfile = os.path.join(bad_dir, filebase + '.psv')
         self.assertTrue(os.path.isfile(psvfile))
+
+
+class TestQueueFile(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+A message.
+""")
+        self._switchboard = config.switchboards['shunt']
+
+    def _path(self, filebase, extension='.pck'):
+        return os.path.join(
+            self._switchboard.queue_directory, filebase + extension)
+
+    def test_raw_bytes(self):
+        filebase = self._switchboard.enqueue(self._msg, foo=7)
+        with open(self._path(filebase), 'rb') as fp:
+            data = pickle.load(fp)
+            attributes = pickle.load(fp)
+            raw = fp.read()
+        self.assertEqual(data, dict(_parsemsg=False, foo=7, version=4))
+        self.assertEqual(attributes['original_size'], len(str(self._msg)))
+        # The headers of a message which wasn't read from bytes are kept with
+        # its attributes, and only the body is written as bytes.
+        self.assertEqual(attributes['_headers'], self._msg._headers)
+        self.assertNotIn('__class__', attributes)
+        self.assertEqual(raw, b'A message.\n')
+
+    def test_original_bytes(self):
+        # The headers of a message read from bytes are written as those bytes
+        # while they're unchanged, and aren't stored a second time with the
+        # attributes.  A long header isn't refolded.
+        original = (b'From: anne@example.com\n'
+                    b'X-Long: ' + b'word ' * 30 + b'\n'
+                    b'Message-ID: <ant>\n\nA message.\n')
+        msg = LazyMessage(original)
+        self.assertEqual(msg['message-id'], '<ant>')
+        filebase = self._switchboard.enqueue(msg)
+        with open(self._path(filebase), 'rb') as fp:
+            pickle.load(fp)
+            attributes = pickle.load(fp)
+            raw = fp.read()
+        self.assertEqual(attributes, {})
+        self.assertEqual(raw, original)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.as_bytes(), original)
+
+    def test_long_header_is_kept(self):
+        # The long header of an attached message, which is written as bytes,
+        # isn't folded.
+        value = ' '.join(['word'] * 30)
+        self._msg['X-Long'] = value
+        digest = MultipartDigestMessage()
+        digest.attach(MIMEMessage(self._msg))
+        filebase = self._switchboard.enqueue(digest)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg.get_payload(0).get_payload(0)['x-long'], value)
+        self.assertIs(type(msg), MultipartDigestMessage)
+
+    def test_message_class_is_kept(self):
+        msg = UserNotification(
+            'anne@example.com', 'test@example.com', 'Hello', 'A message.')
+        filebase = self._switchboard.enqueue(msg)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, UserNotification)
+        self.assertIsInstance(msg, LazyMessage)
+        self.assertEqual(msg['subject'], 'Hello')
+        # Parsing the body turns it into the class it stands for.
+        self.assertEqual(msg.get_payload(), 'A message.')
+        self.assertIs(type(msg), UserNotification)
+
+    def test_dequeue_is_lazy(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg, LazyMessage)
+        self.assertEqual(msg.original_size, self._msg.original_size)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(msg.get_payload(), 'A message.\n')
+
+    def test_body_is_copied(self):
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, data = self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase)
+        # Only the headers were changed, so the body isn't parsed again.
+        msg['X-Added'] = 'Yes'
+        filebase = self._switchboard.enqueue(msg)
+        self.assertNotIn('_payload', vars(msg))
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['x-added'], 'Yes')
+        self.assertEqual(msg.get_payload(), 'A message.\n')
+
+    def test_headers_are_kept(self):
+        self._msg['Subject'] = Header('Caf\xe9', 'utf-8')
+        filebase = self._switchboard.enqueue(self._msg)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertIsInstance(msg['subject'], Header)
+        self.assertEqual(str(msg['subject']), 'Caf\xe9')
+
+    def test_legacy_entry(self):
+        # Entries written with schema version 3 can still be dequeued, and
+        # are upgraded when they are recovered.
+        filebase = '1234567890.0+' + '0' * 40
+        with open(self._path(filebase), 'wb') as fp:
+            pickle.dump(self._msg, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(dict(_parsemsg=False, version=3), fp)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+        self.assertEqual(data, dict(_parsemsg=False, version=3))
+        self._switchboard.recover_backup_files()
+        with open(self._path(filebase), 'rb') as fp:
+            data = pickle.load(fp)
+            pickle.load(fp)
+            raw = fp.read()
+        self.assertEqual(data['_bak_count'], 1)
+        self.assertEqual(raw, b'A message.\n')
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(msg['message-id'], '<ant>')
+
+    def test_plaintext(self):
+        filebase = self._switchboard.enqueue(self._msg, _plaintext=True)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertNotIsInstance(msg, LazyMessage)
+        self.assertTrue(data['_parsemsg'])
+        self.assertEqual(msg.original_size, len(str(self._msg)))
+        self.assertEqual(msg['message-id'], '<ant>')
+
+
+@patch('mailman.core.switchboard.MAX_INLINE_RECIPIENTS', 3)
+class TestRecipientFile(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+A message.
+""")
+        self._recipients = {
+            'cris@example.com', 'anne@example.com', 'bart@example.com'}
+        self._switchboard = config.switchboards['shunt']
+
+    def _path(self, filebase, extension):
+        return os.path.join(
+            self._switchboard.queue_directory, filebase + extension)
+
+    def test_few_recipients_are_inline(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients={'anne@example.com'})
+        self.assertFalse(os.path.exists(self._path(filebase, '.rcp')))
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(data['recipients'], {'anne@example.com'})
+
+    def test_recipients_file(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        with open(self._path(filebase, '.pck'), 'rb') as fp:
+            data = pickle.load(fp)
+        self.assertNotIn('recipients', data)
+        self.assertEqual(data['_recipients'], 3)
+        with open(self._path(filebase, '.rcp'), 'rb') as fp:
+            self.assertEqual(fp.read(), b"""\
+anne@example.com
+bart@example.com
+cris@example.com
+""")
+        msg, data = self._switchboard.dequeue(filebase)
+        recipients = data['recipients']
+        self.assertIsInstance(recipients, RecipientFile)
+        self.assertNotIn('_recipients', data)
+        self.assertEqual(len(recipients), 3)
+        self.assertEqual(list(recipients), sorted(self._recipients))
+        self.assertEqual(recipients, self._recipients)
+        self.assertIn('bart@example.com', recipients)
+        self.assertNotIn('dave@example.com', recipients)
+        self._switchboard.finish(filebase)
+        self.assertFalse(os.path.exists(self._path(filebase, '.rcp')))
+
+    def test_duplicate_recipients(self):
+        recipients = sorted(self._recipients) * 2
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(len(data['recipients']), 3)
+        self.assertEqual(list(data['recipients']), sorted(self._recipients))
+
+    def test_set_operations(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        recipients = data['recipients']
+        difference = recipients - {'anne@example.com'}
+        self.assertIsInstance(difference, set)
+        self.assertEqual(difference, {'bart@example.com', 'cris@example.com'})
+        union = recipients | {'dave@example.com'}
+        self.assertIsInstance(union, set)
+        self.assertEqual(len(union), 4)
+        self.assertEqual(recipients & {'anne@example.com', 'dave@example.com'},
+                         {'anne@example.com'})
+
+    def test_file_not_kept_open(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        with patch('mailman.core.switchboard.open', create=True,
+                   side_effect=open) as opener:
+            msg, data = self._switchboard.dequeue(filebase)
+            self.assertEqual(opener.call_count, 1)
+            list(data['recipients'])
+            list(data['recipients'])
+        self.assertEqual(opener.call_count, 3)
+
+    @patch('mailman.core.switchboard.RECIPIENTS_CHUNK', 7)
+    def test_chunked_reads(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(list(data['recipients']), sorted(self._recipients))
+
+    def test_recipients_are_linked(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        virgin = config.switchboards['virgin']
+        new_filebase = virgin.enqueue(msg, data)
+        self._switchboard.finish(filebase)
+        path = os.path.join(virgin.queue_directory, new_filebase + '.rcp')
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        msg, data = virgin.dequeue(new_filebase)
+        self.assertEqual(data['recipients'], self._recipients)
+        # When the recipients can't be linked, e.g. across file systems,
+        # they're written again.
+        with patch('mailman.core.switchboard.os.link', side_effect=OSError):
+            filebase = self._switchboard.enqueue(msg, data)
+        path = self._path(filebase, '.rcp')
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(data['recipients'], self._recipients)
+
+    def test_finished_before_enqueued(self):
+        # Once their queue entry is finished, the recipients can't be linked,
+        # and only copied if they were loaded.
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase)
+        virgin = config.switchboards['virgin']
+        with self.assertRaisesRegex(FileNotFoundError, 'is finished'):
+            virgin.enqueue(msg, data)
+        self.assertEqual(os.listdir(virgin.queue_directory), [])
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertIn('anne@example.com', data['recipients'])
+        self._switchboard.finish(filebase)
+        new_filebase = virgin.enqueue(msg, data)
+        msg, data = virgin.dequeue(new_filebase)
+        self.assertEqual(list(data['recipients']), sorted(self._recipients))
+
+    def test_linked_while_queued(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        new_filebase = config.switchboards['virgin'].enqueue(msg, data)
+        path = os.path.join(config.switchboards['virgin'].queue_directory,
+                            new_filebase + '.rcp')
+        self.assertTrue(os.path.samefile(path, self._path(filebase, '.rcp')))
+
+    def test_changed_recipients(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        data['recipients'] = set(data['recipients']) - {'anne@example.com'}
+        filebase = self._switchboard.enqueue(msg, data)
+        msg, data = self._switchboard.dequeue(filebase)
+        self.assertEqual(data['recipients'],
+                         {'bart@example.com', 'cris@example.com'})
+
+    def test_preserved_with_entry(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        self._switchboard.dequeue(filebase)
+        self._switchboard.finish(filebase, preserve=True)
+        bad_dir = config.switchboards['bad'].queue_directory
+        self.assertTrue(
+            os.path.exists(os.path.join(bad_dir, filebase + '.rcp')))
+        self.assertFalse(os.path.exists(self._path(filebase, '.rcp')))
+
+    def test_pickled_as_set(self):
+        filebase = self._switchboard.enqueue(
+            self._msg, recipients=self._recipients)
+        msg, data = self._switchboard.dequeue(filebase)
+        recipients = pickle.loads(pickle.dumps(data['recipients']))
+        self.assertEqual(recipients, self._recipients)
+        self.assertIsInstance(recipients, set)
+
+
+class TestWait(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        # Use a fresh switchboard, since the global one may already be
+        # watching its queue directory.
+        self._switchboard = Switchboard(
+            'shunt', config.switchboards['shunt'].queue_directory)
+
+    def test_first_wait_returns_immediately(self):
+        # Entries enqueued before the watch started are not noticed, so the
+        # first wait always tells the caller to look at the queue.
+        self.assertTrue(self._switchboard.wait(60))
+        self.assertFalse(self._switchboard.wait(0))
+
+    def test_wake_up_on_enqueue(self):
+        self._switchboard.wait(0)
+        self._switchboard.enqueue(self._msg)
+        self.assertTrue(self._switchboard.wait(60))
+        self.assertFalse(self._switchboard.wait(0))
+
+    def test_only_our_slice(self):
+        slices = [
+            Switchboard('shunt', self._switchboard.queue_directory, i, 2)
+            for i in range(2)
+            ]
+        for switchboard in slices:
+            switchboard.wait(0)
+            if isinstance(switchboard._watcher, _PollingWatcher):
+                self.skipTest('inotify is not available')
+        filebase = self._switchboard.enqueue(self._msg)
+        woken = [switchboard.wait(0.1) for switchboard in slices]
+        self.assertEqual(woken.count(True), 1)
+        self.assertEqual(slices[woken.index(True)].files, [filebase])
+
+
+class TestQueueIndex(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._switchboard = Switchboard(
+            'shunt', config.switchboards['shunt'].queue_directory)
+
+    def test_index_follows_queue(self):
+        self.assertEqual(self._switchboard.files, [])
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(3)]
+        self.assertEqual(self._switchboard.files, filebases)
+        self._switchboard.dequeue(filebases[1])
+        self.assertEqual(self._switchboard.files,
+                         [filebases[0], filebases[2]])
+        self.assertEqual(self._switchboard.files,
+                         self._switchboard.get_files())
+
+    def test_files_kept_until_changed(self):
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(3)]
+        files = self._switchboard.files
+        self.assertEqual(files, filebases)
+        # The same list is returned again until an entry is added or taken.
+        self.assertIs(self._switchboard.files, files)
+        self._switchboard.dequeue(filebases[0])
+        self.assertEqual(self._switchboard.files, filebases[1:])
+        self.assertEqual(files, filebases)
+
+    def test_get_batch(self):
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(5)]
+        self.assertEqual(self._switchboard.get_batch(2), filebases[:2])
+        self.assertEqual(self._switchboard.get_batch(10), filebases)
+        self.assertEqual(self._switchboard.get_batch(), filebases)
+
+    def test_dequeued_elsewhere(self):
+        # Entries taken by another switchboard disappear from the index.
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(2)]
+        self.assertEqual(self._switchboard.files, filebases)
+        other = Switchboard('shunt', self._switchboard.queue_directory)
+        other.dequeue(filebases[0])
+        self.assertEqual(self._switchboard.files, filebases[1:])
+
+    def test_recovered_entry(self):
+        # An entry which is dequeued and then recovered is listed once.
+        filebase = self._switchboard.enqueue(self._msg)
+        self.assertEqual(self._switchboard.files, [filebase])
+        self._switchboard.dequeue(filebase)
+        self.assertEqual(self._switchboard.files, [])
+        self._switchboard.recover_backup_files()
+        self.assertEqual(self._switchboard.files, [filebase])
+
+    def _polling_switchboard(self):
+        with patch('mailman.utilities.filesystem._inotify', None), \
+                patch('mailman.utilities.filesystem.ctypes.CDLL',
+                      side_effect=OSError):
+            switchboard = Switchboard(
+                'shunt', self._switchboard.queue_directory,
+                rescan_interval=10)
+            self.assertEqual(switchboard.files, [])
+        self.assertIsInstance(switchboard._watcher, _PollingWatcher)
+        return switchboard
+
+    def test_polling_own_changes(self):
+        # Without inotify, dequeuing and finishing entries doesn't make the
+        # queue directory be scanned again.
+        switchboard = self._polling_switchboard()
+        filebases = [self._switchboard.enqueue(self._msg, foo=i)
+                     for i in range(2)]
+        self.assertEqual(switchboard.files, filebases)
+        with patch('mailman.core.switchboard.os.listdir',
+                   wraps=os.listdir) as listdir:
+            switchboard.dequeue(filebases[0])
+            switchboard.finish(filebases[0])
+            self.assertEqual(switchboard.files, filebases[1:])
+        self.assertEqual(listdir.call_count, 0)
+
+    def test_polling_same_tick(self):
+        # An entry added within the same tick of the file system's clock as
+        # the last scan doesn't change the directory's modification time.
+        # It's found once the rescan interval has passed.
+        switchboard = self._polling_switchboard()
+        directory = switchboard.queue_directory
+        mtime = os.stat(directory).st_mtime_ns
+        filebase = self._switchboard.enqueue(self._msg)
+        os.utime(directory, ns=(mtime, mtime))
+        self.assertEqual(switchboard.files, [])
+        with patch('mailman.utilities.filesystem.time.time',
+                   return_value=time.time() + 10):
+            self.assertEqual(switchboard.files, [filebase])
+
+    def test_fifo_order(self):
+        index = _QueueIndex([('c', 3.0), ('a', 1.0)])
+        index.add('b', 2.0)
+        index.add('d', 3.0)
+        self.assertEqual(index.first(), ['a', 'b', 'c', 'd'])
+        index.discard('b')
+        index.discard('c')
+        index.add('b', 2.0)
+        self.assertEqual(index.first(), ['a', 'b', 'd'])
+        self.assertEqual(index.first(2), ['a', 'b'])
+        self.assertEqual(len(index), 3)
+
+    def test_due_entries(self):
+        index = _QueueIndex([('a', 1.0), ('b', 2.0), ('c', 3.0)])
+        self.assertEqual(index.first(until=2.0), ['a', 'b'])
+        self.assertEqual(index.first(1, until=2.0), ['a'])
+        self.assertEqual(index.next_due(2.0), 3.0)
+        self.assertEqual(index.next_due(0.5), 1.0)
+        self.assertIsNone(index.next_due(3.0))
+        index.discard('c')
+        self.assertIsNone(index.next_due(2.0))
+
+    def test_delayed_entries(self):
+        # Delayed entries are listed, but not handed out in batches until
+        # they're due.
+        now = self._switchboard.enqueue(self._msg)
+        later = self._switchboard.enqueue(self._msg, _delay=60)
+        self.assertEqual(self._switchboard.files, [now, later])
+        self.assertEqual(self._switchboard.get_files(), [now, later])
+        self.assertEqual(self._switchboard.get_batch(), [now])
+        when = float(later.split('+')[0])
+        self.assertAlmostEqual(self._switchboard.next_due(), when)
+        with patch('mailman.core.switchboard.time.time',
+                   return_value=when):
+            self.assertEqual(self._switchboard.get_batch(), [now, later])
+            self.assertIsNone(self._switchboard.next_due())
+        # The delay isn't saved in the metadata.
+        msg, msgdata = self._switchboard.dequeue(later)
+        self.assertNotIn('_delay', msgdata)
+
+
+class TestSlices(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._digests = [hashlib.sha1(str(i).encode('ascii')).hexdigest()
+                         for i in range(1000)]
+
+    def test_slices_are_balanced(self):
+        slices = [slice_of(digest, 3) for digest in self._digests]
+        for slice_number in range(3):
+            self.assertGreater(slices.count(slice_number), 250)
+
+    def test_entries_only_move_to_new_slice(self):
+        for numslices in range(1, 8):
+            for digest in self._digests:
+                before = slice_of(digest, numslices)
+                after = slice_of(digest, numslices + 1)
+                self.assertIn(after, (before, numslices))
+
+    def test_switchboards_split_queue(self):
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        queue_directory = config.switchboards['shunt'].queue_directory
+        switchboard = Switchboard('shunt', queue_directory)
+        filebases = [switchboard.enqueue(msg, foo=i) for i in range(20)]
+        # Any number of slices will do, not just powers of 2.
+        slices = [Switchboard('shunt', queue_directory, i, 3)
+                  for i in range(3)]
+        files = [sorted(switchboard.files) for switchboard in slices]
+        self.assertEqual(sorted(sum(files, [])), sorted(filebases))
+        for i, switchboard in enumerate(slices):
+            for filebase in files[i]:
+                digest = filebase.split('+', 1)[1]
+                self.assertEqual(slice_of(digest, 3), i)
+
+    def test_resize(self):
+        msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        queue_directory = config.switchboards['shunt'].queue_directory
+        switchboard = Switchboard('shunt', queue_directory)
+        filebases = [switchboard.enqueue(msg, foo=i) for i in range(20)]
+        slices = [Switchboard('shunt', queue_directory, i, 2)
+                  for i in range(2)]
+        files = [set(switchboard.files) for switchboard in slices]
+        # An entry of the second slice is being processed.
+        processing = sorted(files[1])[0]
+        slices[1].dequeue(processing)
+        # With one more slice, the first slice only loses entries.
+        slices[0].resize(3)
+        self.assertEqual(set(slices[0].files), {
+            filebase for filebase in files[0]
+            if slice_of(filebase.split('+', 1)[1], 3) == 0
+            })
+        # When the second slice is removed, the first one takes over its
+        # entries, including the one which was being processed.
+        slices[0].resize(1)
+        self.assertEqual(sorted(slices[0].files), sorted(filebases))
+        self.assertEqual(slices[0].get_files('.bak'), [])
+
+
+class TestGroupCommit(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._msg = mfs("""\
+From: anne@example.com
+To: test@example.com
+Message-ID: <ant>
+
+""")
+
+    @configuration('runner.shunt', group_commit_max=10)
+    def test_entry_invisible_until_committed(self):
+        switchboard = config.switchboards['shunt']
+        with group_commit():
+            filebase = switchboard.enqueue(self._msg)
+            self.assertEqual(switchboard.files, [])
+        self.assertEqual(switchboard.files, [filebase])
+
+    @configuration('runner.shunt', group_commit_max=10)
+    def test_no_group_commit_outside_block(self):
+        switchboard = config.switchboards['shunt']
+        filebase = switchboard.enqueue(self._msg)
+        self.assertEqual(switchboard.files, [filebase])
+
+    def test_group_commit_disabled(self):
+        # By default, queues are not group committed.
+        switchboard = config.switchboards['shunt']
+        with group_commit():
+            filebase = switchboard.enqueue(self._msg)
+            self.assertEqual(switchboard.files, [filebase])
+
+    @configuration('runner.shunt', group_commit_max=2)
+    def test_commit_when_full(self):
+        switchboard = config.switchboards['shunt']
+        with group_commit():
+            switchboard.enqueue(self._msg)
+            self.assertEqual(len(switchboard.files), 0)
+            switchboard.enqueue(self._msg)
+            self.assertEqual(len(switchboard.files), 2)
+
+    @configuration('runner.shunt', group_commit_max=10,
+                   group_commit_window='0s')
+    def test_commit_when_due(self):
+        switchboard = config.switchboards['shunt']
+        with group_commit() as committer:
+            switchboard.enqueue(self._msg)
+            self.assertEqual(len(switchboard.files), 0)
+            committer.commit_if_due()
+            self.assertEqual(len(switchboard.files), 1)
+
+    @configuration('runner.shunt', group_commit_max=10)
+    def test_deferred_until_committed(self):
+        switchboard = config.switchboards['shunt']
+        calls = []
+        with group_commit() as committer:
+            # Nothing is pending, so this runs right away.
+            committer.defer(calls.append, 1)
+            self.assertEqual(calls, [1])
+            switchboard.enqueue(self._msg)
+            committer.defer(calls.append, 2)
+            self.assertEqual(calls, [1])
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(len(switchboard.files), 1)
+
+    @configuration('runner.shunt', group_commit_max=10)
+    @patch('mailman.core.switchboard.MAX_INLINE_RECIPIENTS', 3)
+    def test_commit_syncs_entry_files(self):
+        # Only the files of the committed entries and their directory are
+        # synced, not the whole file system.
+        switchboard = config.switchboards['shunt']
+        recipients = ['anne@example.com', 'bart@example.com',
+                      'cris@example.com']
+        with patch('mailman.core.switchboard._fsync_path',
+                   wraps=_fsync_path) as fsync_path, \
+                patch('mailman.core.switchboard.os.sync') as sync:
+            with group_commit():
+                filebase = switchboard.enqueue(
+                    self._msg, recipients=recipients)
+                self.assertEqual(fsync_path.call_count, 0)
+        base = os.path.join(switchboard.queue_directory, filebase)
+        self.assertEqual(
+            [call[0][0] for call in fsync_path.call_args_list],
+            [base + '.pck.tmp', base + '.rcp', switchboard.queue_directory,
+             switchboard.queue_directory])
+        self.assertFalse(sync.called)
+        self.assertEqual(switchboard.files, [filebase])
+
+    @configuration('runner.shunt', group_commit_max=10)
+    def test_failed_commit_keeps_deferred(self):
+        # If an entry can't be committed, the work deferred on it is dropped,
+        # so that e.g. the source queue entry is not removed.
+        switchboard = config.switchboards['shunt']
+        calls = []
+        error_log = LogFileMark('mailman.error')
+        with group_commit() as committer:
+            switchboard.enqueue(self._msg)
+            committer.defer(calls.append, 1)
+            with patch('mailman.core.switchboard.os.rename',
+                       side_effect=OSError('Oops!')):
+                committer.commit()
+        self.assertEqual(calls, [])
+        self.assertIn('Group commit failed', error_log.read())
@@ -0,0 +1,24 @@
+"""Preferred address index
+
+Revision ID: e5c1a0f7b9d4
+Revises: b2e694dfde35
+Create Date: 2018-06-18 10:42:17.524913
+
+"""
+
+from alembic import op
+
+
+# Revision identifiers, used by Alembic.
+revision = 'e5c1a0f7b9d4'
+down_revision = 'b2e694dfde35'
+
+
+def upgrade():
+    op.create_index(
+        op.f('ix_user__preferred_address_id'), 'user',
+        ['_preferred_address_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user__preferred_address_id'), table_name='user')
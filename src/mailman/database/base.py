@@ -24,7 +24,7 @@ from mailman.interfaces.database import IDatabase
 from mailman.utilities.string import expand
 from public import public
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.interface import implementer
 
 
@@ -82,6 +82,14 @@ class SABaseDatabase:
         """
         pass
 
+    def _configure(self, engine):
+        """Configure the engine once it is created.
+
+        Some database backends need their connections set up for the way
+        Mailman uses them.
+        """
+        pass
+
     def initialize(self, debug=None):
         """See `IDatabase`."""
         # Calculate the engine url.
@@ -105,6 +113,8 @@ class SABaseDatabase:
         self.url = url
         self.engine = create_engine(
             url, isolation_level='READ UNCOMMITTED', pool_pre_ping=True)
-        session = sessionmaker(bind=self.engine)
-        self.store = session()
+        self._configure(self.engine)
+        # Every thread gets its own session, so that runners can process
+        # messages in worker threads.
+        self.store = scoped_session(sessionmaker(bind=self.engine))
         self.store.commit()
@@ -21,6 +21,7 @@ import os
 
 from mailman.database.base import SABaseDatabase
 from public import public
+from sqlalchemy.event import listens_for
 from urllib.parse import urlparse
 
 
@@ -42,3 +43,15 @@ class SQLiteDatabase(SABaseDatabase):
         # Ignore errors
         if fd > 0:
             os.close(fd)
+
+    def _configure(self, engine):
+        """See `SABaseDatabase`."""
+        # pysqlite only begins a transaction before a statement which changes
+        # the database.  A savepoint outside of a transaction begins one of
+        # its own, which releasing the savepoint commits, so begin the
+        # transaction first.
+        @listens_for(engine, 'savepoint')
+        def begin(connection, name):
+            dbapi_connection = connection.connection
+            if not dbapi_connection.in_transaction:
+                dbapi_connection.execute('BEGIN')
@@ -35,6 +35,29 @@ def transaction():
         config.db.commit()
 
 
+@public
+@contextmanager
+def savepoint():
+    """Context manager for a savepoint in the current transaction.
+
+    When the block exits uncleanly, only the changes made inside it are rolled
+    back, and the exception is re-raised.  The rest of the transaction is left
+    alone.  If the block commits the transaction itself, the savepoint ends
+    there, and earlier changes made inside it can no longer be rolled back
+    separately.
+    """
+    nested = config.db.store.begin_nested()
+    try:
+        yield
+    except:                                              # noqa: E722
+        if nested.is_active:
+            nested.rollback()
+        raise
+    else:
+        if nested.is_active:
+            nested.commit()
+
+
 @public
 def transactional(function):
     """Decorator for transactional support.
@@ -23,8 +23,11 @@ safe pickle deserialization, even if the email package adds additional Message
 attributes.
 """
 
+import re
 import email
 import email.message
+import email.parser
+import email.policy
 import email.utils
 
 from email.header import Header
@@ -37,6 +40,14 @@ from zope.component import getUtility
 
 COMMASPACE = ', '
 
+# The instance attributes of a message which are set up by parsing its
+# headers and its body respectively.
+HEADER_ATTRIBUTES = frozenset((
+    '_headers', '_unixfrom', '_charset', '_default_type', 'defects'))
+BODY_ATTRIBUTES = frozenset(('_payload', 'preamble', 'epilogue'))
+# The blank line separating the headers from the body.
+HEADER_END = re.compile(rb'^\r?\n|\r?\n\r?\n')
+
 
 @public
 class Message(email.message.Message):
@@ -123,6 +134,141 @@ class Message(email.message.Message):
         return clean_senders
 
 
+@public
+class LazyMessage(Message):
+    """A message which is parsed from its bytes only as far as needed.
+
+    The headers are parsed the first time they are used, and the body only
+    when it is touched, at which point the message becomes an instance of the
+    class it stands for.  Until then, `as_bytes()` reuses the original bytes
+    of the body, and those of the headers too while they are unchanged.
+
+    Use `for_class()` to get the lazy class standing for a subclass of
+    `Message`.
+    """
+
+    # The class of the message this one stands for.
+    _message_class = Message
+
+    def __init__(self, raw, headers_included=True):
+        """Create a lazily parsed message.
+
+        :param raw: The message's bytes.
+        :type raw: bytes
+        :param headers_included: Whether the bytes start with the headers.
+            If not, they are only the body, and the header attributes must be
+            set before the message is used.
+        :type headers_included: bool
+        """
+        # Don't chain up, since the base class would set the very attributes
+        # whose absence tells us what still has to be parsed.
+        self._raw = raw
+        self.policy = email.policy.compat32
+        if headers_included:
+            match = HEADER_END.search(raw)
+            self._body_start = len(raw) if match is None else match.end()
+        else:
+            self._body_start = 0
+
+    @classmethod
+    def for_class(cls, message_class):
+        """Return the lazy class standing for a message class.
+
+        :param message_class: A subclass of `Message`.
+        :type message_class: class
+        :return: A subclass of both `LazyMessage` and `message_class`.
+        :rtype: class
+        """
+        if message_class is Message:
+            return LazyMessage
+        lazy_class = _LAZY_CLASSES.get(message_class)
+        if lazy_class is None:
+            lazy_class = type(message_class.__name__, (cls, message_class),
+                              dict(_message_class=message_class))
+            _LAZY_CLASSES[message_class] = lazy_class
+        return lazy_class
+
+    def __getattr__(self, name):
+        # This is only called for missing attributes.
+        if '_raw' not in self.__dict__ or name.startswith('__'):
+            raise AttributeError(name)
+        if name in HEADER_ATTRIBUTES:
+            parsed = email.parser.BytesHeaderParser(_class=Message).parsebytes(
+                self._raw[:self._body_start])
+            self._update(parsed, HEADER_ATTRIBUTES)
+            # Remember the headers, to tell whether they changed.
+            self._parsed_headers = list(self._headers)
+        elif name in BODY_ATTRIBUTES:
+            self._parse_body()
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def _update(self, parsed, names):
+        # Attributes which were set before they were parsed win.
+        for name in names:
+            self.__dict__.setdefault(name, parsed.__dict__[name])
+
+    def _parse_body(self):
+        """Parse the body, and turn into the message this one stands for."""
+        if self.raw_headers() is None:
+            source = self._folded_headers() + self._raw[self._body_start:]
+        else:
+            source = self._raw
+        parsed = email.parser.BytesParser(_class=Message).parsebytes(source)
+        self._update(parsed, HEADER_ATTRIBUTES | BODY_ATTRIBUTES)
+        del self._raw, self._body_start
+        self.__dict__.pop('_parsed_headers', None)
+        self.__class__ = self._message_class
+
+    def _folded_headers(self):
+        headers = [self.policy.fold_binary(name, value)
+                   for name, value in self._headers]
+        headers.append(self.policy.linesep.encode('ascii'))
+        return b''.join(headers)
+
+    def raw_headers(self):
+        """Return the original bytes of the headers.
+
+        :return: The bytes, including the blank line ending them, or None if
+            the headers were changed or didn't come from the bytes.
+        :rtype: bytes or None
+        """
+        if self._body_start == 0:
+            return None
+        if ('_headers' in self.__dict__ and
+                self._headers != self.__dict__.get('_parsed_headers')):
+            return None
+        return self._raw[:self._body_start]
+
+    def raw_body(self):
+        """Return the original bytes of the body.
+
+        :return: The bytes, or None if the body was parsed.
+        :rtype: bytes-like object or None
+        """
+        if not BODY_ATTRIBUTES.isdisjoint(self.__dict__):
+            return None
+        return memoryview(self._raw)[self._body_start:]
+
+    def as_bytes(self, unixfrom=False, policy=None):
+        body = self.raw_body()
+        if unixfrom or policy is not None or body is None:
+            return super().as_bytes(unixfrom, policy)
+        if self.raw_headers() is None:
+            return self._folded_headers() + body
+        return self._raw
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are of the completely parsed message.
+        self._parse_body()
+        return self.__reduce_ex__(protocol)
+
+
+# The lazy classes standing for subclasses of Message.
+_LAZY_CLASSES = {}
+
+
 @public
 class MultipartDigestMessage(MIMEMultipart, Message):
     """Mix-in class for MIME digest messages."""
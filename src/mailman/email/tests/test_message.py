@@ -23,7 +23,7 @@ from email import message_from_binary_file
 from email.header import Header
 from email.parser import FeedParser
 from mailman.app.lifecycle import create_list
-from mailman.email.message import Message, UserNotification
+from mailman.email.message import LazyMessage, Message, UserNotification
 from mailman.testing.helpers import get_queue_messages
 from mailman.testing.layers import ConfigLayer
 from pkg_resources import resource_filename
@@ -125,3 +125,57 @@ Test content
             fp.seek(0)
             text = fp.read().decode('ascii', 'replace')
         self.assertEqual(msg.as_string(), text)
+
+
+class TestLazyMessage(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._raw = b"""\
+From: anne@example.com
+Subject: Parts
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+Preamble
+--BOUNDARY
+
+The first part.
+--BOUNDARY--
+"""
+
+    def test_unparsed(self):
+        msg = LazyMessage(self._raw)
+        self.assertIs(msg.as_bytes(), self._raw)
+        self.assertNotIn('_headers', vars(msg))
+        self.assertFalse(hasattr(msg, 'original_size'))
+
+    def test_headers_only(self):
+        msg = LazyMessage(self._raw)
+        self.assertEqual(msg['subject'], 'Parts')
+        self.assertEqual(msg.get_content_type(), 'multipart/mixed')
+        self.assertNotIn('_payload', vars(msg))
+        # Changed headers are written with the original body.
+        msg.replace_header('Subject', 'Changed')
+        self.assertEqual(
+            msg.as_bytes(),
+            self._raw.replace(b'Subject: Parts', b'Subject: Changed'))
+        self.assertNotIn('_payload', vars(msg))
+
+    def test_body(self):
+        msg = LazyMessage(self._raw)
+        msg['X-Added'] = 'Yes'
+        self.assertTrue(msg.is_multipart())
+        self.assertEqual(msg.preamble, 'Preamble')
+        self.assertEqual(msg.get_payload(0).get_payload(),
+                         'The first part.')
+        # The header added before the body was parsed is kept.
+        self.assertEqual(msg['x-added'], 'Yes')
+        self.assertIn(b'X-Added: Yes', msg.as_bytes())
+        self.assertNotIn('_raw', vars(msg))
+        self.assertIs(type(msg), Message)
+
+    def test_set_before_parsing(self):
+        msg = LazyMessage(self._raw)
+        msg.set_unixfrom('From anne@example.com')
+        self.assertEqual(msg['from'], 'anne@example.com')
+        self.assertEqual(msg.get_unixfrom(), 'From anne@example.com')
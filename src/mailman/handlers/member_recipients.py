@@ -23,10 +23,10 @@ on the `recipients' attribute of the message.  This attribute is used by the
 SendmailDeliver and BulkDeliver modules.
 """
 
+from mailman.app.recipients import get_recipients
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.interfaces.handler import IHandler
-from mailman.interfaces.member import DeliveryStatus
 from mailman.interfaces.pipeline import RejectMessage
 from mailman.utilities.string import wrap
 from public import public
@@ -79,10 +79,9 @@ Your urgent message to the $mlist.display_name mailing list was not authorized
 for delivery.  The original message as received by Mailman is attached.
 """)
                 raise RejectMessage(wrap(text))
-        # Calculate the regular recipients of the message
-        recipients = set(member.address.email
-                         for member in mlist.regular_members.members
-                         if member.delivery_status == DeliveryStatus.enabled)
+        # Calculate the regular recipients of the message.  Only the members
+        # whose delivery is enabled get it.
+        recipients = get_recipients(mlist)
         # Remove the sender if they don't want to receive their own posts
         if not include_sender and member.address.email in recipients:
             recipients.remove(member.address.email)
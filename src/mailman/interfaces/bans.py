@@ -96,6 +96,20 @@ class IBanManager(Interface):
         :rtype: bool
         """
 
+    def get_ban(email):
+        """Find the ban on a specific email address.
+
+        The email address is checked against the bans in the same way as
+        `is_banned()` does.  Bans on the email address itself are found
+        before ban patterns, and the mailing list's bans before global bans.
+
+        :param email: The text email address being checked.
+        :type email: str
+        :return: The ban on the given email address, or None if it isn't
+            banned.
+        :rtype: `IBan`
+        """
+
     def __iter__():
         """An iterator over all the banned email addresses.
 
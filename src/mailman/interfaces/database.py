@@ -50,7 +50,10 @@ class IDatabase(Interface):
         """Abort the current transaction."""
 
     store = Attribute(
-        """The underlying database object on which you can do queries.""")
+        """The underlying database object on which you can do queries.
+
+        Each thread has its own session behind this object.
+        """)
 
 
 @public
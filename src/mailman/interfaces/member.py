@@ -87,6 +87,15 @@ class UnsubscriptionEvent(MembershipChangeEvent):
         return '{0} left {1}'.format(self.member.address, self.mlist.list_id)
 
 
+@public
+class SubscriptionAddressChangeEvent(MembershipChangeEvent):
+    """Event which gets triggered when a member changes their address."""
+
+    def __str__(self):
+        return '{0} changed address on {1}'.format(
+            self.member.address, self.mlist.list_id)
+
+
 @public
 class MembershipError(MailmanError):
     """Base exception for all membership errors."""
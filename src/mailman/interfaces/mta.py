@@ -17,6 +17,7 @@
 
 """Interface for mail transport agent integration."""
 
+from enum import Enum
 from mailman.interfaces.errors import MailmanError
 from public import public
 from zope.interface import Interface
@@ -25,10 +26,25 @@ from zope.interface import Interface
 @public
 class SomeRecipientsFailed(MailmanError):
     """Delivery to some or all recipients failed"""
-    def __init__(self, temporary_failures, permanent_failures):
+    def __init__(self, temporary_failures, permanent_failures,
+                 connection_failures=()):
         super().__init__()
         self.temporary_failures = temporary_failures
         self.permanent_failures = permanent_failures
+        # The temporary failures which happened because the MTA couldn't be
+        # connected to, or dropped the connection.
+        self.connection_failures = connection_failures
+
+
+@public
+class CircuitState(Enum):
+    # Messages are delivered to the MTA as usual.
+    closed = 0
+    # The MTA couldn't be connected to, so no messages are delivered to it
+    # for a while.
+    open = 1
+    # A single message is being delivered, to see if the MTA is back.
+    half_open = 2
 
 
 @public
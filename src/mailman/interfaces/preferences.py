@@ -21,6 +21,24 @@ from public import public
 from zope.interface import Attribute, Interface
 
 
+@public
+class PreferencesChangeEvent:
+    """Triggered when a preference changes.
+
+    The event is triggered just before the new value is set, so the named
+    preference still has its old value.
+    """
+
+    def __init__(self, preferences, name, value):
+        self.preferences = preferences
+        self.name = name
+        self.value = value
+
+    def __str__(self):
+        return '<{} {}: {}>'.format(
+            self.__class__.__name__, self.name, self.value)
+
+
 @public
 class IPreferences(Interface):
     """Delivery related information."""
@@ -64,6 +64,45 @@ class IRoster(Interface):
         :rtype: `IMember` or None
         """
 
+    def get_members(emails):
+        """Get the members for many addresses at once.
+
+        This is equivalent to calling ``get_member()`` for each email
+        address, but uses only a few queries of the database however many
+        addresses there are.
+
+        :param emails: The email addresses to search for.
+        :type emails: iterable of strings
+        :return: A mapping from each of the email addresses to its member, or
+            None if it isn't a member.
+        :rtype: dict
+        """
+
+    def get_delivery_members(delivery_modes=None, delivery_statuses=None):
+        """Get the members with the given delivery modes and statuses.
+
+        The members' effective preferences are worked out by the database,
+        so only the matching members are loaded, as they are iterated over.
+
+        :param delivery_modes: The delivery modes to filter on, or None to
+            not filter on delivery mode.
+        :type delivery_modes: sequence of `DeliveryMode`
+        :param delivery_statuses: The delivery statuses to filter on, or None
+            to not filter on delivery status.
+        :type delivery_statuses: sequence of `DeliveryStatus`
+        :return: The matching members.
+        :rtype: iterator of `IMember`
+        """
+
+    def count_delivery_members(delivery_modes=None, delivery_statuses=None):
+        """Count the members with the given delivery modes and statuses.
+
+        The arguments are the same as for ``get_delivery_members()``.
+
+        :return: The number of matching members.
+        :rtype: int
+        """
+
     def get_memberships(email):
         """Get the memberships for the given address.
 
@@ -68,6 +68,15 @@ class IRunner(Interface):
         through the main loop.
         """)
 
+    batch_size = Attribute("""\
+        The maximum number of queue entries processed in one database
+        transaction.
+        """)
+
+    workers = Attribute("""\
+        The number of worker threads processing queue entries.
+        """)
+
     def set_signals():
         """Set up the signal handlers necessary to control the runner.
 
@@ -77,6 +86,10 @@ class IRunner(Interface):
         - SIGUSR1: Also causes the runner to exit, but the master watcher will
           retart it.
         - SIGHUP: Re-open the log files.
+        - SIGUSR2: The master watcher changed the number of instances of the
+          runner, so its slice of the queue must be resized.  Under the
+          master, the slice count is also read once when the handlers are
+          installed, in case it changed before.
         """
 
     def _one_iteration():
@@ -35,6 +35,16 @@ class ISwitchboard(Interface):
         directory.
         """)
 
+    group_commit_max = Attribute(
+        """The maximum number of entries committed as a group.
+
+        When 0, every entry is synced to disk as it is enqueued.  Otherwise,
+        entries enqueued inside a `group_commit()` block are synced together.
+        """)
+
+    group_commit_window = Attribute(
+        """The maximum number of seconds an entry waits for its group.""")
+
     def enqueue(_msg, _metadata=None, **_kws):
         """Store the message and metadata in the switchboard's queue.
 
@@ -42,6 +52,15 @@ class ISwitchboard(Interface):
         keyword arguments are added to the metadata dictonary, with precedence
         given to the keyword arguments.
 
+        Keyword arguments starting with an underscore are not saved in the
+        metadata.  `_delay` is the number of seconds to wait before the entry
+        is due, i.e. before it is returned by `get_batch()`.  By default, the
+        entry is due right away.
+
+        Large sets of recipients in the metadata are stored in a file of
+        their own, and are dequeued as a read-only set which reads them from
+        there.
+
         The base name of the message file is returned.
         """
 
@@ -66,15 +85,64 @@ class ISwitchboard(Interface):
     files = Attribute(
         """An iterator over all the .pck files in the queue directory.
 
-        The base names of the matching files are returned.
+        The base names of the matching files are returned, in FIFO order,
+        including those which aren't due yet.
         """)
 
+    def get_batch(count=None):
+        """Return the oldest due .pck files in this switchboard's slice.
+
+        The files are taken from an in-memory index which is kept up to date
+        with the queue directory as cheaply as possible, so that deep queues
+        don't have to be scanned over and over again.  Entries which were
+        enqueued with a delay are left out until they are due.
+
+        :param count: The maximum number of files to return, or None to
+            return all of them.
+        :type count: int
+        :return: The base names of the files, in FIFO order.
+        :rtype: list
+        """
+
+    def next_due():
+        """Return when the next entry which isn't due yet will be due.
+
+        :return: The `time.time()` at which the entry is due, or None if all
+            the entries are due.
+        :rtype: float or None
+        """
+
     def get_files(extension='.pck'):
         """Like the 'files' attribute, but accepts an alternative extension.
 
         Only the files in the queue directory that have a matching extension
         are returned.  Like 'files', the base names of the matching files are
-        returned.
+        returned.  Unlike 'files', the queue directory is always scanned.
+        """
+
+    def wait(timeout):
+        """Wait for new files to be added to the queue directory.
+
+        Only files in this switchboard's slice of the queue are considered.
+        The first call starts watching the queue directory and returns True
+        immediately, since files added earlier would not be noticed.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :return: True if new files may be available, False if the timeout
+            expired.
+        :rtype: bool
+        """
+
+    def restore(filebase):
+        """Put a dequeued entry back in the queue, to be processed again.
+
+        As with `recover_backup_files()`, the entry is preserved in the bad
+        queue instead once it has been put back too many times.
+
+        :param filebase: The file base name of the entry, as returned by
+            `dequeue()`.
+        :type filebase: str
         """
 
     def recover_backup_files():
@@ -39,6 +39,32 @@ class PasswordChangeEvent:
             self.__class__.__name__, self.user.display_name)
 
 
+@public
+class AddressLinkEvent:
+    """Event which gets triggered when an address is linked or unlinked."""
+
+    def __init__(self, user, address):
+        self.user = user
+        self.address = address
+
+    def __str__(self):
+        return '<{} {} {}>'.format(
+            self.__class__.__name__, self.user.display_name,
+            self.address.email)
+
+
+@public
+class PreferredAddressChangeEvent:
+    """Event which gets triggered when a user's preferred address changes."""
+
+    def __init__(self, user):
+        self.user = user
+
+    def __str__(self):
+        return '<{} {}>'.format(
+            self.__class__.__name__, self.user.display_name)
+
+
 @public
 class IUser(Interface):
     """A basic user."""
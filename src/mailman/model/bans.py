@@ -15,20 +15,45 @@
 # You should have received a copy of the GNU General Public License along with
 # GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Ban manager."""
-
+"""Ban manager.
+
+Each process keeps an index of the bans of every mailing list it checks, and
+of the global bans: a set of the banned email addresses, and the compiled ban
+patterns.  The indexes are valid for as long as the token in
+`$cache_dir/bans/token` doesn't change.  The token is replaced whenever a
+transaction which banned or unbanned an email address commits, so that every
+process rebuilds its indexes.  Bans changed by other means, e.g. by another
+host or directly in the database, aren't noticed, so the indexes can be turned
+off with the `[mailman]cache_bans` setting.
+"""
+
+import os
 import re
 
+from lazr.config import as_boolean
+from mailman.config import config
 from mailman.database.model import Model
 from mailman.database.transaction import dbconnection
 from mailman.database.types import SAUnicode
 from mailman.interfaces.bans import IBan, IBanManager
+from mailman.interfaces.listmanager import ListDeletingEvent
+from mailman.utilities.filesystem import new_token, read_token
+from mailman.utilities.patterns import combine_patterns
 from mailman.utilities.queries import QuerySequence
 from public import public
 from sqlalchemy import Column, Integer
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
 from zope.interface import implementer
 
 
+PENDING_KEY = 'mailman.bans'
+
+# Map list ids, or None for the global bans, to the token and the index this
+# process last built.
+_indexes = {}
+
+
 @public
 @implementer(IBan)
 class Ban(Model):
@@ -46,6 +71,108 @@ class Ban(Model):
         self.list_id = list_id
 
 
+class _BanIndex:
+    """The bans of a mailing list, or the global bans."""
+
+    def __init__(self, emails):
+        self._emails = set()
+        patterns = []
+        for email in emails:
+            if email.startswith('^'):
+                patterns.append(email)
+            else:
+                self._emails.add(email)
+        # A single pattern matching wherever any of the combinable ones does
+        # rules most of them out at once.
+        self._combined, combined = combine_patterns(patterns)
+        self._patterns = []
+        for pattern in patterns:
+            try:
+                compiled = re.compile(pattern, re.IGNORECASE)
+            except re.error:
+                # Let matching raise the error, as it always has.
+                compiled = None
+            self._patterns.append((pattern, compiled, pattern in combined))
+
+    def find_email(self, email):
+        return email if email in self._emails else None
+
+    def find_pattern(self, email):
+        skip_combinable = (self._combined is not None and
+                           self._combined.match(email) is None)
+        for pattern, compiled, combinable in self._patterns:
+            if combinable and skip_combinable:
+                continue
+            if compiled is None:
+                re.match(pattern, email, re.IGNORECASE)
+            elif compiled.match(email) is not None:
+                return pattern
+        return None
+
+
+def _path():
+    return os.path.join(config.CACHE_DIR, 'bans', 'token')
+
+
+def _get_indexes(store, list_ids):
+    def build(list_id):
+        emails = store.query(Ban.email).filter_by(
+            list_id=list_id).order_by(Ban.id)
+        return _BanIndex(email for (email,) in emails)
+    if not as_boolean(config.mailman.cache_bans):
+        return [build(list_id) for list_id in list_ids]
+    if store.info.get(PENDING_KEY, False):
+        # This transaction changed the bans, and other processes can't see
+        # the changes yet, so its indexes must not be shared.
+        return [build(list_id) for list_id in list_ids]
+    token = read_token(_path())
+    indexes = []
+    for list_id in list_ids:
+        cached = _indexes.get(list_id)
+        if cached is None or cached[0] != token:
+            # The token was read before the bans were, so if it changed in
+            # the meantime, the index is already stale.
+            cached = _indexes[list_id] = (token, build(list_id))
+        indexes.append(cached[1])
+    return indexes
+
+
+@public
+def invalidate():
+    """Invalidate every process's ban indexes.
+
+    This takes effect immediately.  Use it outside of a transaction; banning
+    and unbanning email addresses waits until the transaction commits
+    instead.
+    """
+    new_token(_path())
+    _indexes.clear()
+
+
+def _invalidate_on_commit():
+    # Invalidating the indexes before the transaction commits would let
+    # another process index the old bans again.
+    config.db.store.info[PENDING_KEY] = True
+
+
+@listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop(PENDING_KEY, False):
+        invalidate()
+
+
+@listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+@public
+def handle_ListDeletingEvent(event):
+    # The mailing list's bans are deleted along with it.
+    if isinstance(event, ListDeletingEvent):
+        _invalidate_on_commit()
+
+
 @public
 @implementer(IBanManager)
 class BanManager:
@@ -62,6 +189,7 @@ class BanManager:
         if bans.count() == 0:
             ban = Ban(email, self._list_id)
             store.add(ban)
+            _invalidate_on_commit()
 
     @dbconnection
     def unban(self, store, email):
@@ -70,45 +198,37 @@ class BanManager:
             email=email, list_id=self._list_id).first()
         if ban is not None:
             store.delete(ban)
+            _invalidate_on_commit()
+
+    def _find(self, store, email):
+        # Exact bans are checked before pattern bans, and the mailing list's
+        # bans before the global ones.
+        list_ids = [None] if self._list_id is None else [self._list_id, None]
+        indexes = list(zip(list_ids, _get_indexes(store, list_ids)))
+        for list_id, index in indexes:
+            banned = index.find_email(email)
+            if banned is not None:
+                return list_id, banned
+        for list_id, index in indexes:
+            banned = index.find_pattern(email)
+            if banned is not None:
+                return list_id, banned
+        return None
 
     @dbconnection
     def is_banned(self, store, email):
         """See `IBanManager`."""
-        list_id = self._list_id
-        if list_id is None:
-            # The client is asking for global bans.  Look up bans on the
-            # specific email address first.
-            bans = store.query(Ban).filter_by(email=email, list_id=None)
-            if bans.count() > 0:
-                return True
-            # And now look for global pattern bans.
-            bans = store.query(Ban).filter_by(list_id=None)
-            for ban in bans:
-                if (ban.email.startswith('^') and
-                        re.match(ban.email, email, re.IGNORECASE) is not None):
-                    return True
-        else:
-            # This is a list-specific ban.
-            bans = store.query(Ban).filter_by(email=email, list_id=list_id)
-            if bans.count() > 0:
-                return True
-            # Try global bans next.
-            bans = store.query(Ban).filter_by(email=email, list_id=None)
-            if bans.count() > 0:
-                return True
-            # Now try specific mailing list bans, but with a pattern.
-            bans = store.query(Ban).filter_by(list_id=list_id)
-            for ban in bans:
-                if (ban.email.startswith('^') and
-                        re.match(ban.email, email, re.IGNORECASE) is not None):
-                    return True
-            # And now try global pattern bans.
-            bans = store.query(Ban).filter_by(list_id=None)
-            for ban in bans:
-                if (ban.email.startswith('^') and
-                        re.match(ban.email, email, re.IGNORECASE) is not None):
-                    return True
-        return False
+        return self._find(store, email) is not None
+
+    @dbconnection
+    def get_ban(self, store, email):
+        """See `IBanManager`."""
+        found = self._find(store, email)
+        if found is None:
+            return None
+        list_id, banned = found
+        return store.query(Ban).filter_by(
+            email=banned, list_id=list_id).first()
 
     @property
     @dbconnection
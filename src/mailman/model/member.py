@@ -25,7 +25,8 @@ from mailman.interfaces.action import Action
 from mailman.interfaces.address import IAddress
 from mailman.interfaces.listmanager import IListManager
 from mailman.interfaces.member import (
-    IMember, MemberRole, MembershipError, UnsubscriptionEvent)
+    IMember, MemberRole, MembershipError, SubscriptionAddressChangeEvent,
+    UnsubscriptionEvent)
 from mailman.interfaces.user import IUser, UnverifiedAddressError
 from mailman.interfaces.usermanager import IUserManager
 from mailman.utilities.uid import UIDFactory
@@ -119,13 +120,14 @@ class Member(Model):
         if user is None or user != self.user:
             raise MembershipError('Address is not controlled by user')
         self._address = new_address
+        notify(SubscriptionAddressChangeEvent(self.mailing_list, self))
 
     @property
     def user(self):
         """See `IMember`."""
         return (self._user
                 if self._address is None
-                else getUtility(IUserManager).get_user(self._address.email))
+                else self._address.user)
 
     @property
     def subscriber(self):
@@ -22,10 +22,13 @@ from mailman.database.transaction import dbconnection
 from mailman.database.types import Enum, SAUnicode
 from mailman.interfaces.languages import ILanguageManager
 from mailman.interfaces.member import DeliveryMode, DeliveryStatus
-from mailman.interfaces.preferences import IPreferences
+from mailman.interfaces.preferences import (
+    IPreferences, PreferencesChangeEvent)
 from public import public
 from sqlalchemy import Boolean, Column, Integer
+from sqlalchemy.orm import validates
 from zope.component import getUtility
+from zope.event import notify
 from zope.interface import implementer
 
 
@@ -48,6 +51,14 @@ class Preferences(Model):
     def __repr__(self):
         return '<Preferences object at {:#x}>'.format(id(self))
 
+    @validates('acknowledge_posts', 'hide_address', '_preferred_language',
+               'receive_list_copy', 'receive_own_postings', 'delivery_mode',
+               'delivery_status')
+    def _changing(self, key, value):
+        if getattr(self, key) != value:
+            notify(PreferencesChangeEvent(self, key.lstrip('_'), value))
+        return value
+
     @property
     def preferred_language(self):
         if self._preferred_language is None:
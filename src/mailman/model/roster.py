@@ -22,16 +22,124 @@ the ones that fit a particular role.  These are used as the member, owner,
 moderator, and administrator roster filters.
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from mailman.config import config
+from mailman.core.constants import system_preferences
 from mailman.database.transaction import dbconnection
-from mailman.interfaces.member import DeliveryMode, MemberRole
+from mailman.interfaces.listmanager import ListDeletingEvent
+from mailman.interfaces.member import (
+    DeliveryMode, DeliveryStatus, MemberRole, MembershipChangeEvent)
 from mailman.interfaces.roster import IRoster
+from mailman.interfaces.user import (
+    AddressLinkEvent, PreferredAddressChangeEvent)
 from mailman.model.address import Address
 from mailman.model.member import Member
+from mailman.model.preferences import Preferences
 from public import public
-from sqlalchemy import or_
+from sqlalchemy import func, literal, or_
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session, aliased, joinedload
 from zope.interface import implementer
 
 
+# The number of email addresses looked up by each query of get_members(), and
+# of members loaded by each query of get_delivery_members().  This keeps the
+# queries under SQLite's limit on the number of parameters.
+LOOKUP_CHUNK = 500
+
+# The number of get_member() lookups remembered by a member cache.
+MEMBER_CACHE_SIZE = 100
+CACHE_KEY = 'mailman.memberships'
+
+
+@public
+@contextmanager
+def member_cache():
+    """Remember the membership lookups made in this thread's block.
+
+    The runners process each message in a member cache, since the same
+    sender and recipients are looked up several times along the way.
+    Outside of it, every lookup queries the database, so that membership
+    changes made by other processes are seen.  Nested caches share the
+    outermost one.
+    """
+    info = config.db.store.info
+    if CACHE_KEY in info:
+        yield
+        return
+    info[CACHE_KEY] = OrderedDict()
+    try:
+        yield
+    finally:
+        info.pop(CACHE_KEY, None)
+
+
+def _forget_memberships(list_id=None):
+    cache = config.db.store.info.get(CACHE_KEY)
+    if cache is None:
+        return
+    if list_id is None:
+        cache.clear()
+    else:
+        for key in [key for key in cache if key[0] == list_id]:
+            del cache[key]
+
+
+@listens_for(Session, 'after_commit')
+@listens_for(Session, 'after_soft_rollback')
+def _forget_transaction(session, *args):
+    # Other processes may change the membership as soon as the transaction
+    # ends, and a rollback may undo this one's changes.
+    cache = session.info.get(CACHE_KEY)
+    if cache is not None:
+        cache.clear()
+
+
+@public
+def handle_MembershipChangeEvent(event):
+    if isinstance(event, MembershipChangeEvent):
+        _forget_memberships(event.mlist.list_id)
+
+
+@public
+def handle_ListDeletingEvent(event):
+    if isinstance(event, ListDeletingEvent):
+        _forget_memberships(event.mailing_list.list_id)
+
+
+@public
+def handle_AddressLinkEvent(event):
+    # Absorbing a user moves its memberships along with its addresses.
+    if isinstance(event, AddressLinkEvent):
+        _forget_memberships()
+
+
+@public
+def handle_PreferredAddressChangeEvent(event):
+    # The user's memberships are looked up by the preferred address, on any
+    # number of mailing lists.
+    if isinstance(event, PreferredAddressChangeEvent):
+        _forget_memberships()
+
+
+def _member_options():
+    # Load everything the delivery callbacks look at along with the members,
+    # i.e. their addresses, users and preferences.
+    #
+    # Avoid circular imports.
+    from mailman.model.user import User
+    return (
+        joinedload(Member.preferences),
+        joinedload(Member._address).joinedload(Address.preferences),
+        joinedload(Member._address).joinedload(
+            Address.user).joinedload(User.preferences),
+        joinedload(Member._user).joinedload(User.preferences),
+        joinedload(Member._user).joinedload(
+            User._preferred_address).joinedload(Address.preferences),
+        )
+
+
 @public
 @implementer(IRoster)
 class AbstractRoster:
@@ -48,11 +156,14 @@ class AbstractRoster:
     def __init__(self, mlist):
         self._mlist = mlist
 
+    def _criteria(self):
+        # The criteria selecting this roster's members.
+        return (Member.list_id == self._mlist.list_id,
+                Member.role == self.role)
+
     @dbconnection
     def _query(self, store):
-        return store.query(Member).filter(
-            Member.list_id == self._mlist.list_id,
-            Member.role == self.role)
+        return store.query(Member).filter(*self._criteria())
 
     @property
     def members(self):
@@ -84,24 +195,32 @@ class AbstractRoster:
 
     @dbconnection
     def _get_all_memberships(self, store, email):
+        # Repeated lookups of the same email address are answered from the
+        # member cache, if there is one, until the list's membership changes.
+        cache = store.info.get(CACHE_KEY)
+        key = (self._mlist.list_id, self.name, email)
+        if cache is not None:
+            memberships = cache.get(key)
+            if memberships is not None:
+                cache.move_to_end(key)
+                return list(memberships)
         # Avoid circular imports.
         from mailman.model.user import User
-        # Here's a query that finds all members subscribed with an explicit
-        # email address.
-        members_a = store.query(Member).filter(
+        # Find the members subscribed with the explicit email address and the
+        # ones subscribed with the preferred address it is, in one query.
+        query = store.query(Member).select_from(Address).outerjoin(
+            User, User._preferred_address_id == Address.id).join(
+            Member, or_(Member.address_id == Address.id,
+                        Member.user_id == User.id)).filter(
             Member.list_id == self._mlist.list_id,
             Member.role == self.role,
-            Address.email == email,
-            Member.address_id == Address.id)
-        # Here's a query that finds all members subscribed with their
-        # preferred address.
-        members_u = store.query(Member).filter(
-            Member.list_id == self._mlist.list_id,
-            Member.role == self.role,
-            Address.email == email,
-            Member.user_id == User.id,
-            User._preferred_address_id == Address.id)
-        return members_a.union(members_u).all()
+            Address.email == email)
+        memberships = query.all()
+        if cache is not None:
+            cache[key] = tuple(memberships)
+            if len(cache) > MEMBER_CACHE_SIZE:
+                cache.popitem(last=False)
+        return memberships
 
     def get_member(self, email):
         """See ``IRoster``."""
@@ -119,6 +238,100 @@ class AbstractRoster:
                 if memberships[0]._address is not None
                 else memberships[1])
 
+    @dbconnection
+    def _query_preferences(self, store, entity, *names):
+        """Query the members along with their effective preferences.
+
+        Like `Member._lookup()`, each preference is the member's own, or else
+        its address's, or else its address's user's, or else the system
+        default.  Here the database works them out for all the members at
+        once.
+
+        :param entity: What to query, e.g. `Member`, or the members' email
+            addresses.
+        :param names: The names of the preferences.
+        :type names: strings
+        :return: A query of the entity for this roster's members, joined with
+            everything their preferences come from, and a dictionary mapping
+            the names to the preference expressions, for filtering the query
+            on.
+        :rtype: 2-tuple of query and dict
+        """
+        # Avoid circular imports.
+        from mailman.model.user import User
+        member_user = aliased(User)
+        address_user = aliased(User)
+        member_preferences = aliased(Preferences)
+        address_preferences = aliased(Preferences)
+        user_preferences = aliased(Preferences)
+        preferences = {}
+        for name in names:
+            column = Preferences.__table__.columns[name]
+            preferences[name] = func.coalesce(
+                getattr(member_preferences, name),
+                getattr(address_preferences, name),
+                getattr(user_preferences, name),
+                literal(getattr(system_preferences, name), column.type),
+                type_=column.type)
+        # The member's address is the one it was subscribed with, or else its
+        # user's preferred address.
+        address_id = func.coalesce(
+            Member.address_id, member_user._preferred_address_id)
+        query = store.query(entity).select_from(Member)
+        query = query.outerjoin(
+            member_user, Member.user_id == member_user.id)
+        query = query.join(Address, Address.id == address_id)
+        query = query.outerjoin(
+            address_user, Address.user_id == address_user.id)
+        query = query.outerjoin(
+            member_preferences,
+            Member.preferences_id == member_preferences.id)
+        query = query.outerjoin(
+            address_preferences,
+            Address.preferences_id == address_preferences.id)
+        query = query.outerjoin(
+            user_preferences,
+            address_user.preferences_id == user_preferences.id)
+        query = query.filter(*self._criteria())
+        return query, preferences
+
+    def _query_delivery(self, entity, delivery_modes, delivery_statuses):
+        query, preferences = self._query_preferences(
+            entity, 'delivery_mode', 'delivery_status')
+        if delivery_modes is not None:
+            query = query.filter(
+                preferences['delivery_mode'].in_(delivery_modes))
+        if delivery_statuses is not None:
+            query = query.filter(
+                preferences['delivery_status'].in_(delivery_statuses))
+        return query
+
+    def get_delivery_members(self, delivery_modes=None,
+                             delivery_statuses=None):
+        """See `IRoster`."""
+        query = self._query_delivery(
+            Member, delivery_modes, delivery_statuses)
+        query = query.options(*_member_options()).order_by(Member.id)
+        # Load the members a chunk at a time, each chunk completely, so that
+        # no query is left open while the callers look at the members.
+        last_id = None
+        while True:
+            chunk = query
+            if last_id is not None:
+                chunk = chunk.filter(Member.id > last_id)
+            members = chunk.limit(LOOKUP_CHUNK).all()
+            yield from members
+            if len(members) < LOOKUP_CHUNK:
+                break
+            last_id = members[-1].id
+
+    def count_delivery_members(self, delivery_modes=None,
+                               delivery_statuses=None):
+        """See `IRoster`."""
+        query = self._query_delivery(
+            func.count(Member.id), delivery_modes, delivery_statuses)
+        return query.scalar()
+
     def get_memberships(self, email):
         """See ``IRoster``."""
         memberships = self._get_all_memberships(email)
@@ -127,6 +340,40 @@ class AbstractRoster:
             count)
         return memberships
 
+    def _lookup_members(self, emails, preferred=True):
+        # Avoid circular imports.
+        from mailman.model.user import User
+        options = _member_options()
+        explicit = {}
+        indirect = {}
+        emails = sorted(set(emails))
+        for start in range(0, len(emails), LOOKUP_CHUNK):
+            chunk = emails[start:start + LOOKUP_CHUNK]
+            # The members subscribed with an explicit email address.
+            query = self._query().join(
+                Address, Member.address_id == Address.id).filter(
+                Address.email.in_(chunk))
+            for member, email in query.options(*options).add_columns(
+                    Address.email):
+                explicit[email] = member
+            if not preferred:
+                continue
+            # The members subscribed with their preferred address.
+            query = self._query().join(
+                User, Member.user_id == User.id).join(
+                Address, User._preferred_address_id == Address.id).filter(
+                Address.email.in_(chunk))
+            for member, email in query.options(*options).add_columns(
+                    Address.email):
+                indirect[email] = member
+        # As with get_member(), the explicit address membership wins.
+        return {email: explicit.get(email, indirect.get(email))
+                for email in emails}
+
+    def get_members(self, emails):
+        """See ``IRoster``."""
+        return self._lookup_members(emails)
+
 
 @public
 class MemberRoster(AbstractRoster):
@@ -166,12 +413,10 @@ class AdministratorRoster(AbstractRoster):
 
     name = 'administrator'
 
-    @dbconnection
-    def _query(self, store):
-        return store.query(Member).filter(
-            Member.list_id == self._mlist.list_id,
-            or_(Member.role == MemberRole.owner,
-                Member.role == MemberRole.moderator))
+    def _criteria(self):
+        return (Member.list_id == self._mlist.list_id,
+                or_(Member.role == MemberRole.owner,
+                    Member.role == MemberRole.moderator))
 
     @dbconnection
     def get_member(self, store, email):
@@ -183,36 +428,62 @@ class AdministratorRoster(AbstractRoster):
             Address.email == email,
             Member.address_id == Address.id).one_or_none()
 
+    def get_members(self, emails):
+        """See `IRoster`."""
+        # Like get_member(), only consider explicit address memberships.
+        return self._lookup_members(emails, preferred=False)
+
 
 @public
 class DeliveryMemberRoster(AbstractRoster):
     """Return all the members having a particular kind of delivery."""
 
     role = MemberRole.member
+    # The delivery modes of the members in this roster.
+    delivery_modes = ()
 
     @property
-    def member_count(self):
+    def members(self):
         """See `IRoster`."""
-        # XXX 2012-03-15 BAW: It would be nice to make this more efficient.
-        # The problem is that you'd have to change the loop in _get_members()
-        # checking the delivery mode to a query parameter.
-        return len(tuple(self.members))
+        yield from self.get_delivery_members()
 
-    @dbconnection
-    def _get_members(self, store, *delivery_modes):
-        """The set of members for a mailing list, filter by delivery mode.
+    @property
+    def member_count(self):
+        """See `IRoster`."""
+        return self.count_delivery_members()
+
+    def _query_delivery(self, entity, delivery_modes, delivery_statuses):
+        # Only the members with this roster's delivery modes are in it.
+        if delivery_modes is None:
+            delivery_modes = self.delivery_modes
+        else:
+            delivery_modes = [mode for mode in delivery_modes
+                              if mode in self.delivery_modes]
+        return super()._query_delivery(
+            entity, delivery_modes, delivery_statuses)
+
+    def get_recipients(self, *delivery_modes, original_email=False):
+        """The email addresses of the members which get deliveries.
+
+        These are the members with the given delivery modes whose delivery
+        is enabled.  Their effective preferences are worked out by the
+        database, so this takes a single query however many members there
+        are.
 
         :param delivery_modes: The modes to filter on.
         :type delivery_modes: sequence of `DeliveryMode`.
-        :return: A generator of members.
-        :rtype: generator
+        :param original_email: Whether to return the case-preserved email
+            addresses instead of the lower-cased ones.
+        :type original_email: bool
+        :return: The email addresses.
+        :rtype: set
         """
-        results = store.query(Member).filter_by(
-            list_id=self._mlist.list_id,
-            role=MemberRole.member)
-        for member in results:
-            if member.delivery_mode in delivery_modes:
-                yield member
+        email = (func.coalesce(Address._original, Address.email)
+                 if original_email
+                 else Address.email)
+        query = self._query_delivery(
+            email, delivery_modes, (DeliveryStatus.enabled,))
+        return set(email for (email,) in query)
 
 
 @public
@@ -220,11 +491,15 @@ class RegularMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'regular_members'
+    delivery_modes = (DeliveryMode.regular,)
 
     @property
-    def members(self):
-        """See `IRoster`."""
-        yield from self._get_members(DeliveryMode.regular)
+    def recipients(self):
+        """The email addresses of the regular members getting deliveries.
+
+        :rtype: set
+        """
+        return self.get_recipients(DeliveryMode.regular)
 
 
 @public
@@ -232,14 +507,11 @@ class DigestMemberRoster(DeliveryMemberRoster):
     """Return all the regular delivery members of a list."""
 
     name = 'digest_members'
-
-    @property
-    def members(self):
-        """See `IRoster`."""
-        yield from self._get_members(
-            DeliveryMode.plaintext_digests,
-            DeliveryMode.mime_digests,
-            DeliveryMode.summary_digests)
+    delivery_modes = (
+        DeliveryMode.plaintext_digests,
+        DeliveryMode.mime_digests,
+        DeliveryMode.summary_digests,
+        )
 
 
 @public
@@ -248,9 +520,8 @@ class Subscribers(AbstractRoster):
 
     name = 'subscribers'
 
-    @dbconnection
-    def _query(self, store):
-        return store.query(Member).filter_by(list_id=self._mlist.list_id)
+    def _criteria(self):
+        return (Member.list_id == self._mlist.list_id,)
 
 
 @public
@@ -298,6 +569,23 @@ class Memberships:
         """See `IRoster`."""
         raise NotImplementedError
 
+    @dbconnection
+    def get_members(self, store, emails):
+        """See `IRoster`."""
+        raise NotImplementedError
+
+    @dbconnection
+    def get_delivery_members(self, store, delivery_modes=None,
+                             delivery_statuses=None):
+        """See `IRoster`."""
+        raise NotImplementedError
+
+    @dbconnection
+    def count_delivery_members(self, store, delivery_modes=None,
+                               delivery_statuses=None):
+        """See `IRoster`."""
+        raise NotImplementedError
+
     @dbconnection
     def get_memberships(self, store, address):
         """See `IRoster`."""
@@ -17,12 +17,19 @@
 
 """Test Bans and the ban manager."""
 
+import re
 import unittest
 
 from mailman.app.lifecycle import create_list
+from mailman.config import config
+from mailman.database.transaction import transaction
 from mailman.interfaces.bans import IBanManager
 from mailman.interfaces.listmanager import IListManager
+from mailman.model import bans
+from mailman.model.bans import Ban
+from mailman.testing.helpers import configuration
 from mailman.testing.layers import ConfigLayer
+from mailman.utilities.filesystem import read_token
 from zope.component import getUtility
 
 
@@ -63,3 +70,122 @@ class TestMailingListBans(unittest.TestCase):
         self.assertEqual(
             [self._manager.bans[i].email for i in range(count)],
             ['ant@example.com', 'bee@example.com', 'cat@example.com'])
+
+
+class TestBanIndex(unittest.TestCase):
+    layer = ConfigLayer
+
+    def setUp(self):
+        with transaction():
+            self._mlist = create_list('ant@example.com')
+        self._manager = IBanManager(self._mlist)
+        self._global_manager = IBanManager(None)
+
+    def _ban(self, manager, *emails):
+        with transaction():
+            for email in emails:
+                manager.ban(email)
+
+    def test_get_ban(self):
+        # The matching ban is reported: exact bans before patterns, and the
+        # mailing list's bans before global ones.
+        self._ban(self._manager, 'anne@example.com', '^.*@example.org$')
+        self._ban(self._global_manager,
+                  'anne@example.com', 'bart@example.com', '^cris@')
+        ban = self._manager.get_ban('anne@example.com')
+        self.assertEqual((ban.email, ban.list_id),
+                         ('anne@example.com', 'ant.example.com'))
+        ban = self._manager.get_ban('bart@example.com')
+        self.assertEqual((ban.email, ban.list_id), ('bart@example.com', None))
+        ban = self._manager.get_ban('cris@example.org')
+        self.assertEqual((ban.email, ban.list_id),
+                         ('^.*@example.org$', 'ant.example.com'))
+        ban = self._manager.get_ban('cris@example.com')
+        self.assertEqual((ban.email, ban.list_id), ('^cris@', None))
+        self.assertIsNone(self._manager.get_ban('dave@example.com'))
+        ban = self._global_manager.get_ban('anne@example.com')
+        self.assertEqual((ban.email, ban.list_id), ('anne@example.com', None))
+        self.assertIsNone(self._global_manager.get_ban('anne@example.org'))
+
+    def test_many_patterns(self):
+        # The patterns are matched case insensitively at the start of the
+        # email address, including those which can't be combined.
+        self._ban(self._manager, *('^user{}@'.format(i) for i in range(500)))
+        self._ban(self._manager, r'^(\w+)\.\1@')
+        self.assertTrue(self._manager.is_banned('user42@example.com'))
+        self.assertTrue(self._manager.is_banned('USER499@example.com'))
+        self.assertFalse(self._manager.is_banned('xuser42@example.com'))
+        self.assertFalse(self._manager.is_banned('user500@example.com'))
+        self.assertEqual(self._manager.get_ban('bee.bee@example.com').email,
+                         r'^(\w+)\.\1@')
+        self.assertFalse(self._manager.is_banned('bee.cat@example.com'))
+
+    def test_bad_pattern(self):
+        # A ban pattern which isn't a valid regular expression still raises
+        # an error when it's reached.
+        self._ban(self._manager, 'anne@example.com', '^(bad')
+        self.assertTrue(self._manager.is_banned('anne@example.com'))
+        self.assertRaises(
+            re.error, self._manager.is_banned, 'bart@example.com')
+
+    def test_index_is_kept(self):
+        # Once the bans are committed, the index is kept until the token
+        # changes, which ignores changes made behind the ban manager's back.
+        self._ban(self._manager, 'anne@example.com')
+        self.assertTrue(self._manager.is_banned('anne@example.com'))
+        index = bans._indexes['ant.example.com']
+        with transaction():
+            config.db.store.query(Ban).delete()
+        self.assertTrue(self._manager.is_banned('anne@example.com'))
+        self.assertIs(bans._indexes['ant.example.com'], index)
+        bans.invalidate()
+        self.assertFalse(self._manager.is_banned('anne@example.com'))
+
+    def test_index_disabled(self):
+        # Without the indexes, changes made behind the ban manager's back are
+        # seen at once.
+        self._ban(self._manager, 'anne@example.com')
+        with configuration('mailman', cache_bans='no'):
+            self.assertTrue(self._manager.is_banned('anne@example.com'))
+            with transaction():
+                config.db.store.query(Ban).delete()
+            self.assertFalse(self._manager.is_banned('anne@example.com'))
+
+    def test_ban_invalidates_on_commit(self):
+        # Banning and unbanning replace the token when the transaction
+        # commits.
+        self.assertFalse(self._manager.is_banned('anne@example.com'))
+        token = read_token(bans._path())
+        self._ban(self._manager, 'anne@example.com')
+        self.assertNotEqual(read_token(bans._path()), token)
+        self.assertTrue(self._manager.is_banned('anne@example.com'))
+        token = read_token(bans._path())
+        with transaction():
+            self._global_manager.unban('anne@example.com')
+        self.assertEqual(read_token(bans._path()), token)
+        with transaction():
+            self._manager.unban('anne@example.com')
+        self.assertNotEqual(read_token(bans._path()), token)
+        self.assertFalse(self._manager.is_banned('anne@example.com'))
+
+    def test_uncommitted_bans(self):
+        # The bans of an uncommitted transaction are seen by it, but aren't
+        # indexed for anyone else.
+        self.assertFalse(self._manager.is_banned('anne@example.com'))
+        token = read_token(bans._path())
+        self._manager.ban('anne@example.com')
+        self.assertTrue(self._manager.is_banned('anne@example.com'))
+        config.db.abort()
+        self.assertEqual(read_token(bans._path()), token)
+        self.assertFalse(self._manager.is_banned('anne@example.com'))
+
+    def test_delete_list_invalidates(self):
+        # A mailing list's bans go away with it, even if a list with the same
+        # list id is created again.
+        self._ban(self._manager, 'anne@example.com')
+        self.assertTrue(self._manager.is_banned('anne@example.com'))
+        with transaction():
+            getUtility(IListManager).delete(self._mlist)
+        with transaction():
+            mlist = create_list('ant@example.com')
+        self.assertFalse(IBanManager(mlist).is_banned('anne@example.com'))
@@ -20,12 +20,16 @@
 import unittest
 
 from mailman.app.lifecycle import create_list
+from mailman.config import config
 from mailman.interfaces.address import IAddress
-from mailman.interfaces.member import DeliveryMode, MemberRole
+from mailman.interfaces.member import DeliveryMode, DeliveryStatus, MemberRole
 from mailman.interfaces.user import IUser
 from mailman.interfaces.usermanager import IUserManager
+from mailman.model.roster import member_cache
 from mailman.testing.helpers import set_preferred
 from mailman.testing.layers import ConfigLayer
+from sqlalchemy import event, or_
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -191,6 +195,34 @@ class TestMembershipsRoster(unittest.TestCase):
             [record.address.email for record in memberships],
             ['anne@example.com', 'anne@example.com'])
 
+    def test_get_members(self):
+        # get_members() looks up many addresses at once, returning the same
+        # members as get_member() would.
+        bart = getUtility(IUserManager).create_address('bart@example.com')
+        self._ant.subscribe(self._anne)
+        self._ant.subscribe(self._anne.preferred_address)
+        self._ant.subscribe(bart)
+        emails = ['anne@example.com', 'bart@example.com', 'cris@example.com']
+        members = self._ant.members.get_members(emails)
+        self.assertEqual(members, {
+            email: self._ant.members.get_member(email)
+            for email in emails
+            })
+        self.assertTrue(IAddress.providedBy(
+            members['anne@example.com'].subscriber))
+        self.assertEqual(members['bart@example.com'].address, bart)
+        self.assertIsNone(members['cris@example.com'])
+
+    def test_get_members_chunked(self):
+        # The addresses are looked up in chunks.
+        self._ant.subscribe(self._anne)
+        emails = ['person{}@example.com'.format(i) for i in range(5)]
+        emails.append('anne@example.com')
+        with patch('mailman.model.roster.LOOKUP_CHUNK', 2):
+            members = self._ant.members.get_members(emails)
+        self.assertEqual(len(members), 6)
+        self.assertEqual(members['anne@example.com'].user, self._anne)
+
     def test_memberships_users(self):
         self._ant.subscribe(self._anne)
         users = list(self._anne.memberships.users)
@@ -225,3 +257,384 @@ class TestUserRoster(unittest.TestCase):
         self._mlist.subscribe(self._dave)
         member = self._mlist.members.get_member('bart@example.com')
         self.assertEqual(member.user, self._bart)
+
+
+class TestRecipients(unittest.TestCase):
+    """Test the recipients of the delivery rosters."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        self._user_manager = getUtility(IUserManager)
+
+    def _subscribe(self, email, via_user=False):
+        if via_user:
+            user = self._user_manager.make_user(email)
+            set_preferred(user)
+            return self._mlist.subscribe(user)
+        address = self._user_manager.create_address(email)
+        return self._mlist.subscribe(address)
+
+    def _expected(self, roster):
+        # What the members' own preferences say.
+        return set(member.address.email
+                   for member in roster.members
+                   if member.delivery_status == DeliveryStatus.enabled)
+
+    def test_recipients(self):
+        self._subscribe('anne@example.com')
+        self._subscribe('bart@example.com', via_user=True)
+        self.assertEqual(self._mlist.regular_members.recipients,
+                         {'anne@example.com', 'bart@example.com'})
+        self.assertEqual(self._mlist.digest_members.get_recipients(
+            DeliveryMode.mime_digests), set())
+
+    def test_preference_precedence(self):
+        # The member's preferences come first, then the address's, then the
+        # user's, and then the system's.
+        anne = self._subscribe('anne@example.com')
+        bart = self._subscribe('bart@example.com', via_user=True)
+        cris = self._subscribe('cris@example.com', via_user=True)
+        dave = self._subscribe('dave@example.com')
+        elle = self._subscribe('elle@example.com', via_user=True)
+        fred = self._subscribe('fred@example.com')
+        self._user_manager.make_user('fred@example.com')
+        # Anne disables delivery on her address, but not her membership.
+        anne.address.preferences.delivery_status = (
+            DeliveryStatus.by_user)
+        # Bart disables delivery as a user, but enables it on the address
+        # he's subscribed with.
+        bart.user.preferences.delivery_status = DeliveryStatus.by_user
+        bart.address.preferences.delivery_status = DeliveryStatus.enabled
+        # Cris disables delivery as a user.
+        cris.user.preferences.delivery_status = DeliveryStatus.by_user
+        # Dave disables delivery on his address, but enables it for his
+        # membership.
+        dave.address.preferences.delivery_status = DeliveryStatus.by_user
+        dave.preferences.delivery_status = DeliveryStatus.enabled
+        # Elle gets digests.
+        elle.preferences.delivery_mode = DeliveryMode.mime_digests
+        # Fred's address got linked to a user who disabled delivery.
+        fred.address.user.preferences.delivery_status = (
+            DeliveryStatus.by_moderator)
+        recipients = self._mlist.regular_members.recipients
+        self.assertEqual(recipients, {'bart@example.com', 'dave@example.com'})
+        self.assertEqual(recipients,
+                         self._expected(self._mlist.regular_members))
+        self.assertEqual(
+            self._mlist.digest_members.get_recipients(
+                DeliveryMode.mime_digests),
+            {'elle@example.com'})
+
+    def test_other_lists(self):
+        # Only the roster's own members are recipients.
+        bee = create_list('bee@example.com')
+        self._subscribe('anne@example.com')
+        address = self._user_manager.create_address('bart@example.com')
+        bee.subscribe(address)
+        self._mlist.subscribe(address, MemberRole.owner)
+        self.assertEqual(self._mlist.regular_members.recipients,
+                         {'anne@example.com'})
+
+
+class TestDeliveryMembers(unittest.TestCase):
+    """Test filtering rosters on delivery mode and status."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        user_manager = getUtility(IUserManager)
+        self._members = {}
+        for email, mode, status in (
+                ('anne@example.com', None, None),
+                ('bart@example.com', None, DeliveryStatus.by_bounces),
+                ('cris@example.com', DeliveryMode.mime_digests, None),
+                ('dave@example.com', DeliveryMode.plaintext_digests,
+                 DeliveryStatus.by_user),
+                ):
+            address = user_manager.create_address(email)
+            member = self._mlist.subscribe(address)
+            if mode is not None:
+                member.preferences.delivery_mode = mode
+            if status is not None:
+                address.preferences.delivery_status = status
+            self._members[email] = member
+        # An owner isn't in the delivery rosters.
+        self._mlist.subscribe(
+            user_manager.create_address('elle@example.com'), MemberRole.owner)
+
+    def _emails(self, members):
+        return sorted(member.address.email for member in members)
+
+    def test_regular_members(self):
+        roster = self._mlist.regular_members
+        self.assertEqual(self._emails(roster.members),
+                         ['anne@example.com', 'bart@example.com'])
+        self.assertEqual(roster.member_count, 2)
+
+    def test_digest_members(self):
+        roster = self._mlist.digest_members
+        self.assertEqual(self._emails(roster.members),
+                         ['cris@example.com', 'dave@example.com'])
+        self.assertEqual(roster.member_count, 2)
+
+    def test_filter_status(self):
+        roster = self._mlist.members
+        self.assertEqual(
+            self._emails(roster.get_delivery_members(
+                delivery_statuses=[DeliveryStatus.enabled])),
+            ['anne@example.com', 'cris@example.com'])
+        self.assertEqual(
+            roster.count_delivery_members(
+                delivery_statuses=[DeliveryStatus.enabled]), 2)
+
+    def test_filter_mode_and_status(self):
+        roster = self._mlist.members
+        self.assertEqual(
+            self._emails(roster.get_delivery_members(
+                [DeliveryMode.regular, DeliveryMode.plaintext_digests],
+                [DeliveryStatus.by_bounces, DeliveryStatus.by_user])),
+            ['bart@example.com', 'dave@example.com'])
+
+    def test_delivery_roster_modes(self):
+        # A delivery roster never has members with other delivery modes.
+        roster = self._mlist.digest_members
+        self.assertEqual(
+            self._emails(roster.get_delivery_members(
+                [DeliveryMode.regular, DeliveryMode.mime_digests])),
+            ['cris@example.com'])
+        self.assertEqual(
+            roster.count_delivery_members([DeliveryMode.regular]), 0)
+
+    def test_administrators(self):
+        roster = self._mlist.administrators
+        self.assertEqual(
+            self._emails(roster.get_delivery_members([DeliveryMode.regular])),
+            ['elle@example.com'])
+
+    @patch('mailman.model.roster.LOOKUP_CHUNK', 3)
+    def test_members_are_loaded_in_chunks(self):
+        # Each chunk of members is loaded along with their addresses and
+        # preferences by one query, so looking at them doesn't query again.
+        user_manager = getUtility(IUserManager)
+        for i in range(3):
+            user = user_manager.make_user('user{}@example.com'.format(i))
+            set_preferred(user)
+            self._mlist.subscribe(user)
+        config.db.commit()
+        roster = self._mlist.members
+        # The committed mailing list is loaded again before counting.
+        self.assertEqual(self._mlist.list_id, 'ant.example.com')
+        statements = []
+
+        def record(connection, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(config.db.engine, 'before_cursor_execute', record)
+        try:
+            members = [
+                (member.address.email, member.delivery_mode,
+                 member.delivery_status)
+                for member in roster.get_delivery_members()]
+        finally:
+            event.remove(config.db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(members), 7)
+        self.assertEqual(len(statements), 3)
+
+    def test_matches_python_lookups(self):
+        roster = self._mlist.subscribers
+        for mode in DeliveryMode:
+            for status in DeliveryStatus:
+                expected = sorted(
+                    member.address.email for member in roster.members
+                    if member.delivery_mode == mode and
+                    member.delivery_status == status)
+                members = roster.get_delivery_members([mode], [status])
+                self.assertEqual(self._emails(members), expected)
+
+
+class TestGetMember(unittest.TestCase):
+    """Test get_member() lookups."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        self._user_manager = getUtility(IUserManager)
+        self._anne = self._user_manager.create_address('anne@example.com')
+
+    def test_one_query(self):
+        # The explicit address and preferred address memberships are looked
+        # up in a single query.
+        user = self._user_manager.make_user('bart@example.com')
+        set_preferred(user)
+        member = self._mlist.subscribe(user)
+        with patch('mailman.model.roster.or_', wraps=or_) as lookup:
+            self.assertEqual(
+                self._mlist.members.get_member('bart@example.com'), member)
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_rosters(self):
+        # Each roster of the mailing list only finds its own members.
+        self._mlist.subscribe(self._anne)
+        self.assertIsNotNone(
+            self._mlist.members.get_member('anne@example.com'))
+        self.assertIsNone(
+            self._mlist.nonmembers.get_member('anne@example.com'))
+
+    def test_subscription(self):
+        self.assertIsNone(self._mlist.members.get_member('anne@example.com'))
+        member = self._mlist.subscribe(self._anne)
+        self.assertEqual(
+            self._mlist.members.get_member('anne@example.com'), member)
+
+    def test_unsubscription(self):
+        member = self._mlist.subscribe(self._anne)
+        self.assertEqual(
+            self._mlist.members.get_member('anne@example.com'), member)
+        member.unsubscribe()
+        self.assertIsNone(self._mlist.members.get_member('anne@example.com'))
+
+    def test_preferred_address(self):
+        user = self._user_manager.make_user('bart@example.com')
+        set_preferred(user)
+        member = self._mlist.subscribe(user)
+        self.assertEqual(
+            self._mlist.members.get_member('bart@example.com'), member)
+        address = user.register('brat@example.com')
+        address.verified_on = address.registered_on
+        user.preferred_address = address
+        self.assertIsNone(self._mlist.members.get_member('bart@example.com'))
+        self.assertEqual(
+            self._mlist.members.get_member('brat@example.com'), member)
+
+    def test_absorb(self):
+        # Absorbing a user relinks its addresses and moves its memberships.
+        bart = self._user_manager.make_user('bart@example.com')
+        set_preferred(bart)
+        cris = self._user_manager.make_user('cris@example.com')
+        set_preferred(cris)
+        member = self._mlist.subscribe(bart)
+        self.assertEqual(
+            self._mlist.members.get_member('bart@example.com'), member)
+        self.assertIsNone(self._mlist.members.get_member('cris@example.com'))
+        cris.absorb(bart)
+        self.assertIsNone(self._mlist.members.get_member('bart@example.com'))
+        self.assertEqual(
+            self._mlist.members.get_member('cris@example.com'), member)
+
+
+class TestMemberCache(unittest.TestCase):
+    """Test the cache of get_member() lookups."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('ant@example.com')
+        self._user_manager = getUtility(IUserManager)
+        self._anne = self._user_manager.create_address('anne@example.com')
+
+    def _lookups(self):
+        # Count the queries looking up memberships.
+        return patch('mailman.model.roster.or_', wraps=or_)
+
+    def test_cached(self):
+        member = self._mlist.subscribe(self._anne)
+        with member_cache(), self._lookups() as lookup:
+            for i in range(5):
+                self.assertEqual(
+                    self._mlist.members.get_member('anne@example.com'),
+                    member)
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_not_cached_outside(self):
+        self._mlist.subscribe(self._anne)
+        with member_cache():
+            self._mlist.members.get_member('anne@example.com')
+        with self._lookups() as lookup:
+            for i in range(2):
+                self._mlist.members.get_member('anne@example.com')
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_nested(self):
+        # A nested cache shares the outer one, which outlives it.
+        with member_cache(), self._lookups() as lookup:
+            with member_cache():
+                self._mlist.members.get_member('anne@example.com')
+            self._mlist.members.get_member('anne@example.com')
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_subscription(self):
+        with member_cache():
+            self.assertIsNone(
+                self._mlist.members.get_member('anne@example.com'))
+            member = self._mlist.subscribe(self._anne)
+            self.assertEqual(
+                self._mlist.members.get_member('anne@example.com'), member)
+            member.unsubscribe()
+            self.assertIsNone(
+                self._mlist.members.get_member('anne@example.com'))
+
+    def test_other_list(self):
+        # Subscribing to another mailing list leaves this one's lookups
+        # cached.
+        bee = create_list('bee@example.com')
+        self._mlist.subscribe(self._anne)
+        with member_cache():
+            self._mlist.members.get_member('anne@example.com')
+            bee.subscribe(self._anne)
+            with self._lookups() as lookup:
+                self._mlist.members.get_member('anne@example.com')
+        self.assertEqual(lookup.call_count, 0)
+
+    def test_preferred_address(self):
+        user = self._user_manager.make_user('bart@example.com')
+        set_preferred(user)
+        member = self._mlist.subscribe(user)
+        with member_cache():
+            self.assertEqual(
+                self._mlist.members.get_member('bart@example.com'), member)
+            address = user.register('brat@example.com')
+            address.verified_on = address.registered_on
+            user.preferred_address = address
+            self.assertIsNone(
+                self._mlist.members.get_member('bart@example.com'))
+
+    def test_absorb(self):
+        bart = self._user_manager.make_user('bart@example.com')
+        set_preferred(bart)
+        cris = self._user_manager.make_user('cris@example.com')
+        set_preferred(cris)
+        member = self._mlist.subscribe(bart)
+        with member_cache():
+            self.assertEqual(
+                self._mlist.members.get_member('bart@example.com'), member)
+            cris.absorb(bart)
+            self.assertIsNone(
+                self._mlist.members.get_member('bart@example.com'))
+
+    def test_transaction(self):
+        # The lookups are forgotten when the transaction ends.
+        self._mlist.subscribe(self._anne)
+        config.db.commit()
+        with member_cache():
+            self._mlist.members.get_member('anne@example.com')
+            config.db.abort()
+            with self._lookups() as lookup:
+                self._mlist.members.get_member('anne@example.com')
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_evicted(self):
+        for i in range(3):
+            self._mlist.subscribe(self._user_manager.create_address(
+                'person{}@example.com'.format(i)))
+        with member_cache(), patch(
+                'mailman.model.roster.MEMBER_CACHE_SIZE', 2):
+            for i in range(3):
+                self._mlist.members.get_member(
+                    'person{}@example.com'.format(i))
+            with self._lookups() as lookup:
+                self._mlist.members.get_member('person2@example.com')
+                self._mlist.members.get_member('person0@example.com')
+        self.assertEqual(lookup.call_count, 1)
@@ -23,7 +23,8 @@ from mailman.database.types import SAUnicode, UUID
 from mailman.interfaces.address import (
     AddressAlreadyLinkedError, AddressNotLinkedError)
 from mailman.interfaces.user import (
-    IUser, PasswordChangeEvent, UnverifiedAddressError)
+    AddressLinkEvent, IUser, PasswordChangeEvent, PreferredAddressChangeEvent,
+    UnverifiedAddressError)
 from mailman.model.address import Address
 from mailman.model.member import Member
 from mailman.model.preferences import Preferences
@@ -63,7 +64,8 @@ class User(Model):
         Integer,
         ForeignKey('address.id', use_alter=True,
                    name='_preferred_address',
-                   ondelete='SET NULL'))
+                   ondelete='SET NULL'),
+        index=True)
 
     _preferred_address = relationship(
         'Address', primaryjoin=(_preferred_address_id == Address.id),
@@ -116,12 +118,14 @@ class User(Model):
         if address.user is not None:
             raise AddressAlreadyLinkedError(address)
         address.user = self
+        notify(AddressLinkEvent(self, address))
 
     def unlink(self, address):
         """See `IUser`."""
         if address.user is None or address.user is not self:
             raise AddressNotLinkedError(address)
         address.user = None
+        notify(AddressLinkEvent(self, address))
 
     @property
     def preferred_address(self):
@@ -141,11 +145,13 @@ class User(Model):
         elif address.user != self:
             raise AddressAlreadyLinkedError(address)
         self._preferred_address = address
+        notify(PreferredAddressChangeEvent(self))
 
     @preferred_address.deleter
     def preferred_address(self):
         """See `IUser`."""
         self._preferred_address = None
+        notify(PreferredAddressChangeEvent(self))
 
     @dbconnection
     def controls(self, store, email):
@@ -161,6 +167,8 @@ class User(Model):
         """See `IUser`."""
         # First, see if the address already exists
         address = store.query(Address).filter_by(email=email.lower()).first()
+        # Only an existing address can have any memberships to relink.
+        existing = address is not None
         if address is None:
             if display_name is None:
                 display_name = ''
@@ -170,6 +178,8 @@ class User(Model):
         if address.user is not None:
             raise AddressAlreadyLinkedError(address)
         address.user = self
+        if existing:
+            notify(AddressLinkEvent(self, address))
         return address
 
     @property
@@ -188,6 +198,7 @@ class User(Model):
         for address in list(user.addresses):
             # Convert these to a list because we'll mutate the result.
             address.user = self
+            notify(AddressLinkEvent(self, address))
         # Merge memberships.
         other_members = store.query(Member).filter(
             Member.user_id == user.id)
@@ -17,14 +17,15 @@
 
 """Base delivery class."""
 
-import copy
 import socket
 import logging
 import smtplib
 
+from email.generator import Generator
+from io import StringIO
 from mailman.config import config
 from mailman.interfaces.mta import IMailTransportAgentDelivery
-from mailman.mta.connection import Connection
+from mailman.mta.connection import PooledConnection, encode_message
 from public import public
 from zope.interface import implementer
 
@@ -32,6 +33,62 @@ from zope.interface import implementer
 log = logging.getLogger('mailman.smtp')
 
 
+def _is_connection_error(error):
+    # Whether the MTA couldn't be connected to, or dropped the connection, as
+    # opposed to answering with an error.  All SMTP errors are socket errors.
+    return (isinstance(error, (smtplib.SMTPConnectError,
+                               smtplib.SMTPServerDisconnected)) or
+            not isinstance(error, smtplib.SMTPException))
+
+
+class _SharingGenerator(Generator):
+    """A generator which flattens the shared subparts of messages only once.
+
+    Each subpart is flattened exactly as a plain generator would flatten it,
+    the first time it is seen, and its text is reused from then on.
+    """
+
+    def __init__(self, outfp, mangle_from_=None, maxheaderlen=None, *,
+                 policy=None, shared=None):
+        super().__init__(outfp, mangle_from_, maxheaderlen, policy=policy)
+        # Maps the ids of the shared subparts to the subpart and its text.
+        self._shared = shared
+
+    def clone(self, fp):
+        clone = super().clone(fp)
+        clone._shared = self._shared
+        return clone
+
+    def flatten(self, msg, unixfrom=False, linesep=None):
+        entry = self._shared.get(id(msg))
+        if unixfrom or entry is None or entry[0] is not msg:
+            super().flatten(msg, unixfrom, linesep)
+            return
+        if entry[1] is None:
+            fp = self._fp
+            self._fp = StringIO()
+            try:
+                super().flatten(msg, unixfrom, linesep)
+                entry[1] = self._fp.getvalue()
+            finally:
+                self._fp = fp
+        self.write(entry[1])
+
+
+def _copy_outer(msg):
+    """Copy a message, sharing its subparts with the original.
+
+    Only the outer message's headers and list of subparts are copied, so
+    the copy's headers and payload can be changed, but not its subparts.
+    """
+    message_copy = msg.__class__.__new__(msg.__class__)
+    message_copy.__dict__.update(msg.__dict__)
+    message_copy._headers = list(msg._headers)
+    if isinstance(msg._payload, list):
+        message_copy._payload = list(msg._payload)
+    return message_copy
+
+
 @public
 @implementer(IMailTransportAgentDelivery)
 class BaseDelivery:
@@ -41,10 +98,32 @@ class BaseDelivery:
         """Create a basic deliverer."""
         username = (config.mta.smtp_user if config.mta.smtp_user else None)
         password = (config.mta.smtp_pass if config.mta.smtp_pass else None)
-        self._connection = Connection(
+        self._connection = PooledConnection(
             config.mta.smtp_host, int(config.mta.smtp_port),
             int(config.mta.max_sessions_per_connection),
             username, password)
+        # The last message flattened for sending, and its bytes.
+        self._flattened = None
+        # The recipients which weren't delivered to because the MTA couldn't
+        # be connected to, or dropped the connection.
+        self.connection_failures = set()
+
+    def _flatten(self, msg):
+        """Return the bytes of a message as they are sent to the MTA.
+
+        A message delivered in several chunks is only flattened and encoded
+        for the first of them, so it must not be changed in between.
+
+        :param msg: The message being delivered.
+        :type msg: `Message`
+        :return: The encoded message.
+        :rtype: bytes
+        """
+        flattened = self._flattened
+        if flattened is None or flattened[0] is not msg:
+            flattened = (msg, encode_message(msg.as_string()))
+            self._flattened = flattened
+        return flattened[1]
 
     def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
         """Low-level delivery to a set of recipients.
@@ -67,7 +146,7 @@ class BaseDelivery:
         # email address for predictability and testability.
         try:
             refused = self._connection.sendmail(
-                sender, sorted(recipients), msg.as_string())
+                sender, sorted(recipients), self._flatten(msg))
         except smtplib.SMTPRecipientsRefused as error:
             log.error('%s recipients refused: %s', message_id, error)
             refused = error.recipients
@@ -77,17 +156,21 @@ class BaseDelivery:
                 # recipient -> (code, error)
                 (recipient, (error.smtp_code, error.smtp_error))
                 for recipient in recipients)
+            if _is_connection_error(error):
+                self.connection_failures.update(recipients)
         except (socket.error, IOError, smtplib.SMTPException) as error:
             # MTA not responding, or other socket problems, or any other
             # kind of SMTPException.  In that case, nothing got delivered,
             # so treat this as a temporary failure.  We use error code 444
             # for this (temporary, unspecified failure, cf RFC 5321).
             log.error('%s low level smtp error: %s', message_id, error)
-            error = str(error)
+            reason = str(error)
             refused = dict(
                 # recipient -> (code, error)
-                (recipient, (444, error))
+                (recipient, (444, reason))
                 for recipient in recipients)
+            if _is_connection_error(error):
+                self.connection_failures.update(recipients)
         return refused
 
     def _get_sender(self, mlist, msg, msgdata):
@@ -133,6 +216,28 @@ class IndividualDelivery(BaseDelivery):
         """See `BaseDelivery`."""
         super().__init__()
         self.callbacks = []
+        # The subparts shared by the recipients' copies of the message being
+        # delivered.
+        self._shared = {}
+
+    def _flatten(self, msg):
+        """See `BaseDelivery`.
+
+        The subparts shared with the original message are flattened once, for
+        the first recipient.
+        """
+        if len(self._shared) == 0:
+            return super()._flatten(msg)
+        fp = StringIO()
+        generator = _SharingGenerator(
+            fp, mangle_from_=False, maxheaderlen=0, policy=msg.policy,
+            shared=self._shared)
+        try:
+            generator.flatten(msg)
+        except (KeyError, LookupError, UnicodeEncodeError):
+            # Let the message work around these.
+            return super()._flatten(msg)
+        return encode_message(fp.getvalue())
 
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`.
@@ -143,25 +248,36 @@ class IndividualDelivery(BaseDelivery):
         """
         refused = {}
         recipients = msgdata.get('recipients', set())
-        for recipient in recipients:
-            log.debug('IndividualDelivery to: %s', recipient)
-            # Make a copy of the original messages and operator on it, since
-            # we're going to munge it repeatedly for each recipient.
-            message_copy = copy.deepcopy(msg)
-            msgdata_copy = msgdata.copy()
-            # Squirrel the current recipient away in the message metadata.
-            # That way the subclass's _get_sender() override can encode the
-            # recipient address in the sender, e.g. for VERP.
-            msgdata_copy['recipient'] = recipient
-            # See if the recipient is a member of the mailing list, and if so,
-            # squirrel this information away for use by other modules, such as
-            # the header/footer decorator.  XXX 2012-03-05 this is probably
-            # highly inefficient on the database.
-            member = mlist.members.get_member(recipient)
-            msgdata_copy['member'] = member
-            for callback in self.callbacks:
-                callback(mlist, message_copy, msgdata_copy)
-            status = self._deliver_to_recipients(
-                mlist, message_copy, msgdata_copy, [recipient])
-            refused.update(status)
+        # The callbacks only change the outer message, i.e. its headers and
+        # its payload, so every recipient's copy of the message shares the
+        # subparts of the original, and they are flattened only once.  Walking
+        # the message also fully parses it, so that the copies don't.
+        self._shared = {id(part): [part, None]
+                        for part in msg.walk()
+                        if part is not msg}
+        # Look up the members for all the recipients at once, along with their
+        # addresses, users and preferences, for use by other modules, such as
+        # the header/footer decorator.
+        members = mlist.members.get_members(recipients)
+        try:
+            for recipient in recipients:
+                log.debug('IndividualDelivery to: %s', recipient)
+                # Make a copy of the original message and operate on it, since
+                # we're going to munge it repeatedly for each recipient.
+                message_copy = _copy_outer(msg)
+                msgdata_copy = msgdata.copy()
+                # Squirrel the current recipient away in the message metadata.
+                # That way the subclass's _get_sender() override can encode
+                # the recipient address in the sender, e.g. for VERP.
+                msgdata_copy['recipient'] = recipient
+                # If the recipient is a member of the mailing list, squirrel
+                # this information away too.
+                msgdata_copy['member'] = members[recipient]
+                for callback in self.callbacks:
+                    callback(mlist, message_copy, msgdata_copy)
+                status = self._deliver_to_recipients(
+                    mlist, message_copy, msgdata_copy, [recipient])
+                refused.update(status)
+        finally:
+            self._shared = {}
         return refused
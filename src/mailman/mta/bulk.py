@@ -17,6 +17,10 @@
 
 """Bulk message delivery."""
 
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import chain, islice
 from mailman.mta.base import BaseDelivery
 from mailman.mta.decorating import DecoratingMixin
 from public import public
@@ -35,22 +39,35 @@ CHUNKMAP = dict(
     )
 
 
+def _bucket(address):
+    localpart, at, domain = address.partition('@')
+    domain_parts = domain.split('.')
+    return CHUNKMAP.get(domain_parts[-1], 0)
+
+
 @public
 class BulkDelivery(BaseDelivery, DecoratingMixin):
     """Deliver messages to the MSA in as few sessions as possible."""
 
-    def __init__(self, max_recipients=None):
+    def __init__(self, max_recipients=None, max_threads=None):
         """See `BaseDelivery`.
 
         :param max_recipients: The maximum number of recipients per delivery
             chunk.  None, zero or less means to group all recipients into one
             big chunk.
         :type max_recipients: integer
+        :param max_threads: The maximum number of chunks to deliver at the
+            same time, each in its own thread and over its own connection.
+            None, one or less means to deliver the chunks one after another.
+        :type max_threads: integer
         """
         super().__init__()
         self._max_recipients = (max_recipients
                                 if max_recipients is not None
                                 else 0)
+        self._max_threads = (max_threads
+                             if max_threads is not None
+                             else 0)
 
     def chunkify(self, recipients):
         """Split a set of recipients into chunks.
@@ -58,12 +75,16 @@ class BulkDelivery(BaseDelivery, DecoratingMixin):
         The `max_recipients` argument given to the constructor specifies the
         maximum number of recipients in each chunk.
 
+        The recipients are read once to count them, and once more for each
+        top-level domain bucket, so that only one chunk at a time is held in
+        memory.
+
         :param recipients: The set of recipient email addresses
         :type recipients: sequence of email address strings
-        :return: A list of chunks, where each chunk is a set containing no
-            more than `max_recipients` number of addresses.  The chunk can
-            contain fewer, and no packing is guaranteed.
-        :rtype: list of sets of strings
+        :return: An iterator over the chunks, where each chunk is a set
+            containing no more than `max_recipients` number of addresses.  The
+            chunk can contain fewer, and no packing is guaranteed.
+        :rtype: iterator of sets of strings
         """
         if self._max_recipients <= 0:
             yield set(recipients)
@@ -72,27 +93,21 @@ class BulkDelivery(BaseDelivery, DecoratingMixin):
         # by splitting the recipient addresses into top-level domain buckets,
         # using the "most common" domains.  Everything else ends up in the
         # zeroth bucket.
-        by_bucket = {}
-        for address in recipients:
-            localpart, at, domain = address.partition('@')
-            domain_parts = domain.split('.')
-            bucket_number = CHUNKMAP.get(domain_parts[-1], 0)
-            by_bucket.setdefault(bucket_number, set()).add(address)
-        # Fill chunks by sorting the tld values by length.
-        chunk = set()
-        for tld_chunk in sorted(by_bucket.values(), key=len, reverse=True):
-            while tld_chunk:
-                chunk.add(tld_chunk.pop())
+        sizes = Counter(_bucket(address) for address in recipients)
+        # Fill chunks by sorting the buckets by size.  Every bucket starts a
+        # new chunk.
+        for bucket_number, size in sorted(
+                sizes.items(), key=lambda item: item[1], reverse=True):
+            chunk = set()
+            for address in recipients:
+                if _bucket(address) != bucket_number:
+                    continue
+                chunk.add(address)
                 if len(chunk) == self._max_recipients:
                     yield chunk
                     chunk = set()
-            # Every tld bucket starts a new chunk, but only if non-empty
             if len(chunk) > 0:
                 yield chunk
-                chunk = set()
-        # Be sure to include the last chunk, but only if it's non-empty.
-        if len(chunk) > 0:
-            yield chunk
 
     def deliver(self, mlist, msg, msgdata):
         """See `IMailTransportAgentDelivery`."""
@@ -100,9 +115,34 @@ class BulkDelivery(BaseDelivery, DecoratingMixin):
         self.decorate(mlist, msg, msgdata)
         # Only decorate once.
         msgdata['nodecorate'] = True
+        # The chunks are made as they are delivered.  Only the first two are
+        # made up front, to tell whether there's more than one.
+        chunks = self.chunkify(msgdata.get('recipients', set()))
+        first = list(islice(chunks, 2))
+        chunks = chain(first, chunks)
         refused = {}
-        for recipients in self.chunkify(msgdata.get('recipients', set())):
-            chunk_refused = self._deliver_to_recipients(
-                mlist, msg, msgdata, recipients)
-            refused.update(chunk_refused)
+        if self._max_threads > 1 and len(first) > 1:
+            # All the chunks share the message, the metadata and the mailing
+            # list.  Do everything which might change the message, or touch
+            # the database, in this thread before the others start.
+            msgdata = dict(msgdata,
+                           sender=self._get_sender(mlist, msg, msgdata))
+            self._flatten(msg)
+            deliver = partial(self._deliver_to_recipients, mlist, msg, msgdata)
+            with ThreadPoolExecutor(self._max_threads) as executor:
+                # Keep every thread busy, without making all the chunks.
+                pending = set()
+                for recipients in chunks:
+                    if len(pending) >= self._max_threads:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            refused.update(future.result())
+                    pending.add(executor.submit(deliver, recipients))
+                for future in wait(pending).done:
+                    refused.update(future.result())
+        else:
+            for recipients in chunks:
+                refused.update(self._deliver_to_recipients(
+                    mlist, msg, msgdata, recipients))
         return refused
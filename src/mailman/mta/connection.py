@@ -15,19 +15,52 @@
 # You should have received a copy of the GNU General Public License along with
 # GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
 
-"""MTA connections."""
+"""MTA connections.
 
+The connections of a process are pooled.  Deliveries borrow a connection from
+the pool for each SMTP transaction, so a connection, and its authentication,
+outlives the delivery of a single message.
+"""
+
+import re
+import time
 import logging
 import smtplib
+import threading
 
 from contextlib import suppress
-from lazr.config import as_boolean
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from public import public
 
 
 log = logging.getLogger('mailman.smtp')
 
+# Line endings to turn into CRLF, as smtplib does for str messages.
+EOL = re.compile(br'\r\n|\n|\r(?!\n)')
+
+# Idle connections which haven't been used for this many seconds are checked
+# with a NOOP before they are handed out again.
+CHECK_AFTER = 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@public
+def encode_message(msgtext):
+    """Encode message text as it is sent to the SMTP server.
+
+    The SMTP server gets pure ascii with CRLF line endings.  We have seen
+    malformed messages with non-ascii unicodes, so anything else is replaced.
+
+    :param msgtext: The flattened message.
+    :type msgtext: str
+    :return: The message as sent to the SMTP server.
+    :rtype: bytes
+    """
+    return EOL.sub(b'\r\n', msgtext.encode('ascii', 'replace'))
+
 
 @public
 class Connection:
@@ -59,29 +92,42 @@ class Connection:
         self._password = smtp_pass
         self._session_count = None
         self._connection = None
+        # When the connection was last given back to its pool.
+        self.last_used = time.monotonic()
+
+    @property
+    def key(self):
+        """The pool key of connections to the same server as the same user."""
+        return (self._host, self._port, self._sessions_per_connection,
+                self._username, self._password)
 
     def _connect(self):
         """Open a new connection."""
-        self._connection = smtplib.SMTP()
+        connection = smtplib.SMTP()
         log.debug('Connecting to %s:%s', self._host, self._port)
-        self._connection.connect(self._host, self._port)
+        connection.connect(self._host, self._port)
+        # Only keep the connection once it's open, since an SMTP object which
+        # never connected can't be quit or closed.
+        self._connection = connection
         if self._username is not None and self._password is not None:
             log.debug('Logging in')
             self._connection.login(self._username, self._password)
         self._session_count = self._sessions_per_connection
 
     def sendmail(self, envsender, recipients, msgtext):
-        """Mimic `smtplib.SMTP.sendmail`."""
+        """Mimic `smtplib.SMTP.sendmail`.
+
+        The message may be given as the bytes returned by `encode_message()`,
+        so that a message sent many times is only encoded once.
+        """
         if as_boolean(config.devmode.enabled):
             # Force the recipients to the specified address, but still deliver
             # to the same number of recipients.
             recipients = [config.devmode.recipient] * len(recipients)
         if self._connection is None:
             self._connect()
-        # smtplib.SMTP.sendmail requires the message string to be pure ascii.
-        # We have seen malformed messages with non-ascii unicodes, so ensure
-        # we have pure ascii.
-        msgtext = msgtext.encode('ascii', 'replace').decode('ascii')
+        if isinstance(msgtext, str):
+            msgtext = encode_message(msgtext)
         try:
             log.debug('envsender: %s, recipients: %s, size(msgtext): %s',
                       envsender, recipients, len(msgtext))
@@ -100,10 +146,202 @@ class Connection:
             self.quit()
         return results
 
+    def check(self):
+        """Close the connection unless the SMTP server still answers it.
+
+        A closed connection is opened again by the next `sendmail()`.
+        """
+        if self._connection is None:
+            return
+        try:
+            code, response = self._connection.noop()
+        except (smtplib.SMTPException, OSError):
+            code = None
+        if code != 250:
+            log.debug('Dropping stale connection to %s:%s',
+                      self._host, self._port)
+            self.quit()
+
     def quit(self):
         """Mimic `smtplib.SMTP.quit`."""
-        if self._connection is None:
+        connection, self._connection = self._connection, None
+        if connection is None:
             return
-        with suppress(smtplib.SMTPException):
-            self._connection.quit()
-        self._connection = None
+        try:
+            with suppress(smtplib.SMTPException, OSError):
+                connection.quit()
+        finally:
+            # quit() closes the connection unless it failed.
+            if getattr(connection, 'sock', None) is not None:
+                with suppress(OSError):
+                    connection.close()
+
+
+@public
+class ConnectionPool:
+    """A pool of connections to SMTP servers."""
+
+    def __init__(self, max_connections=0, idle_timeout=0):
+        """Create a connection pool.
+
+        :param max_connections: The maximum number of connections, in use or
+            idle, in the pool.  Borrowers wait for a connection to be given
+            back when there are this many.  Zero means there is no limit.
+        :type max_connections: int
+        :param idle_timeout: The number of seconds an idle connection is kept
+            open.  Zero means connections are closed as soon as they are given
+            back.
+        :type idle_timeout: float
+        """
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        # Idle connections by key, the most recently used last.
+        self._idle = {}
+        # All the connections, in use or idle.
+        self._count = 0
+
+    def _pop_expired(self, now):
+        # Called with the lock held.
+        expired = []
+        for key, idle in list(self._idle.items()):
+            while (len(idle) > 0 and
+                   now - idle[0].last_used > self.idle_timeout):
+                expired.append(idle.pop(0))
+            if len(idle) == 0:
+                del self._idle[key]
+        self._count -= len(expired)
+        return expired
+
+    def _pop_oldest(self):
+        # Called with the lock held.
+        if len(self._idle) == 0:
+            return None
+        key = min(self._idle, key=lambda key: self._idle[key][0].last_used)
+        idle = self._idle[key]
+        connection = idle.pop(0)
+        if len(idle) == 0:
+            del self._idle[key]
+        self._count -= 1
+        return connection
+
+    def acquire(self, host, port, sessions_per_connection,
+                smtp_user=None, smtp_pass=None):
+        """Borrow a connection from the pool.
+
+        Arguments are as for `Connection`.  The connection must be given back
+        with `release()`.
+
+        :return: An idle connection with the same arguments if there is one,
+            otherwise a new connection.
+        :rtype: `Connection`
+        """
+        key = (host, port, sessions_per_connection, smtp_user, smtp_pass)
+        connection = None
+        while connection is None:
+            with self._lock:
+                closing = self._pop_expired(time.monotonic())
+                idle = self._idle.get(key)
+                if idle:
+                    connection = idle.pop()
+                    if len(idle) == 0:
+                        del self._idle[key]
+                elif (self.max_connections <= 0 or
+                        self._count < self.max_connections):
+                    connection = Connection(*key)
+                    self._count += 1
+                else:
+                    # Make room by closing the connection which has been idle
+                    # the longest, or wait for one to be given back.
+                    oldest = self._pop_oldest()
+                    if oldest is None:
+                        self._lock.wait()
+                    else:
+                        closing.append(oldest)
+            for stale in closing:
+                stale.quit()
+        if time.monotonic() - connection.last_used > CHECK_AFTER:
+            connection.check()
+        return connection
+
+    def release(self, connection, discard=False):
+        """Give a borrowed connection back to the pool.
+
+        :param connection: The connection.
+        :type connection: `Connection`
+        :param discard: Whether to close the connection instead of keeping it
+            for reuse, e.g. because it failed.
+        :type discard: bool
+        """
+        connection.last_used = time.monotonic()
+        with self._lock:
+            keep = not discard and self.idle_timeout > 0
+            if keep:
+                self._idle.setdefault(connection.key, []).append(connection)
+            else:
+                self._count -= 1
+            self._lock.notify()
+        if not keep:
+            connection.quit()
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            closing = [connection
+                       for idle in self._idle.values()
+                       for connection in idle]
+            self._idle.clear()
+            self._count -= len(closing)
+            self._lock.notify_all()
+        for connection in closing:
+            connection.quit()
+
+
+@public
+def get_connection_pool():
+    """Return this process's connection pool, creating it on first use.
+
+    :return: The pool.
+    :rtype: `ConnectionPool`
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            idle_timeout = as_timedelta(config.mta.connection_idle_timeout)
+            _pool = ConnectionPool(int(config.mta.max_connections),
+                                   idle_timeout.total_seconds())
+        return _pool
+
+
+@public
+class PooledConnection:
+    """A connection borrowed from this process's pool for every session.
+
+    This mimics `Connection`.
+    """
+
+    def __init__(self, host, port, sessions_per_connection,
+                 smtp_user=None, smtp_pass=None):
+        """Arguments are as for `Connection`."""
+        self._key = (host, port, sessions_per_connection,
+                     smtp_user, smtp_pass)
+
+    def sendmail(self, envsender, recipients, msgtext):
+        """Mimic `smtplib.SMTP.sendmail`."""
+        pool = get_connection_pool()
+        connection = pool.acquire(*self._key)
+        failed = True
+        try:
+            results = connection.sendmail(envsender, recipients, msgtext)
+            failed = False
+        finally:
+            # Don't reuse a connection which may be broken.
+            pool.release(connection, discard=failed)
+        return results
+
+    def quit(self):
+        """Mimic `smtplib.SMTP.quit`.
+
+        Connections are closed by the pool when they have been idle for too
+        long.
+        """
@@ -74,7 +74,8 @@ def deliver(mlist, msg, msgdata):
     elif mlist.personalize != Personalization.none:
         agent = Deliver()
     else:
-        agent = BulkDelivery(int(config.mta.max_recipients))
+        agent = BulkDelivery(int(config.mta.max_recipients),
+                             int(config.mta.max_delivery_threads))
     log.debug('Using agent: %s', agent)
     # Keep track of the original recipients and the original sender for
     # logging purposes.
@@ -148,4 +149,8 @@ def deliver(mlist, msg, msgdata):
             log.info('%s', expand(template, mlist, substitutions))
     # Return the results
     if temporary_failures or permanent_failures:
-        raise SomeRecipientsFailed(temporary_failures, permanent_failures)
+        connection_failures = [
+            recipient for recipient in temporary_failures
+            if recipient in agent.connection_failures]
+        raise SomeRecipientsFailed(
+            temporary_failures, permanent_failures, connection_failures)
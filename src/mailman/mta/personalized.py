@@ -46,8 +46,14 @@ class PersonalizedMixin:
         if mlist.personalize != Personalization.full:
             return
         recipient = msgdata['recipient']
-        user_manager = getUtility(IUserManager)
-        user = user_manager.get_user(recipient)
+        member = msgdata.get('member')
+        if member is not None and member.address.email == recipient.lower():
+            # The member was looked up along with its user, so there's no
+            # need to ask the database again.
+            user = member.user
+        else:
+            user_manager = getUtility(IUserManager)
+            user = user_manager.get_user(recipient)
         if user is None:
             msg.replace_header('To', recipient)
         else:
@@ -17,10 +17,15 @@
 
 """Test MTA connections."""
 
+import time
+import socket
 import unittest
+import threading
 
 from mailman.config import config
-from mailman.mta.connection import Connection
+from mailman.mta.connection import (
+    Connection, ConnectionPool, PooledConnection, encode_message,
+    get_connection_pool)
 from mailman.testing.layers import SMTPLayer
 from smtplib import SMTP, SMTPAuthenticationError
 
@@ -58,6 +63,19 @@ Subject: aardvarks
         self.assertEqual(self.layer.smtpd.get_authentication_credentials(),
                          'AHRlc3R1c2VyAHRlc3RwYXNz')
 
+    def test_connection_refused(self):
+        # A connection the MTA refused is not kept, and the refusal is not
+        # hidden by closing it.
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        connection = Connection('localhost', port, 0)
+        with self.assertRaises(ConnectionRefusedError):
+            connection.sendmail(
+                'anne@example.com', ['bart@example.com'], 'Subject: x\n\n')
+        self.assertIsNone(connection._connection)
+        connection.quit()
+
 
 class TestConnectionCount(unittest.TestCase):
     layer = SMTPLayer
@@ -102,3 +120,139 @@ Subject: aardvarks
         client.connect(config.mta.smtp_host, int(config.mta.smtp_port))
         client.docmd('RSET')
         self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 0)
+
+
+class TestConnectionPool(unittest.TestCase):
+    layer = SMTPLayer
+
+    def setUp(self):
+        self.key = (config.mta.smtp_host, int(config.mta.smtp_port), 0)
+        self.msg_text = """\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks
+
+"""
+
+    def _pool(self, max_connections=0, idle_timeout=60):
+        pool = ConnectionPool(max_connections, idle_timeout)
+        self.addCleanup(pool.close)
+        return pool
+
+    def _send(self, pool, key=None):
+        connection = pool.acquire(*(self.key if key is None else key))
+        connection.sendmail(
+            'anne@example.com', ['bart@example.com'], self.msg_text)
+        pool.release(connection)
+        return connection
+
+    def test_reuse(self):
+        pool = self._pool()
+        first = self._send(pool)
+        second = self._send(pool)
+        self.assertIs(first, second)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+
+    def test_different_servers(self):
+        pool = self._pool()
+        first = self._send(pool)
+        second = self._send(pool, self.key + ('testuser', 'testpass'))
+        self.assertEqual(SMTPLayer.smtpd.get_authentication_credentials(),
+                         'AHRlc3R1c2VyAHRlc3RwYXNz')
+        self.assertIsNot(first, second)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_no_idle_timeout(self):
+        pool = self._pool(idle_timeout=0)
+        self._send(pool)
+        self._send(pool)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_idle_timeout(self):
+        pool = self._pool(idle_timeout=0.01)
+        first = self._send(pool)
+        time.sleep(0.05)
+        second = self._send(pool)
+        self.assertIsNot(first, second)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_stale_connection(self):
+        # A connection the server has dropped is noticed before it is used.
+        pool = self._pool()
+        connection = self._send(pool)
+        connection._connection.sock.shutdown(socket.SHUT_RDWR)
+        connection.last_used -= 10
+        self.assertIs(self._send(pool), connection)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_max_sessions_per_connection(self):
+        pool = self._pool()
+        key = self.key[:2] + (2,)
+        for i in range(4):
+            self._send(pool, key)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_discard(self):
+        pool = self._pool()
+        first = pool.acquire(*self.key)
+        pool.release(first, discard=True)
+        self.assertIsNot(pool.acquire(*self.key), first)
+
+    def test_max_connections(self):
+        # Borrowers wait for a connection to be given back.
+        pool = self._pool(max_connections=1)
+        first = pool.acquire(*self.key)
+        borrowed = []
+        thread = threading.Thread(
+            target=lambda: borrowed.append(pool.acquire(*self.key)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(borrowed, [])
+        pool.release(first)
+        thread.join()
+        self.assertEqual(borrowed, [first])
+
+    def test_max_connections_closes_idle(self):
+        # An idle connection to another server makes room for a new one.
+        pool = self._pool(max_connections=1)
+        first = self._send(pool)
+        self._send(pool, self.key + ('testuser', 'testpass'))
+        self.assertEqual(SMTPLayer.smtpd.get_authentication_credentials(),
+                         'AHRlc3R1c2VyAHRlc3RwYXNz')
+        self.assertIsNone(first._connection)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 2)
+
+    def test_pooled_connection(self):
+        # Deliveries share the connections of the process's pool.
+        for i in range(2):
+            connection = PooledConnection(*self.key)
+            connection.sendmail(
+                'anne@example.com', ['bart@example.com'], self.msg_text)
+        self.assertEqual(SMTPLayer.smtpd.get_connection_count(), 1)
+        get_connection_pool().close()
+        self.assertEqual(get_connection_pool()._count, 0)
+
+
+class TestEncodeMessage(unittest.TestCase):
+    layer = SMTPLayer
+
+    def test_encode_message(self):
+        self.assertEqual(encode_message('a\nb\rc\r\nd \u00e9\n'),
+                         b'a\r\nb\r\nc\r\nd ?\r\n')
+
+    def test_send_bytes(self):
+        connection = Connection(
+            config.mta.smtp_host, int(config.mta.smtp_port), 0)
+        self.addCleanup(connection.quit)
+        connection.sendmail('anne@example.com', ['bart@example.com'],
+                            encode_message("""\
+From: anne@example.com
+To: bart@example.com
+Subject: aardvarks \u00e9
+
+Hello
+"""))
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['subject'], 'aardvarks ?')
+        self.assertEqual(messages[0].get_payload().rstrip(), 'Hello')
@@ -18,19 +18,27 @@
 """Test various aspects of email delivery."""
 
 import os
+import re
+import copy
 import shutil
+import smtplib
 import tempfile
 import unittest
+import threading
 
 from mailman.app.lifecycle import create_list
 from mailman.config import config
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.template import ITemplateManager
+from mailman.interfaces.usermanager import IUserManager
 from mailman.mta.bulk import BulkDelivery
+from mailman.mta.connection import encode_message
 from mailman.mta.deliver import Deliver
 from mailman.testing.helpers import (
     specialized_message_from_string as mfs, subscribe)
-from mailman.testing.layers import ConfigLayer
+from mailman.testing.layers import ConfigLayer, SMTPLayer
+from sqlalchemy import event
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -57,6 +65,15 @@ class BulkDeliverTester(BulkDelivery):
         return []
 
 
+# Refuse recipients whose names start with b, recording the delivery threads.
+class RefusingBulkDeliverTester(BulkDelivery):
+    def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
+        _deliveries.append((threading.current_thread(), msgdata, recipients))
+        return {recipient: (550, b'Refused')
+                for recipient in recipients
+                if recipient.startswith('b')}
+
+
 class TestIndividualDelivery(unittest.TestCase):
     """Test personalized delivery details."""
 
@@ -114,6 +131,59 @@ name     : $user_name
         member = _msgdata.get('member')
         self.assertEqual(member, self._anne)
 
+    def test_members_looked_up_at_once(self):
+        # The members, addresses and users of all the recipients are looked
+        # up together, not one recipient at a time.
+        self._mlist.personalize = Personalization.full
+        user_manager = getUtility(IUserManager)
+        recipients = ['anne@example.org']
+        for i in range(10):
+            email = 'person{}@example.org'.format(i)
+            if i % 2 == 0:
+                # Subscribed with their preferred address.
+                subscribe(self._mlist, 'Person{}'.format(i), email=email)
+            else:
+                # Subscribed with an explicit address.
+                address = user_manager.create_address(email, 'A Person')
+                self._mlist.subscribe(address)
+            recipients.append(email)
+        # Not a member.
+        recipients.append('cris@example.org')
+        config.db.commit()
+        statements = []
+
+        def record(connection, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(config.db.engine, 'before_cursor_execute', record)
+        try:
+            DeliverTester().deliver(
+                self._mlist, self._msg, dict(recipients=recipients))
+        finally:
+            event.remove(config.db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(_deliveries), 12)
+        members = {msgdata['recipient']: msgdata['member']
+                   for mlist, msg, msgdata, recipients in _deliveries}
+        self.assertEqual(members['anne@example.org'], self._anne)
+        self.assertEqual(members['person1@example.org'].address.email,
+                         'person1@example.org')
+        self.assertEqual(members['person2@example.org'].user.display_name,
+                         'Person2 Person')
+        self.assertIsNone(members['cris@example.org'])
+        # The To headers are personalized.
+        to = {msgdata['recipient']: msg['to']
+              for mlist, msg, msgdata, recipients in _deliveries}
+        self.assertEqual(to['person2@example.org'],
+                         'Person2 Person <person2@example.org>')
+        self.assertEqual(to['person1@example.org'], 'person1@example.org')
+        self.assertEqual(to['cris@example.org'], 'cris@example.org')
+        # There's one query for the explicit address memberships and one for
+        # the preferred address memberships, and only the nonmember needs
+        # another look up.
+        lookups = [statement for statement in statements
+                   if re.search(r'FROM (member|address|"user"|user)\b',
+                                statement)]
+        self.assertEqual(len(lookups), 3)
+
     def test_decoration(self):
         msgdata = dict(recipients=['anne@example.org'])
         agent = DeliverTester()
@@ -200,3 +270,285 @@ list: Test
 Footer
 
 """)
+
+    def test_concurrent_chunks(self):
+        # With more than one delivery thread, the chunks are delivered in
+        # parallel and their refusals are merged.
+        recipients = ['{}{}@example.com'.format(name, i)
+                      for name in ('anne', 'bart')
+                      for i in range(5)]
+        msgdata = dict(recipients=recipients)
+        agent = RefusingBulkDeliverTester(2, 3)
+        refused = agent.deliver(self._mlist, self._msg, msgdata)
+        self.assertEqual(sorted(refused), recipients[5:])
+        self.assertEqual(len(_deliveries), 5)
+        delivered = set()
+        for thread, _msgdata, _recipients in _deliveries:
+            self.assertIsNot(thread, threading.current_thread())
+            # The envelope sender was worked out before the threads started.
+            self.assertEqual(_msgdata['sender'], 'test-bounces@example.com')
+            delivered.update(_recipients)
+        self.assertEqual(delivered, set(recipients))
+        self.assertNotIn('sender', msgdata)
+
+    def test_chunks_are_streamed(self):
+        # The chunks are made as they are delivered, not all up front.
+        recipients = ['anne{}@example.com'.format(i) for i in range(10)]
+        agent = RefusingBulkDeliverTester(2, 1)
+        made = []
+        chunkify = agent.chunkify
+
+        def counting_chunkify(recipients):
+            for chunk in chunkify(recipients):
+                made.append(chunk)
+                yield chunk
+        agent.chunkify = counting_chunkify
+        deliver = agent._deliver_to_recipients
+        made_before = []
+
+        def counting_deliver(mlist, msg, msgdata, recipients):
+            made_before.append(len(made))
+            return deliver(mlist, msg, msgdata, recipients)
+        agent._deliver_to_recipients = counting_deliver
+        agent.deliver(self._mlist, self._msg, dict(recipients=recipients))
+        self.assertEqual(made_before, [2, 2, 3, 4, 5])
+
+    def test_one_thread(self):
+        msgdata = dict(recipients=['anne@example.com', 'bart@example.com'])
+        agent = RefusingBulkDeliverTester(1, 1)
+        refused = agent.deliver(self._mlist, self._msg, msgdata)
+        self.assertEqual(list(refused), ['bart@example.com'])
+        self.assertEqual(
+            [thread for thread, _msgdata, _recipients in _deliveries],
+            [threading.current_thread()] * 2)
+
+
+class TestFlattening(unittest.TestCase):
+    """Test that messages are flattened once."""
+
+    layer = SMTPLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+
+""")
+
+    def test_flatten_once_for_all_chunks(self):
+        recipients = ['anne@example.com', 'bart@example.org',
+                      'cate@example.net']
+        msgdata = dict(recipients=recipients, nodecorate=True)
+        agent = BulkDelivery(1)
+        with patch.object(self._msg, 'as_string',
+                          wraps=self._msg.as_string) as as_string:
+            refused = agent.deliver(self._mlist, self._msg, msgdata)
+        self.assertEqual(refused, {})
+        self.assertEqual(as_string.call_count, 1)
+        messages = list(SMTPLayer.smtpd.messages)
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(
+            sorted(message['x-rcptto'] for message in messages), recipients)
+
+
+class TestConnectionFailures(unittest.TestCase):
+    """Test which delivery errors count as connection failures."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Message-ID: <ant>
+
+""")
+        self._agent = BulkDelivery(1)
+
+    def _deliver(self, error):
+        msgdata = dict(recipients=['anne@example.com'], nodecorate=True)
+        with patch.object(self._agent, '_connection') as connection:
+            connection.sendmail.side_effect = error
+            return self._agent.deliver(self._mlist, self._msg, msgdata)
+
+    def test_dropped_connection(self):
+        refused = self._deliver(smtplib.SMTPServerDisconnected('Gone'))
+        self.assertEqual(refused, {'anne@example.com': (444, 'Gone')})
+        self.assertEqual(
+            self._agent.connection_failures, {'anne@example.com'})
+
+    def test_other_smtp_error(self):
+        # SMTP errors which aren't about the connection don't count, even
+        # though nothing got delivered.
+        refused = self._deliver(smtplib.SMTPNotSupportedError('No SMTPUTF8'))
+        self.assertEqual(refused, {'anne@example.com': (444, 'No SMTPUTF8')})
+        self.assertEqual(self._agent.connection_failures, set())
+
+
+# Capture the bytes each recipient would be sent.
+class RenderingDeliverTester(Deliver):
+    def _deliver_to_recipients(self, mlist, msg, msgdata, recipients):
+        _deliveries.append((list(recipients)[0], self._flatten(msg)))
+        return {}
+
+
+class TestRendering(unittest.TestCase):
+    """Test that sharing subparts doesn't change what recipients get."""
+
+    layer = ConfigLayer
+    maxDiff = None
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._mlist.personalize = Personalization.full
+        self._recipients = []
+        for name in ('Anne', 'Bart', 'Cris'):
+            email = '{}@example.org'.format(name.lower())
+            subscribe(self._mlist, name, email=email)
+            self._recipients.append(email)
+        del _deliveries[:]
+        self._template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._template_dir)
+        for name, text in (('member-header.txt', 'Hello $user_name'),
+                           ('member-footer.txt', 'Bye $user_address')):
+            path = os.path.join(self._template_dir, 'site', 'en', name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as fp:
+                print(text, file=fp)
+        config.push('templates', """
+        [paths.testing]
+        template_dir: {}
+        """.format(self._template_dir))
+        self.addCleanup(config.pop, 'templates')
+        manager = getUtility(ITemplateManager)
+        manager.set('list:member:regular:header', self._mlist.list_id,
+                    'mailman:///member-header.txt')
+        manager.set('list:member:regular:footer', self._mlist.list_id,
+                    'mailman:///member-footer.txt')
+        # Make the boundaries of new multiparts predictable.
+        patcher = patch('email.generator.Generator._make_boundary',
+                        return_value='===============BOUNDARY==')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        del _deliveries[:]
+
+    def _check(self, text):
+        msg = mfs(text)
+        msgdata = dict(recipients=self._recipients,
+                       verp=True,
+                       **{'add-dup-header': {'bart@example.org': True}})
+        agent = RenderingDeliverTester()
+        # What each recipient got when the whole message was deep copied.
+        expected = []
+        for recipient in self._recipients:
+            message_copy = copy.deepcopy(msg)
+            msgdata_copy = dict(msgdata, recipient=recipient)
+            msgdata_copy['member'] = self._mlist.members.get_member(recipient)
+            for callback in agent.callbacks:
+                callback(self._mlist, message_copy, msgdata_copy)
+            expected.append(
+                (recipient, encode_message(message_copy.as_string())))
+        agent.deliver(self._mlist, msg, msgdata)
+        self.assertEqual(_deliveries, expected)
+        for recipient, rendered in _deliveries:
+            self.assertIn('<{}>'.format(recipient).encode('ascii'), rendered)
+            self.assertIn('Bye {}'.format(recipient).encode('ascii'),
+                          rendered)
+            self.assertEqual(b'X-Mailman-Copy: yes' in rendered,
+                             recipient == 'bart@example.org')
+        # The original message is unchanged.
+        self.assertEqual(msg.as_string(), mfs(text).as_string())
+
+    def test_text_plain(self):
+        self._check("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+
+Some text.
+""")
+
+    def test_multipart_mixed(self):
+        self._check("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="AAA"
+
+--AAA
+Content-Type: text/plain
+
+Some text.
+--AAA
+Content-Type: application/octet-stream
+Content-Transfer-Encoding: base64
+
+AAECAwQFBgcICQ==
+--AAA--
+""")
+
+    def test_wrapped(self):
+        self._check("""\
+From: anne@example.org
+To: test@example.com
+Subject: test
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="AAA"
+
+--AAA
+Content-Type: text/plain
+
+Some text.
+--AAA
+Content-Type: multipart/related; boundary="BBB"
+
+--BBB
+Content-Type: text/html
+
+<p>Some text.</p>
+--BBB
+Content-Type: image/png
+Content-Transfer-Encoding: base64
+
+AAECAwQFBgcICQ==
+--BBB--
+--AAA--
+""")
+
+    def test_subparts_flattened_once(self):
+        msg = mfs("""\
+From: anne@example.org
+To: test@example.com
+Message-ID: <ant>
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="AAA"
+
+--AAA
+Content-Type: text/plain
+
+Some text.
+--AAA--
+""")
+        part = msg.get_payload(0)
+        with patch.object(part, 'get_payload',
+                          wraps=part.get_payload) as get_payload:
+            RenderingDeliverTester().deliver(
+                self._mlist, msg, dict(recipients=self._recipients))
+        self.assertEqual(len(_deliveries), 3)
+        flattened = get_payload.call_count
+        self.assertGreater(flattened, 0)
+        del _deliveries[:]
+        with patch.object(part, 'get_payload',
+                          wraps=part.get_payload) as get_payload:
+            RenderingDeliverTester().deliver(
+                self._mlist, msg, dict(recipients=self._recipients[:1]))
+        self.assertEqual(get_payload.call_count, flattened)
@@ -37,7 +37,9 @@ class TestSystemConfiguration(unittest.TestCase):
         self.assertIn('http_etag', json)
         del json['http_etag']
         self.assertEqual(json, dict(
+            cache_bans='yes',
             cache_life='7d',
+            cache_recipients='no',
             default_language='en',
             email_commands_max_lines='10',
             filtered_messages_are_preservable='no',
@@ -48,6 +50,7 @@ class TestSystemConfiguration(unittest.TestCase):
             pending_request_life='3d',
             post_hook='',
             pre_hook='',
+            runner_start='exec',
             self_link='http://localhost:9001/3.0/system/configuration/mailman',
             sender_headers='from from_ reply-to sender',
             site_owner='noreply@example.com',
@@ -62,8 +65,12 @@ class TestSystemConfiguration(unittest.TestCase):
         del json['http_etag']
         self.assertEqual(json, dict(
             cache_lifetime='7d',
+            error_lifetime='1m',
+            negative_lifetime='1h',
             org_domain_data_url=                                  # noqa: E251
                 'https://publicsuffix.org/list/public_suffix_list.dat',
+            policy_cache_persistent='yes',
+            policy_cache_size='10000',
             resolver_lifetime='5s',
             resolver_timeout='3s',
             self_link='http://localhost:9001/3.0/system/configuration/dmarc',
@@ -19,17 +19,25 @@
 
 import os
 import re
+import json
+import time
+import shutil
+import hashlib
 import logging
+import threading
 import dns.resolver
 
+from collections import OrderedDict
 from dns.exception import DNSException
 from email.utils import parseaddr
-from lazr.config import as_timedelta
+from functools import lru_cache
+from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.i18n import _
 from mailman.interfaces.mailinglist import DMARCMitigateAction
 from mailman.interfaces.rules import IRule
 from mailman.utilities.datetime import now
+from mailman.utilities.filesystem import safe_remove, write_atomically
 from mailman.utilities.protocols import get
 from mailman.utilities.string import wrap
 from pkg_resources import resource_string as resource_bytes
@@ -47,9 +55,14 @@ EMPTYSTRING = ''
 KEEP_LOOKING = object()
 LOCAL_FILE_NAME = 'public_suffix_list.dat'
 
-# Map organizational domain suffix rules to a boolean indicating whether the
-# rule is an exception or not.
-suffix_cache = dict()
+# The number of organizational domains each parsed suffix list remembers.
+MEMO_SIZE = 1024
+
+# The parsed public suffix list, once it has been read.
+suffix_cache = None
+
+# The cache of DMARC policy lookups, once one has been made.
+policy_cache = None
 
 
 def ensure_current_suffix_list():
@@ -103,12 +116,115 @@ def ensure_current_suffix_list():
     return cached_copy_path
 
 
+class _Node:
+    # A label of the suffix list's trie.  The exception flag is None unless a
+    # rule ends at this label.
+    __slots__ = ('children', 'exception')
+
+    def __init__(self):
+        self.children = {}
+        self.exception = None
+
+
+@public
+class SuffixList:
+    """The public suffix list.
+
+    The rules are kept in a trie of their labels, from the top level domain
+    down, so that the rules matching a domain are found by following its
+    labels, including wild cards, instead of trying every rule.  The
+    organizational domains most recently looked up are remembered.
+    """
+
+    def __init__(self, mtime=None):
+        # The modification time of the cached copy the list was read from,
+        # which tells whether the copy has been replaced since.
+        self.mtime = mtime
+        # When to check for a new copy.
+        self.expires = _expires(mtime)
+        self._root = _Node()
+        self.get_organizational_domain = lru_cache(maxsize=MEMO_SIZE)(
+            self._get_organizational_domain)
+
+    def add(self, parts, exception=False):
+        """Add a rule.
+
+        :param parts: The rule's labels, from the top level domain down.
+        :type parts: list of str
+        :param exception: Whether the rule is an exception.
+        :type exception: bool
+        """
+        node = self._root
+        for part in parts:
+            node = node.children.setdefault(part, _Node())
+        node.exception = exception
+
+    def _find(self, key):
+        node = self._root
+        for part in key.split(DOT):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node.exception
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        """Return whether the rule, with reversed labels, is an exception."""
+        exception = self._find(key)
+        if exception is None:
+            raise KeyError(key)
+        return exception
+
+    def _get_organizational_domain(self, domain):
+        parts = domain.lower().split(DOT)
+        parts.reverse()
+        # Follow the domain's labels and the wild cards from the top level
+        # domain down, keeping the length of the longest matching rule.
+        label = 0
+        nodes = [self._root]
+        for depth, part in enumerate(parts, 1):
+            matches = []
+            for node in nodes:
+                for child in (node.children.get(part),
+                              node.children.get('*')):
+                    if child is None:
+                        continue
+                    if child.exception:
+                        # An exception's domain is an organizational domain.
+                        return get_domain(parts, depth - 1)
+                    if child.exception is not None:
+                        label = depth
+                    matches.append(child)
+            if len(matches) == 0:
+                break
+            nodes = matches
+        if label == 0:
+            return get_domain(parts, 1)
+        return get_domain(parts, label)
+
+
+def _expires(mtime):
+    # A fresh copy of the suffix list has its modification time set to when
+    # it expires.  A copy whose modification time has passed is out of date
+    # because it couldn't be refreshed, so don't try again until another
+    # lifetime has passed.
+    if mtime is None:
+        return None
+    timestamp = now().timestamp()
+    if mtime > timestamp:
+        return mtime
+    return timestamp + as_timedelta(
+        config.dmarc.cache_lifetime).total_seconds()
+
+
 def parse_suffix_list(filename=None):
-    # Parse the suffix list into a per process cache.
+    # Parse the suffix list.
     if filename is None:
         filename = ensure_current_suffix_list()
     # At this point the cached copy must exist and is as valid as possible.
-    # Read and return the contents as a UTF-8 string.
+    suffix_list = SuffixList(os.stat(filename).st_mtime)
     with open(filename, 'r', encoding='utf-8') as fp:
         for line in fp:
             if not line.strip() or line.startswith('//'):
@@ -123,8 +239,24 @@ def parse_suffix_list(filename=None):
             else:
                 exception = False
             parts.reverse()
-            key = DOT.join(parts)
-            suffix_cache[key] = exception
+            suffix_list.add(parts, exception)
+    return suffix_list
+
+
+def get_suffix_list():
+    # Return the parsed suffix list, parsing it again only once its cached
+    # copy has been refreshed.
+    global suffix_cache
+    suffix_list = suffix_cache
+    if suffix_list is not None and suffix_list.expires >= now().timestamp():
+        return suffix_list
+    filename = ensure_current_suffix_list()
+    mtime = os.stat(filename).st_mtime
+    if suffix_list is None or mtime != suffix_list.mtime:
+        suffix_list = suffix_cache = parse_suffix_list(filename)
+    else:
+        suffix_list.expires = _expires(mtime)
+    return suffix_list
 
 
 def get_domain(parts, label):
@@ -138,32 +270,250 @@ def get_domain(parts, label):
 def get_organizational_domain(domain):
     # Given a domain name, this returns the corresponding Organizational
     # Domain which may be the same as the input.
-    if len(suffix_cache) == 0:
-        parse_suffix_list()
-    hits = []
-    parts = domain.lower().split('.')
-    parts.reverse()
-    for key in suffix_cache:
-        key_parts = key.split('.')
-        if len(parts) >= len(key_parts):
-            for i in range(len(key_parts) - 1):
-                if parts[i] != key_parts[i] and key_parts[i] != '*':
-                    break
-            else:
-                if (parts[len(key_parts) - 1] == key_parts[-1] or
-                        key_parts[-1] == '*'):
-                    hits.append(key)
-    if not hits:
-        return get_domain(parts, 1)
-    label = 0
-    for key in hits:
-        key_parts = key.split('.')
-        if suffix_cache[key]:
-            # It's an exception.
-            return get_domain(parts, len(key_parts) - 1)
-        if len(key_parts) > label:
-            label = len(key_parts)
-    return get_domain(parts, label)
+    return get_suffix_list().get_organizational_domain(domain)
+
+
+def _make_resolver():
+    resolver = dns.resolver.Resolver()
+    resolver.timeout = as_timedelta(
+        config.dmarc.resolver_timeout).total_seconds()
+    resolver.lifetime = as_timedelta(
+        config.dmarc.resolver_lifetime).total_seconds()
+    return resolver
+
+
+def _negative_ttl(error):
+    # RFC 2308: a negative answer may be cached for the smaller of the TTL
+    # and the minimum field of the zone's SOA record, if the name server
+    # included it.
+    responses = list(error.kwargs.get('responses', {}).values())
+    if 'response' in error.kwargs:
+        responses.append(error.kwargs['response'])
+    ttls = [
+        min(rrset.ttl, rrset[0].minimum)
+        for response in responses
+        for rrset in response.authority
+        if rrset.rdtype == dns.rdatatype.SOA
+        ]
+    if len(ttls) == 0:
+        return as_timedelta(config.dmarc.negative_lifetime).total_seconds()
+    return min(ttls)
+
+
+@public
+class DMARCPolicyCache:
+    """A cache of the DMARC policy records of domains.
+
+    A lookup is cached for as long as the time to live of its DNS records.
+    Lookups finding no records are cached too, as are failed lookups, for a
+    short while.  The least recently used lookups are forgotten first.  Each
+    lookup, except for the failed ones, can also be kept in a file of its
+    own, so that other processes and later runs can use it.  Every time the
+    cache has written as many files as its size, the expired files are
+    removed, and the ones expiring soonest when there are more of them than
+    the cache's size.
+
+    A lookup is None when there is no policy record, so the organizational
+    domain should be looked up next, and True when the lookup failed.
+    Otherwise it is the final name the DMARC domain resolved to and its
+    DMARC records, or None if the name had no TXT records.
+    """
+
+    def __init__(self, size, directory=None, make_resolver=_make_resolver,
+                 clock=time.time):
+        self.size = size
+        self.directory = directory
+        self._make_resolver = make_resolver
+        self._clock = clock
+        self._lock = threading.Lock()
+        # The number of files written since the directory was last pruned.
+        self._writes = 0
+        # Map DMARC domains to the time their lookups expire and the lookups.
+        self._lookups = OrderedDict()
+
+    def _path(self, dmarc_domain):
+        # The domain comes from the message, so it doesn't name the file.
+        digest = hashlib.sha1(dmarc_domain.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def _read(self, dmarc_domain, now):
+        path = self._path(dmarc_domain)
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if data.get('domain') != dmarc_domain:
+            return None
+        if data['expires'] <= now:
+            safe_remove(path)
+            return None
+        return data['expires'], data['lookup']
+
+    def _write(self, dmarc_domain, expires, lookup, now):
+        path = self._path(dmarc_domain)
+        write_atomically(path, json.dumps(dict(
+            domain=dmarc_domain, expires=expires, lookup=lookup)))
+        # The file's modification time is when it expires, so that pruning
+        # doesn't have to read the files.
+        os.utime(path, (expires, expires))
+        # Listing the directory is costly when it holds many files, so it
+        # is only pruned once enough files have been written.
+        with self._lock:
+            self._writes += 1
+            if self._writes < self.size:
+                return
+            self._writes = 0
+        self._prune(now)
+
+    def _prune(self, now):
+        # The domains come from the messages, so the files must not pile up.
+        try:
+            names = [name for name in os.listdir(self.directory)
+                     if name.endswith('.json')]
+        except FileNotFoundError:
+            return
+        if len(names) <= self.size:
+            return
+        files = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                expires = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            files.append((expires, path))
+        files.sort()
+        excess = len(files) - self.size
+        for i, (expires, path) in enumerate(files):
+            if i >= excess and expires > now:
+                break
+            safe_remove(path)
+
+    def _remember(self, dmarc_domain, expires, lookup):
+        with self._lock:
+            self._lookups[dmarc_domain] = (expires, lookup)
+            self._lookups.move_to_end(dmarc_domain)
+            while len(self._lookups) > self.size:
+                self._lookups.popitem(last=False)
+
+    def _query(self, email, dmarc_domain):
+        # Return the lookup, its time to live, and whether it may be kept.
+        resolver = self._make_resolver()
+        try:
+            txt_recs = resolver.query(dmarc_domain, dns.rdatatype.TXT)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as error:
+            return None, _negative_ttl(error), True
+        except (dns.resolver.NoNameservers):
+            elog.error(
+                'DNSException: No Nameservers available for %s (%s).',
+                email, dmarc_domain)
+            # Typically this means a dnssec validation error.  Clients that
+            # don't perform validation *may* successfully see a _dmarc RR
+            # whereas a validating mailman server won't see the _dmarc RR.
+            # We should mitigate this email to be safe.
+            return True, self._error_ttl, False
+        except DNSException as error:
+            elog.error(
+                'DNSException: Unable to query DMARC policy for %s (%s). %s',
+                email, dmarc_domain, error.__doc__)
+            # While we can't be sure what caused the error, there is
+            # potentially a DMARC policy record that we missed and that a
+            # receiver of the mail might see.  Thus, we should err on the side
+            # of caution and mitigate.
+            return True, self._error_ttl, False
+        # Be as robust as possible in parsing the result.
+        results_by_name = {}
+        cnames = {}
+        want_names = set([dmarc_domain + '.'])
+        # Check all the TXT records returned by DNS.  Keep track of the
+        # CNAMEs for checking later on.  Ignore any other non-TXT records.
+        for txt_rec in txt_recs.response.answer:
+            if txt_rec.rdtype == dns.rdatatype.CNAME:
+                cnames[txt_rec.name.to_text()] = (
+                    txt_rec.items[0].target.to_text())
+            if txt_rec.rdtype != dns.rdatatype.TXT:
+                continue
+            result = EMPTYSTRING.join(
+                str(record, encoding='utf-8')
+                for record in txt_rec.items[0].strings)
+            name = txt_rec.name.to_text()
+            results_by_name.setdefault(name, []).append(result)
+        expands = list(want_names)
+        seen = set(expands)
+        while expands:
+            item = expands.pop(0)
+            if item in cnames:
+                if cnames[item] in seen:
+                    # CNAME loop.
+                    continue
+                expands.append(cnames[item])
+                seen.add(cnames[item])
+                want_names.add(cnames[item])
+                want_names.discard(item)
+        assert len(want_names) == 1, (
+            'Error in CNAME processing for {}; want_names != 1.'.format(
+                dmarc_domain))
+        name = want_names.pop()
+        dmarcs = (None
+                  if name not in results_by_name
+                  else [record for record in results_by_name[name]
+                        if record.startswith('v=DMARC1;')])
+        return [name, dmarcs], txt_recs.ttl, True
+
+    @property
+    def _error_ttl(self):
+        return as_timedelta(config.dmarc.error_lifetime).total_seconds()
+
+    def lookup(self, email, dmarc_domain):
+        """Look up the DMARC records of a domain.
+
+        :param email: The email address the lookup is for, to be logged.
+        :type email: str
+        :param dmarc_domain: The _dmarc host name to look up.
+        :type dmarc_domain: str
+        :return: The lookup, as described above.
+        """
+        now = self._clock()
+        with self._lock:
+            cached = self._lookups.get(dmarc_domain)
+            if cached is not None:
+                if cached[0] > now:
+                    self._lookups.move_to_end(dmarc_domain)
+                    return cached[1]
+                del self._lookups[dmarc_domain]
+        if self.directory is not None:
+            cached = self._read(dmarc_domain, now)
+            if cached is not None and cached[0] > now:
+                self._remember(dmarc_domain, *cached)
+                return cached[1]
+        lookup, ttl, keep = self._query(email, dmarc_domain)
+        if ttl > 0 and self.size > 0:
+            expires = now + ttl
+            self._remember(dmarc_domain, expires, lookup)
+            if keep and self.directory is not None:
+                self._write(dmarc_domain, expires, lookup, now)
+        return lookup
+
+    def clear(self):
+        """Forget all the cached lookups, including the kept ones."""
+        with self._lock:
+            self._lookups.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_policy_cache():
+    # Return the DMARC policy cache for the current configuration.
+    global policy_cache
+    size = int(config.dmarc.policy_cache_size)
+    directory = (os.path.join(config.VAR_DIR, 'dmarc')
+                 if as_boolean(config.dmarc.policy_cache_persistent)
+                 else None)
+    cache = policy_cache
+    if cache is None or (cache.size, cache.directory) != (size, directory):
+        cache = policy_cache = DMARCPolicyCache(size, directory)
+    return cache
 
 
 def is_reject_or_quarantine(mlist, email, dmarc_domain, org=False):
@@ -174,104 +524,47 @@ def is_reject_or_quarantine(mlist, email, dmarc_domain, org=False):
     # * True if the DMARC policy is reject or quarantine;
     # * False if is not;
     # * A special sentinel if we should continue looking
-    resolver = dns.resolver.Resolver()
-    resolver.timeout = as_timedelta(
-        config.dmarc.resolver_timeout).total_seconds()
-    resolver.lifetime = as_timedelta(
-        config.dmarc.resolver_lifetime).total_seconds()
-    try:
-        txt_recs = resolver.query(dmarc_domain, dns.rdatatype.TXT)
-    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+    lookup = get_policy_cache().lookup(email, dmarc_domain)
+    if lookup is None:
         return KEEP_LOOKING
-    except (dns.resolver.NoNameservers):
-        elog.error(
-            'DNSException: No Nameservers available for %s (%s).',
-            email, dmarc_domain)
-        # Typically this means a dnssec validation error.  Clients that don't
-        # perform validation *may* successfully see a _dmarc RR whereas a
-        # validating mailman server won't see the _dmarc RR.  We should
-        # mitigate this email to be safe.
+    if lookup is True:
         return True
-    except DNSException as error:
+    name, dmarcs = lookup
+    if dmarcs is None:
+        return False
+    if len(dmarcs) == 0:
+        return KEEP_LOOKING
+    if len(dmarcs) > 1:
         elog.error(
-            'DNSException: Unable to query DMARC policy for %s (%s). %s',
-            email, dmarc_domain, error.__doc__)
-        # While we can't be sure what caused the error, there is potentially
-        # a DMARC policy record that we missed and that a receiver of the mail
-        # might see.  Thus, we should err on the side of caution and mitigate.
-        return True
-    # Be as robust as possible in parsing the result.
-    results_by_name = {}
-    cnames = {}
-    want_names = set([dmarc_domain + '.'])
-    # Check all the TXT records returned by DNS.  Keep track of the CNAMEs for
-    # checking later on.  Ignore any other non-TXT records.
-    for txt_rec in txt_recs.response.answer:
-        if txt_rec.rdtype == dns.rdatatype.CNAME:
-            cnames[txt_rec.name.to_text()] = (
-                txt_rec.items[0].target.to_text())
-        if txt_rec.rdtype != dns.rdatatype.TXT:
-            continue
-        result = EMPTYSTRING.join(
-            str(record, encoding='utf-8')
-            for record in txt_rec.items[0].strings)
-        name = txt_rec.name.to_text()
-        results_by_name.setdefault(name, []).append(result)
-    expands = list(want_names)
-    seen = set(expands)
-    while expands:
-        item = expands.pop(0)
-        if item in cnames:
-            if cnames[item] in seen:
-                # CNAME loop.
-                continue
-            expands.append(cnames[item])
-            seen.add(cnames[item])
-            want_names.add(cnames[item])
-            want_names.discard(item)
-    assert len(want_names) == 1, (
-        'Error in CNAME processing for {}; want_names != 1.'.format(
-            dmarc_domain))
-    for name in want_names:
-        if name not in results_by_name:
-            continue
-        dmarcs = [
-            record for record in results_by_name[name]
-            if record.startswith('v=DMARC1;')
-            ]
-        if len(dmarcs) == 0:
-            return KEEP_LOOKING
-        if len(dmarcs) > 1:
-            elog.error(
-                'RRset of TXT records for %s has %d v=DMARC1 entries; '
-                'testing them all',
-                dmarc_domain, len(dmarcs))
-        for entry in dmarcs:
-            mo = re.search(r'\bsp=(\w*)\b', entry, re.IGNORECASE)
-            if org and mo:
+            'RRset of TXT records for %s has %d v=DMARC1 entries; '
+            'testing them all',
+            dmarc_domain, len(dmarcs))
+    for entry in dmarcs:
+        mo = re.search(r'\bsp=(\w*)\b', entry, re.IGNORECASE)
+        if org and mo:
+            policy = mo.group(1).lower()
+        else:
+            mo = re.search(r'\bp=(\w*)\b', entry, re.IGNORECASE)
+            if mo:
                 policy = mo.group(1).lower()
             else:
-                mo = re.search(r'\bp=(\w*)\b', entry, re.IGNORECASE)
-                if mo:
-                    policy = mo.group(1).lower()
-                else:
-                    # This continue does actually get covered by
-                    # TestDMARCRules.test_domain_with_subdomain_policy() and
-                    # TestDMARCRules.test_no_policy() but because of
-                    # Coverage BitBucket issue #198 and
-                    # http://bugs.python.org/issue2506 coverage cannot report
-                    # it as such, so just pragma it away.
-                    continue                        # pragma: missed
-            if policy in ('reject', 'quarantine'):
-                vlog.info(
-                    '%s: DMARC lookup for %s (%s) found p=%s in %s = %s',
-                    mlist.list_name,
-                    email,
-                    dmarc_domain,
-                    policy,
-                    name,
-                    entry)
-                return True
+                # This continue does actually get covered by
+                # TestDMARCRules.test_domain_with_subdomain_policy() and
+                # TestDMARCRules.test_no_policy() but because of
+                # Coverage BitBucket issue #198 and
+                # http://bugs.python.org/issue2506 coverage cannot report
+                # it as such, so just pragma it away.
+                continue                            # pragma: missed
+        if policy in ('reject', 'quarantine'):
+            vlog.info(
+                '%s: DMARC lookup for %s (%s) found p=%s in %s = %s',
+                mlist.list_name,
+                email,
+                dmarc_domain,
+                policy,
+                name,
+                entry)
+            return True
     return False
 
 
@@ -18,6 +18,7 @@
 """Tests and mocks for DMARC rule."""
 
 import os
+import shutil
 import threading
 
 from contextlib import ExitStack
@@ -25,6 +26,7 @@ from datetime import timedelta
 from dns.exception import DNSException
 from dns.rdatatype import CNAME, TXT
 from dns.resolver import NXDOMAIN, NoAnswer, NoNameservers
+from dns.rrset import from_text
 from email import message_from_bytes
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from lazr.config import as_timedelta
@@ -39,6 +41,7 @@ from mailman.testing.layers import ConfigLayer
 from mailman.utilities.datetime import now
 from pkg_resources import resource_filename
 from public import public
+from types import SimpleNamespace
 from unittest import TestCase
 from unittest.mock import patch
 
@@ -144,7 +147,9 @@ def get_dns_resolver(
                 self.answer = [Ans_e()]
 
     class Resolver:
-        # Mock dns.resolver.Resolver class.
+        # Mock dns.resolver.Resolver class.  Its answers are not cached.
+        ttl = 0
+
         def query(self, domain, data_type):
             if data_type != TXT:
                 raise NoAnswer
@@ -184,9 +189,10 @@ class TestDMARCRules(TestCase):
         self.resources = ExitStack()
         self.addCleanup(self.resources.close)
         # Make sure every test has a clean cache.
-        self.cache = {}
         self.resources.enter_context(
-            patch('mailman.rules.dmarc.suffix_cache', self.cache))
+            patch('mailman.rules.dmarc.suffix_cache', None))
+        self.resources.enter_context(
+            patch('mailman.rules.dmarc.policy_cache', None))
         self.resources.enter_context(use_test_organizational_data())
 
     def test_no_data_for_domain(self):
@@ -204,6 +210,53 @@ class TestDMARCRules(TestCase):
             dmarc.get_organizational_domain('ssub.sub.city.kobe.jp'),
             'city.kobe.jp')
 
+    def test_suffix_list_reused(self):
+        with patch('mailman.rules.dmarc.parse_suffix_list',
+                   wraps=dmarc.parse_suffix_list) as parse:
+            for domain in ('a.example.biz', 'b.example.biz', 'example.com'):
+                dmarc.get_organizational_domain(domain)
+        self.assertEqual(parse.call_count, 1)
+
+    def test_suffix_list_refreshed(self):
+        dmarc.get_organizational_domain('example.biz')
+        # Another process refreshes the expired cached copy.
+        dmarc.suffix_cache.expires = (now() - timedelta(days=1)).timestamp()
+        cache_path = os.path.join(config.VAR_DIR, dmarc.LOCAL_FILE_NAME)
+        with open(cache_path, 'w', encoding='utf-8') as fp:
+            print('example.biz', file=fp)
+        expires = (now() + timedelta(days=1)).timestamp()
+        os.utime(cache_path, (expires, expires))
+        self.assertEqual(
+            dmarc.get_organizational_domain('ssub.sub.example.biz'),
+            'sub.example.biz')
+
+    def test_suffix_list_not_refreshed(self):
+        # When the cached copy can't be refreshed, the suffix list isn't
+        # parsed again, nor refreshed again until another lifetime passes.
+        suffix_list = dmarc.get_suffix_list()
+        suffix_list.expires = (now() - timedelta(days=1)).timestamp()
+        with patch('mailman.rules.dmarc.ensure_current_suffix_list',
+                   return_value=os.path.join(
+                       config.VAR_DIR, dmarc.LOCAL_FILE_NAME)) as ensure:
+            self.assertIs(dmarc.get_suffix_list(), suffix_list)
+            self.assertIs(dmarc.get_suffix_list(), suffix_list)
+        self.assertEqual(ensure.call_count, 1)
+        self.assertGreater(suffix_list.expires, now().timestamp())
+
+    def test_out_of_date_suffix_list_expires(self):
+        # A suffix list read from an out of date copy expires a lifetime
+        # from now, not when the copy did.
+        cache_path = os.path.join(config.VAR_DIR, dmarc.LOCAL_FILE_NAME)
+        with open(cache_path, 'w', encoding='utf-8') as fp:
+            print('example.biz', file=fp)
+        mtime = (now() - timedelta(days=1)).timestamp()
+        os.utime(cache_path, (mtime, mtime))
+        suffix_list = dmarc.parse_suffix_list(cache_path)
+        self.assertEqual(suffix_list.mtime, mtime)
+        lifetime = as_timedelta(config.dmarc.cache_lifetime)
+        self.assertGreater(suffix_list.expires,
+                           (now() + lifetime / 2).timestamp())
+
     def test_no_at_sign_in_from_address(self):
         # If there's no @ sign in the From: address, the rule can't hit.
         mlist = create_list('ant@example.com')
@@ -398,14 +451,14 @@ To: ant@example.com
     def test_parser(self):
         data_file = resource_filename(
             'mailman.rules.tests.data', 'org_domain.txt')
-        dmarc.parse_suffix_list(data_file)
+        suffix_list = dmarc.parse_suffix_list(data_file)
         # There is no entry for example.biz because that line starts with
         # whitespace.
-        self.assertNotIn('biz.example', self.cache)
+        self.assertNotIn('biz.example', suffix_list)
         # The file had !city.kobe.jp so the flag says there's an exception.
-        self.assertTrue(self.cache['jp.kobe.city'])
+        self.assertTrue(suffix_list['jp.kobe.city'])
         # The file had *.kobe.jp so there's no exception.
-        self.assertFalse(self.cache['jp.kobe.*'])
+        self.assertFalse(suffix_list['jp.kobe.*'])
 
 
 # New in Python 3.5.
@@ -550,3 +603,196 @@ class TestSuffixList(TestCase):
         self.assertEqual(contents, 'xyz')
         # The cached file timestamp doesn't change.
         self.assertEqual(os.stat(new_path).st_mtime, expires)
+
+
+class StubResolver:
+    """A resolver answering from a dictionary of host names."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+
+    def query(self, domain, data_type):
+        self.queries.append(domain)
+        answer = self.answers[domain]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def txt_answer(name, ttl, record):
+    rrset = from_text(name + '.', ttl, 'IN', 'TXT', '"{}"'.format(record))
+    return SimpleNamespace(ttl=ttl, response=SimpleNamespace(answer=[rrset]))
+
+
+class TestDMARCPolicyCache(TestCase):
+    """Test the cache of DMARC policy lookups."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._now = 1000.0
+        self._directory = os.path.join(config.VAR_DIR, 'dmarc-test')
+        self.addCleanup(shutil.rmtree, self._directory, ignore_errors=True)
+        self._resolver = StubResolver({
+            '_dmarc.example.biz': txt_answer(
+                '_dmarc.example.biz', 300, 'v=DMARC1; p=reject;'),
+            '_dmarc.example.org': txt_answer(
+                '_dmarc.example.org', 300, 'v=DMARC1; p=none;'),
+            '_dmarc.example.net': txt_answer(
+                '_dmarc.example.net', 300, 'v=DMARC1; p=none;'),
+            '_dmarc.example.info': DNSException('no internet'),
+            '_dmarc.example.com': NoAnswer(),
+            })
+
+    def _make_cache(self, size=10, directory=None):
+        return dmarc.DMARCPolicyCache(
+            size, directory, lambda: self._resolver, lambda: self._now)
+
+    def test_cached_for_ttl(self):
+        cache = self._make_cache()
+        for i in range(3):
+            self.assertEqual(
+                cache.lookup('anne@example.biz', '_dmarc.example.biz'),
+                ['_dmarc.example.biz.', ['v=DMARC1; p=reject;']])
+        self.assertEqual(self._resolver.queries, ['_dmarc.example.biz'])
+        self._now += 301
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        self.assertEqual(len(self._resolver.queries), 2)
+
+    def test_negative_answer(self):
+        # The negative answer is cached for as long as the zone says.
+        soa = from_text('example.com.', 3600, 'IN', 'SOA',
+                        'ns.example.com. root.example.com. 1 2 3 4 60')
+        self._resolver.answers['_dmarc.example.com'] = NXDOMAIN(
+            qnames=['_dmarc.example.com'],
+            responses={'_dmarc.example.com': SimpleNamespace(
+                authority=[soa])})
+        cache = self._make_cache()
+        self.assertIsNone(cache.lookup('anne@example.com',
+                                       '_dmarc.example.com'))
+        self._now += 59
+        cache.lookup('anne@example.com', '_dmarc.example.com')
+        self.assertEqual(len(self._resolver.queries), 1)
+        self._now += 2
+        cache.lookup('anne@example.com', '_dmarc.example.com')
+        self.assertEqual(len(self._resolver.queries), 2)
+
+    def test_negative_answer_without_ttl(self):
+        cache = self._make_cache()
+        with configuration('dmarc', negative_lifetime='10m'):
+            self.assertIsNone(cache.lookup('anne@example.com',
+                                           '_dmarc.example.com'))
+        self._now += 599
+        cache.lookup('anne@example.com', '_dmarc.example.com')
+        self.assertEqual(len(self._resolver.queries), 1)
+
+    def test_error(self):
+        # Failed lookups are cached briefly, but only in memory.
+        mark = LogFileMark('mailman.error')
+        cache = self._make_cache(directory=self._directory)
+        self.assertTrue(cache.lookup('anne@example.info',
+                                     '_dmarc.example.info'))
+        self.assertIn('Unable to query DMARC policy', mark.readline())
+        cache.lookup('anne@example.info', '_dmarc.example.info')
+        self.assertEqual(len(self._resolver.queries), 1)
+        self.assertFalse(os.path.exists(self._directory))
+        self._now += 61
+        cache.lookup('anne@example.info', '_dmarc.example.info')
+        self.assertEqual(len(self._resolver.queries), 2)
+
+    def test_persistent(self):
+        cache = self._make_cache(directory=self._directory)
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        cache.lookup('anne@example.com', '_dmarc.example.com')
+        # Another process uses the lookups.
+        cache = self._make_cache(directory=self._directory)
+        self.assertEqual(
+            cache.lookup('anne@example.biz', '_dmarc.example.biz'),
+            ['_dmarc.example.biz.', ['v=DMARC1; p=reject;']])
+        self.assertIsNone(cache.lookup('anne@example.com',
+                                       '_dmarc.example.com'))
+        self.assertEqual(len(self._resolver.queries), 2)
+        # Unless they have expired.
+        self._now += 301
+        cache = self._make_cache(directory=self._directory)
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        self.assertEqual(len(self._resolver.queries), 3)
+        # The cache can be cleared.
+        cache.clear()
+        self.assertFalse(os.path.exists(self._directory))
+
+    def test_persistent_expired(self):
+        # Expired files are removed when they are read.
+        cache = self._make_cache(directory=self._directory)
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        self.assertEqual(len(os.listdir(self._directory)), 1)
+        self._now += 301
+        cache = self._make_cache(directory=self._directory)
+        self._resolver.answers['_dmarc.example.biz'] = NoAnswer()
+        with configuration('dmarc', negative_lifetime='0s'):
+            cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        self.assertEqual(os.listdir(self._directory), [])
+
+    def test_persistent_size(self):
+        # Once the cache has written as many files as its size, there are no
+        # more files than that.  The expired ones, then the ones expiring
+        # soonest, are removed first.
+        self._resolver.answers['_dmarc.example.org'] = txt_answer(
+            '_dmarc.example.org', 100, 'v=DMARC1; p=none;')
+        self._resolver.answers['_dmarc.example.net'] = txt_answer(
+            '_dmarc.example.net', 200, 'v=DMARC1; p=none;')
+        cache = self._make_cache(size=2, directory=self._directory)
+        cache.lookup('anne@example.net', '_dmarc.example.net')
+        cache.lookup('anne@example.org', '_dmarc.example.org')
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        # The directory isn't pruned after every write.
+        self.assertEqual(len(os.listdir(self._directory)), 3)
+        self._now += 150
+        cache.lookup('anne@example.com', '_dmarc.example.com')
+        self.assertEqual(sorted(os.listdir(self._directory)), sorted(
+            os.path.basename(cache._path(domain))
+            for domain in ('_dmarc.example.biz', '_dmarc.example.com')))
+
+    def test_persistent_prune_after_size_writes(self):
+        # The directory is only listed every size writes.
+        cache = self._make_cache(size=3, directory=self._directory)
+        with patch('mailman.rules.dmarc.os.listdir',
+                   side_effect=os.listdir) as listdir:
+            for domain in ('biz', 'org', 'net', 'com'):
+                cache.lookup('anne@example.' + domain,
+                             '_dmarc.example.' + domain)
+        self.assertEqual(listdir.call_count, 1)
+
+    def test_least_recently_used(self):
+        cache = self._make_cache(size=2)
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        cache.lookup('anne@example.org', '_dmarc.example.org')
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        cache.lookup('anne@example.net', '_dmarc.example.net')
+        self.assertEqual(len(self._resolver.queries), 3)
+        # example.org was forgotten, but not example.biz.
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        self.assertEqual(len(self._resolver.queries), 3)
+        cache.lookup('anne@example.org', '_dmarc.example.org')
+        self.assertEqual(len(self._resolver.queries), 4)
+
+    def test_disabled(self):
+        cache = self._make_cache(size=0)
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        cache.lookup('anne@example.biz', '_dmarc.example.biz')
+        self.assertEqual(len(self._resolver.queries), 2)
+
+    def test_rule(self):
+        # The rule uses the cache.
+        mlist = create_list('ant@example.com')
+        cache = dmarc.get_policy_cache()
+        self.addCleanup(cache.clear)
+        with patch.object(cache, '_make_resolver', lambda: self._resolver):
+            for i in range(2):
+                self.assertTrue(dmarc.maybe_mitigate(
+                    mlist, 'anne@example.biz'))
+                self.assertFalse(dmarc.maybe_mitigate(
+                    mlist, 'anne@example.org'))
+        self.assertEqual(self._resolver.queries,
+                         ['_dmarc.example.biz', '_dmarc.example.org'])
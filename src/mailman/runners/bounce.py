@@ -37,8 +37,8 @@ elog = logging.getLogger('mailman.error')
 class BounceRunner(Runner):
     """The bounce runner."""
 
-    def __init__(self, name, slice=None):
-        super().__init__(name, slice)
+    def __init__(self, name, slice=None, numslices=None):
+        super().__init__(name, slice, numslices)
         self._processor = getUtility(IBounceProcessor)
 
     def _dispose(self, mlist, msg, msgdata):
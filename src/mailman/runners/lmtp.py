@@ -236,8 +236,8 @@ class LMTPRunner(Runner):
 
     is_queue_runner = False
 
-    def __init__(self, name, slice=None):
-        super().__init__(name, slice)
+    def __init__(self, name, slice=None, numslices=None):
+        super().__init__(name, slice, numslices)
         hostname = config.mta.lmtp_host
         port = int(config.mta.lmtp_port)
         self.lmtp = LMTPController(LMTPHandler(), hostname=hostname, port=port)
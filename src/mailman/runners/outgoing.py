@@ -17,16 +17,19 @@
 
 """Outgoing runner."""
 
+import time
+import random
 import socket
 import logging
+import threading
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from lazr.config import as_boolean, as_timedelta
 from mailman.config import config
 from mailman.core.runner import Runner
 from mailman.interfaces.bounce import BounceContext, IBounceProcessor
 from mailman.interfaces.mailinglist import Personalization
-from mailman.interfaces.mta import SomeRecipientsFailed
+from mailman.interfaces.mta import CircuitState, SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
 from mailman.interfaces.subscriptions import ISubscriptionService
 from mailman.utilities.datetime import now
@@ -45,12 +48,102 @@ smtp_log = logging.getLogger('mailman.smtp')
 debug_log = logging.getLogger('mailman.debug')
 
 
+@public
+class CircuitBreaker:
+    """Hold back deliveries to an MTA which can't be connected to.
+
+    After `threshold` connection failures in a row, the circuit opens and no
+    messages are delivered until a backoff delay is over.  Then a single
+    message is let through, which closes the circuit again if it is
+    delivered, or reopens it with twice the backoff delay if it isn't.
+    """
+
+    def __init__(self, threshold, backoff, max_backoff):
+        """Create a circuit breaker.
+
+        :param threshold: The number of connection failures in a row which
+            open the circuit.
+        :type threshold: int
+        :param backoff: The number of seconds the circuit stays open the
+            first time.
+        :type backoff: float
+        :param max_backoff: The maximum number of seconds the circuit stays
+            open.
+        :type max_backoff: float
+        """
+        self.threshold = max(threshold, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CircuitState.closed
+        # The number of connection failures in a row.
+        self.failures = 0
+        # The time.time() at which an open circuit lets a message through.
+        self.retry_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        """True while the circuit is open and not ready to be tried."""
+        return (self.state is CircuitState.open and
+                time.time() < self.retry_at)
+
+    @property
+    def remaining(self):
+        """The number of seconds until the MTA is to be tried again."""
+        return (max(self.retry_at - time.time(), 0)
+                if self.state is CircuitState.open
+                else 0)
+
+    def allow(self):
+        """Return whether a message may be delivered now.
+
+        The first message allowed through an open circuit is the one which
+        tries the MTA again.
+        """
+        with self._lock:
+            if self.state is CircuitState.closed:
+                return True
+            if self.state is CircuitState.half_open or self.waiting:
+                return False
+            self.state = CircuitState.half_open
+            smtp_log.info('SMTP circuit half_open: trying the server again')
+            return True
+
+    def succeeded(self):
+        """Record that the MTA was connected to."""
+        with self._lock:
+            if self.state is not CircuitState.closed:
+                smtp_log.info('SMTP circuit closed: resuming delivery')
+            self.state = CircuitState.closed
+            self.failures = 0
+            self.retry_at = None
+
+    def failed(self):
+        """Record that the MTA couldn't be connected to."""
+        with self._lock:
+            self.failures += 1
+            if (self.state is CircuitState.closed and
+                    self.failures < self.threshold):
+                return
+            # Double the delay every time the MTA is tried in vain, and jitter
+            # it so that runners don't all try again at once.
+            exponent = min(self.failures - self.threshold, 32)
+            delay = min(self.backoff * 2 ** exponent, self.max_backoff)
+            delay = random.uniform(delay / 2, delay)
+            self.retry_at = time.time() + delay
+            self.state = CircuitState.open
+            smtp_log.error(
+                'SMTP circuit open: holding back delivery after %s '
+                'failures; trying again in %.1f seconds',
+                self.failures, delay)
+
+
 @public
 class OutgoingRunner(Runner):
     """The outgoing runner."""
 
-    def __init__(self, slice=None, numslices=1):
-        super().__init__(slice, numslices)
+    def __init__(self, name, slice=None, numslices=None):
+        super().__init__(name, slice, numslices)
         # We look this function up only at startup time.
         self._func = find_name(config.mta.outgoing)
         # This prevents smtp server connection problems from filling up the
@@ -58,12 +151,38 @@ class OutgoingRunner(Runner):
         # set if there was a socket.error.
         self._logged = False
         self._retryq = config.switchboards['retry']
+        # Stop delivering messages for a while when the MTA is down.
+        self.breaker = CircuitBreaker(
+            int(config.mta.connection_failure_threshold),
+            as_timedelta(config.mta.connection_backoff).total_seconds(),
+            as_timedelta(config.mta.connection_max_backoff).total_seconds())
+
+    def __repr__(self):
+        return '<{} at {:#x} circuit {}>'.format(
+            self.__class__.__name__, id(self), self.circuit_state.name)
+
+    @property
+    def circuit_state(self):
+        """The state of the circuit to the MTA, as a `CircuitState`.
+
+        Its transitions are logged in the smtp log.
+        """
+        return self.breaker.state
 
     def _dispose(self, mlist, msg, msgdata):
         # See if we should retry delivery of this message again.
         deliver_after = msgdata.get('deliver_after', datetime.fromtimestamp(0))
         if now() < deliver_after:
-            return True
+            # Leave the message alone until it's time.
+            self._defer(msg, msgdata, deliver_after - now())
+            return False
+        # Hold the message back if the MTA is known to be down.  Only a
+        # message which was already on its way when the circuit opened gets
+        # here; the rest are left alone in the queue.
+        if not self.breaker.allow():
+            self._defer(msg, msgdata,
+                        timedelta(seconds=self.breaker.remaining))
+            return False
         # Calculate whether we should VERP this message or not.  The results of
         # this set the 'verp' key in the message metadata.
         interval = int(config.mta.verp_delivery_interval)
@@ -92,7 +211,9 @@ class OutgoingRunner(Runner):
                 self._func, msg.get('message-id', 'n/a')))
             self._func(mlist, msg, msgdata)
             self._logged = False
+            self.breaker.succeeded()
         except socket.error:
+            self.breaker.failed()
             # There was a problem connecting to the SMTP server.  Log this
             # once, but crank up our sleep time so we don't fill the error
             # log.
@@ -103,8 +224,18 @@ class OutgoingRunner(Runner):
                 log.error('Cannot connect to SMTP server %s on port %s',
                           config.mta.smtp_host, port)
                 self._logged = True
-            return True
+            self._defer(msg, msgdata,
+                        as_timedelta(config.mta.connection_retry_interval))
+            return False
         except SomeRecipientsFailed as error:
+            if error.connection_failures:
+                # The delivery function turned the MTA being down into
+                # temporary failures, which are retried as usual.
+                self.breaker.failed()
+            else:
+                # The MTA was connected to, even if it refused some
+                # recipients.
+                self.breaker.succeeded()
             processor = getUtility(IBounceProcessor)
             # BAW: msg is the original message that failed delivery, not a
             # bounce message.  This may be confusing if this is what's sent to
@@ -160,6 +291,42 @@ class OutgoingRunner(Runner):
                     msgdata['last_recip_count'] = len(recipients)
                     msgdata['deliver_until'] = deliver_until
                     msgdata['recipients'] = recipients
-                    self._retryq.enqueue(msg, msgdata)
+                    # Retry after the retry interval, but no later than the
+                    # end of the retry period.
+                    delay = min(
+                        as_timedelta(config.mta.delivery_retry_interval),
+                        deliver_until - current_time)
+                    self._retryq.enqueue(
+                        msg, msgdata, _delay=delay.total_seconds())
         # We've successfully completed handling of this message.
         return False
+
+    def _one_iteration(self):
+        """See `IRunner`."""
+        if self.breaker.waiting:
+            # Don't even look at the queue until the MTA is to be tried again.
+            return 0
+        return super()._one_iteration()
+
+    def _snooze(self, filecnt):
+        """See `IRunner`."""
+        if self.breaker.waiting:
+            # Sleep no longer than usual, so that the runner still notices
+            # when it's told to stop.
+            time.sleep(min(self.breaker.remaining, self.sleep_float))
+        else:
+            super()._snooze(filecnt)
+
+    def _short_circuit(self):
+        """See `IRunner`."""
+        # Stop going through the queue as soon as the circuit opens, and
+        # after the single message which tries the MTA again.
+        return (super()._short_circuit() or
+                self.breaker.state is not CircuitState.closed)
+
+    def _defer(self, msg, msgdata, delay):
+        """Put the message back in the queue until the delay is over.
+
+        The queue entry isn't touched again before then.
+        """
+        self.switchboard.enqueue(msg, msgdata, _delay=delay.total_seconds())
@@ -37,9 +37,9 @@ class RESTRunner(Runner):
     # won't actually stop the TCPServer started by .serve_forever().
     is_queue_runner = False
 
-    def __init__(self, name, slice=None):
+    def __init__(self, name, slice=None, numslices=None):
         """See `IRunner`."""
-        super().__init__(name, slice)
+        super().__init__(name, slice, numslices)
         # Both the REST server and the signal handlers must run in the main
         # thread; the former because of SQLite requirements (objects created
         # in one thread cannot be shared with the other threads), and the
@@ -52,6 +52,7 @@ class RESTRunner(Runner):
         # server.
         self._server = make_server()
         self._event = threading.Event()
+        self._stopping = False
         def stopper(event, server):                              # noqa: E306
             event.wait()
             server.shutdown()
@@ -67,8 +68,12 @@ class RESTRunner(Runner):
     def signal_handler(self, signum, frame):
         with suppress(RunnerInterrupt):
             super().signal_handler(signum, frame)
-        if signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
-            # Set the flag that will terminate the TCPserver loop.
+        if (signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1) and
+                not self._stopping):
+            # Set the flag that will terminate the TCPserver loop.  Only do
+            # this once, since another signal can arrive while the event is
+            # being set, and setting it again then would deadlock.
+            self._stopping = True
             self._event.set()
 
     def _one_iteration(self):
@@ -17,8 +17,6 @@
 
 """Retry delivery."""
 
-import time
-
 from mailman.config import config
 from mailman.core.runner import Runner
 from public import public
@@ -29,10 +27,7 @@ class RetryRunner(Runner):
     """Retry delivery."""
 
     def _dispose(self, mlist, msg, msgdata):
+        # Messages are enqueued here to be due when they should be retried.
         # Move the message to the out queue for another try.
         config.switchboards['out'].enqueue(msg, msgdata)
         return False
-
-    def _snooze(self, filecnt):
-        # We always want to snooze.
-        time.sleep(self.sleep_float)
@@ -18,6 +18,7 @@
 """Test the outgoing runner."""
 
 import os
+import time
 import socket
 import logging
 import unittest
@@ -30,15 +31,16 @@ from mailman.config import config
 from mailman.interfaces.bounce import BounceContext, IBounceProcessor
 from mailman.interfaces.mailinglist import Personalization
 from mailman.interfaces.member import MemberRole
-from mailman.interfaces.mta import SomeRecipientsFailed
+from mailman.interfaces.mta import CircuitState, SomeRecipientsFailed
 from mailman.interfaces.pending import IPendings
 from mailman.interfaces.usermanager import IUserManager
-from mailman.runners.outgoing import OutgoingRunner
+from mailman.runners.outgoing import CircuitBreaker, OutgoingRunner
 from mailman.testing.helpers import (
     LogFileMark, configuration, get_queue_messages, make_testable_runner,
     specialized_message_from_string as message_from_string)
 from mailman.testing.layers import ConfigLayer, SMTPLayer
 from mailman.utilities.datetime import factory, now
+from unittest.mock import patch
 from zope.component import getUtility
 
 
@@ -75,6 +77,10 @@ Message-Id: <first>
         self._outq.enqueue(self._msg, self._msgdata,
                            tolist=True, listid='test.example.com')
         self._runner.run()
+        # The message isn't due again until its deliver_after time.
+        self.assertEqual(self._outq.get_batch(), [])
+        self.assertAlmostEqual(self._outq.next_due() - time.time(),
+                               timedelta(days=10).total_seconds(), delta=60)
         items = get_queue_messages('out', expected_count=1)
         self.assertEqual(items[0].msgdata['deliver_after'], deliver_after)
         self.assertEqual(items[0].msg['message-id'], '<first>')
@@ -268,6 +274,255 @@ Message-Id: <first>
             line[-53:-1],
             'Cannot connect to SMTP server localhost on port 2112')
 
+    def test_error_defers_message(self):
+        # When the MTA can't be connected to, the message is put back in the
+        # queue, but it isn't due again until the connection retry interval
+        # is over.
+        self._outq.enqueue(self._msg, {}, listid='test.example.com')
+        with configuration('mta', connection_retry_interval='5m'):
+            self._runner.run()
+        self.assertEqual(self._outq.get_batch(), [])
+        self.assertAlmostEqual(self._outq.next_due() - time.time(), 300,
+                               delta=60)
+        items = get_queue_messages('out', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<first>')
+
+
+def refused_port():
+    """Return a local port which refuses connections."""
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class TestConnectionRefused(unittest.TestCase):
+    """Test delivery through the real delivery function to a down MTA."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._mlist = create_list('test@example.com')
+        self._outq = config.switchboards['out']
+        self._runner = make_testable_runner(OutgoingRunner, 'out', run_once)
+        self._msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Message-Id: <first>
+
+""")
+
+    def test_refused_message_is_retried(self):
+        # A connection refused by the MTA is a temporary failure, so the
+        # message is kept for another try rather than shunted.
+        self._outq.enqueue(self._msg, dict(recipients=['bart@example.com']),
+                           listid='test.example.com')
+        with configuration('mta', smtp_port=refused_port()):
+            self._runner.run()
+        get_queue_messages('shunt', expected_count=0)
+        items = get_queue_messages('retry', expected_count=1)
+        self.assertEqual(items[0].msg['message-id'], '<first>')
+        self.assertEqual(items[0].msgdata['recipients'], ['bart@example.com'])
+
+    def test_refused_connections_open_circuit(self):
+        # Connections refused by the MTA count as failures for the circuit
+        # breaker, even though the delivery function reports them as
+        # temporary failures.
+        msgdata = dict(recipients=['bart@example.com'])
+        filebases = [
+            self._outq.enqueue(self._msg, msgdata, listid='test.example.com')
+            for i in range(4)]
+        with configuration('mta', smtp_port=refused_port(),
+                           connection_failure_threshold=2):
+            runner = make_testable_runner(
+                OutgoingRunner, 'out', until_held_back)
+            runner.run()
+        self.assertEqual(runner.breaker.state, CircuitState.open)
+        self.assertEqual(sorted(self._outq.get_batch()), sorted(filebases[2:]))
+        get_queue_messages('shunt', expected_count=0)
+        get_queue_messages('retry', expected_count=2)
+
+
+mta_down = True
+attempts = []
+
+
+def flaky_delivery(mlist, msg, msgdata):
+    attempts.append(msg['message-id'])
+    if mta_down:
+        raise socket.error
+
+
+def until_held_back(runner):
+    """Predicate for make_testable_runner().
+
+    Stops the runner once nothing in its queue is due, or the circuit isn't
+    closed.
+    """
+    return (runner.breaker.state is not CircuitState.closed or
+            len(runner.switchboard.get_batch()) == 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test the circuit breaker for the outgoing MTA."""
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        self._breaker = CircuitBreaker(3, 10, 60)
+
+    def test_opens_after_threshold(self):
+        self.assertTrue(self._breaker.allow())
+        self._breaker.failed()
+        self._breaker.failed()
+        self.assertEqual(self._breaker.state, CircuitState.closed)
+        self.assertTrue(self._breaker.allow())
+        self._breaker.failed()
+        self.assertEqual(self._breaker.state, CircuitState.open)
+        self.assertTrue(self._breaker.waiting)
+        self.assertFalse(self._breaker.allow())
+        # The first delay is jittered between half and all of the backoff.
+        self.assertGreaterEqual(self._breaker.remaining, 4)
+        self.assertLessEqual(self._breaker.remaining, 10)
+
+    def test_success_resets_failures(self):
+        self._breaker.failed()
+        self._breaker.failed()
+        self._breaker.succeeded()
+        self._breaker.failed()
+        self.assertEqual(self._breaker.state, CircuitState.closed)
+
+    def test_probe(self):
+        for i in range(3):
+            self._breaker.failed()
+        self._breaker.retry_at = time.time() - 1
+        self.assertFalse(self._breaker.waiting)
+        # A single message is let through to try the MTA again.
+        self.assertTrue(self._breaker.allow())
+        self.assertEqual(self._breaker.state, CircuitState.half_open)
+        self.assertFalse(self._breaker.allow())
+        self._breaker.succeeded()
+        self.assertEqual(self._breaker.state, CircuitState.closed)
+        self.assertTrue(self._breaker.allow())
+
+    def test_exponential_backoff(self):
+        for i in range(3):
+            self._breaker.failed()
+        delays = []
+        for i in range(4):
+            self._breaker.retry_at = time.time() - 1
+            self.assertTrue(self._breaker.allow())
+            self._breaker.failed()
+            self.assertEqual(self._breaker.state, CircuitState.open)
+            delays.append(self._breaker.remaining)
+        # The backoff doubles from 10 seconds to 20, 40, and then the 60
+        # second maximum, less up to half for the jitter.
+        for delay, backoff in zip(delays, (20, 40, 60, 60)):
+            self.assertGreaterEqual(delay, backoff / 2 - 1)
+            self.assertLessEqual(delay, backoff)
+
+
+class TestHoldingBack(unittest.TestCase):
+    """Test that the outgoing runner holds back messages when the MTA is down.
+    """
+
+    layer = ConfigLayer
+
+    def setUp(self):
+        global mta_down
+        mta_down = True
+        del attempts[:]
+        config.push('flaky outgoing', """
+        [mta]
+        outgoing: mailman.runners.tests.test_outgoing.flaky_delivery
+        connection_failure_threshold: 2
+        """)
+        self.addCleanup(config.pop, 'flaky outgoing')
+        self._mlist = create_list('test@example.com')
+        self._outq = config.switchboards['out']
+        self._runner = make_testable_runner(
+            OutgoingRunner, 'out', until_held_back)
+        for i in range(5):
+            msg = message_from_string("""\
+From: anne@example.com
+To: test@example.com
+Message-Id: <{}>
+
+""".format(i))
+            self._outq.enqueue(msg, {}, listid='test.example.com')
+
+    def test_hold_back(self):
+        global mta_down
+        filebases = self._outq.files
+        self._runner.run()
+        # Only two messages were tried before the circuit opened, and the
+        # rest weren't touched.
+        self.assertEqual(attempts, ['<0>', '<1>'])
+        self.assertEqual(self._runner.breaker.state, CircuitState.open)
+        self.assertEqual(self._outq.get_batch(), filebases[2:])
+        self.assertIn('circuit open', repr(self._runner))
+        # Nothing is tried while the circuit is open.
+        self._runner.run()
+        self.assertEqual(attempts, ['<0>', '<1>'])
+        # A single message tries the MTA again, in vain.
+        self._runner.breaker.retry_at = time.time() - 1
+        self._runner.run()
+        self.assertEqual(attempts, ['<0>', '<1>', '<2>'])
+        self.assertEqual(self._runner.breaker.state, CircuitState.open)
+        # Once the MTA is back, delivery resumes.
+        mta_down = False
+        self._runner.breaker.retry_at = time.time() - 1
+        self._runner.run()
+        self.assertEqual(attempts, ['<0>', '<1>', '<2>', '<3>', '<4>'])
+        self.assertEqual(self._runner.breaker.state, CircuitState.closed)
+        # The messages which failed are waiting to be retried.
+        self.assertEqual(len(self._outq.files), 3)
+        self.assertEqual(self._outq.get_batch(), [])
+
+    def test_circuit_state(self):
+        # The runner reports the state of its circuit to the MTA, and logs
+        # each transition.
+        global mta_down
+        states = []
+
+        def deliver(mlist, msg, msgdata):
+            states.append(self._runner.circuit_state)
+            flaky_delivery(mlist, msg, msgdata)
+        self._runner._func = deliver
+        mark = LogFileMark('mailman.smtp')
+        self.assertEqual(self._runner.circuit_state, CircuitState.closed)
+        self._runner.run()
+        self.assertEqual(self._runner.circuit_state, CircuitState.open)
+        self.assertIn('SMTP circuit open', mark.read())
+        # The first message after the backoff delay is delivered while the
+        # circuit is half open, and closes it.
+        mta_down = False
+        self._runner.breaker.retry_at = time.time() - 1
+        del states[:]
+        self._runner.run()
+        self.assertEqual(states, [
+            CircuitState.half_open, CircuitState.closed, CircuitState.closed])
+        self.assertEqual(self._runner.circuit_state, CircuitState.closed)
+        log = mark.read()
+        self.assertLess(log.index('SMTP circuit half_open'),
+                        log.index('SMTP circuit closed'))
+
+    def test_snooze_while_open(self):
+        # While the circuit is open, the runner sleeps until the MTA is to be
+        # tried again, but never longer than its usual sleep time.
+        self._runner.run()
+        self._runner.sleep_float = 60
+        with patch('mailman.runners.outgoing.time.sleep') as sleep:
+            self._runner._snooze(0)
+        delay = sleep.call_args[0][0]
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(
+            delay, as_timedelta(config.mta.connection_backoff).total_seconds())
+        self._runner.sleep_float = 0.5
+        self._runner.breaker.retry_at = time.time() + 3600
+        with patch('mailman.runners.outgoing.time.sleep') as sleep:
+            self._runner._snooze(0)
+        self.assertEqual(sleep.call_args[0][0], 0.5)
+
 
 temporary_failures = []
 permanent_failures = []
@@ -395,6 +650,33 @@ Message-Id: <first>
         self.assertEqual(items[0].msgdata['deliver_until'], deliver_until)
         self.assertEqual(items[0].msgdata['recipients'], ['cris@example.com'])
 
+    def test_temporary_failure_retry_interval(self):
+        # The message isn't due in the retry queue until the delivery retry
+        # interval is over.
+        temporary_failures.append('cris@example.com')
+        self._outq.enqueue(self._msg, {}, listid='test.example.com')
+        with configuration('mta', delivery_retry_interval='1h'):
+            self._runner.run()
+        retryq = config.switchboards['retry']
+        self.assertEqual(retryq.get_batch(), [])
+        self.assertAlmostEqual(retryq.next_due() - time.time(), 3600,
+                               delta=60)
+        get_queue_messages('retry', expected_count=1)
+
+    def test_temporary_failure_retry_period_ends(self):
+        # The message is retried no later than the end of the retry period,
+        # even if that's sooner than the retry interval.
+        temporary_failures.append('cris@example.com')
+        deliver_until = now() + timedelta(minutes=10)
+        self._outq.enqueue(self._msg, {}, listid='test.example.com',
+                           last_recip_count=1, deliver_until=deliver_until)
+        with configuration('mta', delivery_retry_interval='1h'):
+            self._runner.run()
+        retryq = config.switchboards['retry']
+        self.assertAlmostEqual(retryq.next_due() - time.time(), 600,
+                               delta=60)
+        get_queue_messages('retry', expected_count=1)
+
     def test_two_temporary_failures(self):
         # The first time there are temporary failures, the message just gets
         # put in the retry queue, but with some metadata to prevent infinite
@@ -50,3 +50,11 @@ Message-Id: <first>
         self._retryq.enqueue(self._msg, self._msgdata)
         self._runner.run()
         get_queue_messages('out', expected_count=1)
+
+    def test_message_left_until_due(self):
+        # Messages are only moved once they're due to be retried.
+        self._retryq.enqueue(self._msg, self._msgdata)
+        self._retryq.enqueue(self._msg, self._msgdata, _delay=600)
+        self._runner.run()
+        get_queue_messages('out', expected_count=1)
+        get_queue_messages('retry', expected_count=1)
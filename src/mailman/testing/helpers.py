@@ -63,7 +63,8 @@ def make_testable_runner(runner_class, name=None, predicate=None):
         class name.
     :type name: string or None
     :param predicate: Optional alternative predicate for deciding when to stop
-        the runner.  When None (the default) it stops when the queue is empty.
+        the runner.  When None (the default) it stops when nothing in the
+        queue is due.
     :type predicate: callable that gets one argument, the queue runner.
     :return: A runner instance.
     """
@@ -84,7 +85,7 @@ def make_testable_runner(runner_class, name=None, predicate=None):
         def _do_periodic(self):
             """Stop when the queue is empty."""
             if predicate is None:
-                self._stop = (len(self.switchboard.files) == 0)
+                self._stop = (len(self.switchboard.get_batch()) == 0)
             else:
                 self._stop = predicate(self)
 
@@ -470,10 +471,13 @@ def reset_the_world():
     # Remove all dynamic header-match rules.
     config.chains['header-match'].flush()
     # Remove cached organizational domain suffix file.
-    from mailman.rules.dmarc import LOCAL_FILE_NAME
-    suffix_file = os.path.join(config.VAR_DIR, LOCAL_FILE_NAME)
+    from mailman.rules import dmarc
+    suffix_file = os.path.join(config.VAR_DIR, dmarc.LOCAL_FILE_NAME)
     with suppress(FileNotFoundError):
         os.remove(suffix_file)
+    # Forget the cached DMARC policy lookups, including the kept ones.
+    dmarc.policy_cache = None
+    shutil.rmtree(os.path.join(config.VAR_DIR, 'dmarc'), ignore_errors=True)
 
 
 @public
@@ -18,7 +18,6 @@
 """Internationalization for the tests."""
 
 from contextlib import closing
-from flufl.i18n import registry
 from gettext import GNUTranslations, NullTranslations
 from pkg_resources import resource_stream
 from public import public
@@ -42,7 +41,7 @@ class TestingStrategy:
 def initialize():
     """Install a global underscore function for testing purposes."""
     # Avoid circular imports.
-    from mailman.core.i18n import initialize as core_initialize
+    from mailman.core.i18n import (
+        ThreadLocalApplication, initialize as core_initialize)
     strategy = TestingStrategy('mailman-testing')
-    application = registry.register(strategy)
-    core_initialize(application)
+    core_initialize(ThreadLocalApplication(strategy))
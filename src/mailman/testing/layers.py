@@ -38,6 +38,7 @@ from mailman.core.initialize import INHIBIT_CONFIG_FILE
 from mailman.core.logging import get_handler
 from mailman.database.transaction import transaction
 from mailman.interfaces.domain import IDomainManager
+from mailman.mta.connection import get_connection_pool
 from mailman.testing.helpers import (
     TestableMaster, get_lmtp_client, reset_the_world, wait_for_webservice)
 from mailman.testing.mta import ConnectionCountingController
@@ -254,6 +255,8 @@ class SMTPLayer(ConfigLayer):
 
     @classmethod
     def testTearDown(cls):
+        # Don't let the next test reuse this test's connections.
+        get_connection_pool().close()
         cls.smtpd.reset()
         cls.smtpd.clear()
 
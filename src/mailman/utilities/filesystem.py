@@ -18,11 +18,35 @@
 """Filesystem utilities."""
 
 import os
+import time
+import uuid
+import ctypes
+import select
+import struct
+import weakref
+import threading
 
 from contextlib import suppress
 from public import public
 
 
+# inotify(7) constants.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+# struct inotify_event, without the trailing name.
+INOTIFY_EVENT = struct.Struct('iIII')
+# The most changes a watcher keeps track of between waits.  Beyond that, its
+# directory is scanned again instead.
+MAX_PENDING_NAMES = 16384
+
+# The inotify(7) instance shared by the process's watchers.
+_inotify = None
+
+
 @public
 class umask:
     """Manage the umask for the with statement."""
@@ -86,6 +110,66 @@ def safe_remove(path):
         os.remove(path)
 
 
+@public
+def write_atomically(path, text):
+    """Replace the contents of a file all at once.
+
+    The text is written to a temporary file which is then moved into place,
+    so that readers, even in other processes, never see a partial file.  The
+    file's directory is created if necessary.
+
+    :param path: The path of the file.
+    :type path: str
+    :param text: The new contents of the file.
+    :type text: str
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        safe_remove(tmp_path)
+        raise
+
+
+@public
+def new_token(path):
+    """Replace the token in a file with a new, unique one.
+
+    Tokens let processes tell whether what they cached is still current:
+    whatever was cached under a token is stale once the token is replaced.
+
+    :param path: The path of the token file.
+    :type path: str
+    :return: The new token.
+    :rtype: str
+    """
+    token = uuid.uuid4().hex
+    write_atomically(path, token)
+    return token
+
+
+@public
+def read_token(path):
+    """Read the token in a file.
+
+    If there is no token file, e.g. because it was removed, a new token is
+    created, since nothing cached under an earlier token can be trusted.
+
+    :param path: The path of the token file.
+    :type path: str
+    :return: The token.
+    :rtype: str
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return new_token(path)
+
+
 def first_inexistent_directory(path):
     """Splits iteratively a path until it gives the first non-existent
     directory in the tree.
@@ -108,3 +192,251 @@ def first_inexistent_directory(path):
                 "The path %s exists but is not a directory.",
                 directory)
         directory, rhs = os.path.split(directory)
+
+
+class _PollingWatcher:
+    """Watch a directory by checking its modification time.
+
+    The directory is only looked at before and after sleeping for the whole
+    timeout, just as a runner without a watcher sleeps between looks at its
+    queue, so changes are not noticed any sooner than that.
+
+    A change made within the same tick of the file system's clock as the
+    previous look doesn't change the modification time, so with a rescan
+    interval, a change is also reported whenever that much time has passed
+    since the last report.
+    """
+
+    def __init__(self, path, rescan_interval=None):
+        self.path = path
+        self._mtime = os.stat(path).st_mtime_ns
+        self._rescan_interval = rescan_interval
+        self._reported()
+
+    def _reported(self):
+        if self._rescan_interval is None:
+            self._rescan_at = None
+        else:
+            self._rescan_at = time.time() + self._rescan_interval
+
+    def _changed(self, mtime):
+        return mtime != self._mtime or (
+            self._rescan_at is not None and time.time() >= self._rescan_at)
+
+    def wait(self, timeout):
+        """Wait for files to be added to or removed from the directory.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :return: The empty list if the timeout expired, or None if something
+            changed in the directory.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if not self._changed(mtime) and timeout > 0:
+            time.sleep(timeout)
+            mtime = os.stat(self.path).st_mtime_ns
+        if self._changed(mtime):
+            self._mtime = mtime
+            self._reported()
+            return None
+        return []
+
+    def acknowledge(self):
+        """Don't report the changes made to the directory so far.
+
+        This is for changes the caller made itself, and already knows about.
+        Changes made by others at the same time are then only reported after
+        the rescan interval.
+        """
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def close(self):
+        pass
+
+
+class _INotify:
+    """The inotify(7) instance shared by all the watchers of a process.
+
+    The kernel limits the number of inotify instances per user, so instead
+    of one per watched directory, every watcher adds its directory to the
+    same instance.  Whichever thread waits reads the events, and hands them
+    out to the watchers of the directories they are for.
+    """
+
+    def __init__(self, libc):
+        self._libc = libc
+        self.pid = os.getpid()
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._file = open(fd, 'rb', buffering=0)
+        # The watchers of each watch descriptor, and how many there are, since
+        # all the watchers of a directory share its descriptor.
+        self._watchers = {}
+        self._counts = {}
+        # Only one thread at a time waits for the inotify file; the others
+        # wait for it to hand out what it has read.
+        self._condition = threading.Condition()
+        self._reading = False
+
+    def add(self, watcher, path):
+        """Start handing out the changes to a directory to a watcher.
+
+        :return: The watch descriptor.
+        :rtype: int
+        """
+        with self._condition:
+            wd = self._libc.inotify_add_watch(
+                self._file.fileno(), os.fsencode(path), INOTIFY_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                              path)
+            self._watchers.setdefault(wd, weakref.WeakSet()).add(watcher)
+            self._counts[wd] = self._counts.get(wd, 0) + 1
+            return wd
+
+    def remove(self, wd):
+        """Stop watching for a watcher which has gone away."""
+        with self._condition:
+            self._counts[wd] -= 1
+            if self._counts[wd] == 0:
+                del self._counts[wd]
+                del self._watchers[wd]
+                self._libc.inotify_rm_watch(self._file.fileno(), wd)
+
+    def wait(self, watcher, timeout):
+        """See `_INotifyWatcher`."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                self._read()
+                if watcher.names is None or len(watcher.names) > 0:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if self._reading:
+                    self._condition.wait(remaining)
+                    continue
+                self._reading = True
+                self._condition.release()
+                try:
+                    select.select([self._file], [], [], remaining)
+                finally:
+                    self._condition.acquire()
+                    self._reading = False
+                    self._condition.notify_all()
+            names = watcher.names
+            watcher.names = []
+            return names
+
+    def _read(self):
+        """Hand out all the events which can be read without waiting."""
+        while True:
+            data = self._file.read(65536)
+            if data is None:
+                # There are no more events to read.
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                    data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    watchers = [
+                        watcher
+                        for watchers in list(self._watchers.values())
+                        for watcher in watchers
+                        ]
+                else:
+                    watchers = self._watchers.get(wd, ())
+                for watcher in watchers:
+                    if (mask & IN_Q_OVERFLOW or watcher.names is None or
+                            len(watcher.names) >= MAX_PENDING_NAMES):
+                        # The changes are too many to keep track of.
+                        watcher.names = None
+                    else:
+                        watcher.names.append(name)
+
+
+class _INotifyWatcher:
+    """Watch a directory with Linux's inotify(7)."""
+
+    def __init__(self, path, inotify):
+        self.path = path
+        # The names of the files changed since the last wait, or None if
+        # changes were lost.
+        self.names = []
+        self._inotify = inotify
+        wd = inotify.add(self, path)
+        # Stop watching when the watcher is closed or garbage collected.
+        self._finalizer = weakref.finalize(self, inotify.remove, wd)
+
+    def wait(self, timeout):
+        """See `_PollingWatcher`.
+
+        :return: The names of the files added to or removed from the
+            directory, the empty list if the timeout expired, or None if
+            events were lost.
+        """
+        return self._inotify.wait(self, timeout)
+
+    def acknowledge(self):
+        """See `_PollingWatcher`."""
+        # The names of the changed files are reported, so the caller's own
+        # changes are cheap to apply, and others' can't be told apart.
+
+    def close(self):
+        self._finalizer()
+
+
+def _get_inotify():
+    """Return the process's shared inotify instance, or None."""
+    global _inotify
+    # A child process can't share its parent's.
+    if _inotify is None or _inotify.pid != os.getpid():
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            return None
+        _inotify = _INotify(libc)
+    return _inotify
+
+
+@public
+def watch_directory(path, rescan_interval=None):
+    """Return an object which waits for changes to the files in a directory.
+
+    Files added by renaming them into the directory or by closing them after
+    writing, and files removed by renaming or deleting them, are reported.
+    inotify is used where it is available, with one instance shared by all
+    the watchers of a process.  Otherwise the directory's modification time
+    is checked before and after sleeping for the timeout, and a change is
+    reported at least once every `rescan_interval` seconds, if given.
+
+    The object's `wait(timeout)` method returns the list of names added to or
+    removed from the directory, the empty list if nothing changed before the
+    timeout expired, or None if something may have changed but the names are
+    not known.  Changes are accumulated between calls to `wait()`.  Call
+    `acknowledge()` after changing the directory yourself, and `close()` to
+    release the watch.
+
+    :param path: The directory to watch.
+    :type path: str
+    :param rescan_interval: When the directory's modification time has to be
+        checked, the longest time in seconds between reported changes, or
+        None to only report actual changes.
+    :type rescan_interval: float or None
+    """
+    try:
+        inotify = _get_inotify()
+        if inotify is not None:
+            return _INotifyWatcher(path, inotify)
+    except OSError:
+        # E.g. the per-user limit of inotify instances or watches has been
+        # reached.
+        pass
+    return _PollingWatcher(path, rescan_interval)
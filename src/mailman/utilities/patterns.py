@@ -0,0 +1,63 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers for matching many regular expressions at once."""
+
+import re
+
+from public import public
+
+
+# The flags of a pattern without any inline global flags, and the parts of
+# patterns which refer to their own groups.
+_BASE_FLAGS = re.compile('', re.IGNORECASE).flags
+_NOT_COMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+@public
+def combine_patterns(patterns):
+    """Combine case insensitive patterns into one.
+
+    The combined pattern matches wherever any of the patterns does, so when
+    it doesn't match, none of them need to be tried.  Patterns which can't be
+    combined without changing their meaning, i.e. those with back references
+    or inline global flags, and invalid patterns are left out.
+
+    :param patterns: The patterns.
+    :type patterns: sequence of str
+    :return: The compiled combined pattern, or None if there is none, and the
+        patterns it combines.
+    :rtype: 2-tuple of (`re.Pattern` or None, frozenset of str)
+    """
+    alternatives = []
+    combined = set()
+    for pattern in patterns:
+        try:
+            compiled = re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            continue
+        if (compiled.flags == _BASE_FLAGS and
+                _NOT_COMBINABLE.search(pattern) is None):
+            alternatives.append('(?:{})'.format(pattern))
+            combined.add(pattern)
+    if len(combined) == 0:
+        return None, frozenset()
+    try:
+        return (re.compile('|'.join(alternatives), re.IGNORECASE),
+                frozenset(combined))
+    except (re.error, RecursionError, OverflowError):
+        return None, frozenset()
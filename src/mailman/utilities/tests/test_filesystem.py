@@ -17,11 +17,16 @@
 """Testing functions in the filesystem utilities."""
 
 import os
+import time
 import shutil
 import tempfile
 import unittest
+import threading
 
-from mailman.utilities.filesystem import makedirs, first_inexistent_directory
+from mailman.utilities.filesystem import (
+    _PollingWatcher, first_inexistent_directory, makedirs, new_token,
+    read_token, watch_directory, write_atomically)
+from unittest.mock import patch
 
 
 def fake_makedirs(path, mode):
@@ -76,3 +81,157 @@ class TestMakedirs(unittest.TestCase):
         with unittest.mock.patch('os.makedirs', new=fake_makedirs):
             with self.assertRaises(FileExistsError):
                 makedirs(self.baz)
+
+
+class TestWriteAtomically(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._directory)
+        self._path = os.path.join(self._directory, 'sub', 'file')
+
+    def test_write(self):
+        write_atomically(self._path, 'one')
+        write_atomically(self._path, 'two')
+        with open(self._path, 'r', encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), 'two')
+        self.assertEqual(os.listdir(os.path.dirname(self._path)), ['file'])
+
+    def test_failed_write(self):
+        write_atomically(self._path, 'one')
+        with patch('mailman.utilities.filesystem.os.replace',
+                   side_effect=OSError):
+            self.assertRaises(OSError, write_atomically, self._path, 'two')
+        with open(self._path, 'r', encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), 'one')
+        # The temporary file is removed.
+        self.assertEqual(os.listdir(os.path.dirname(self._path)), ['file'])
+
+    def test_tokens(self):
+        token = read_token(self._path)
+        self.assertEqual(read_token(self._path), token)
+        new = new_token(self._path)
+        self.assertNotEqual(new, token)
+        self.assertEqual(read_token(self._path), new)
+
+
+class TestWatchDirectory(unittest.TestCase):
+    """Tests the directory watchers."""
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_directory)
+
+    def _add_file(self, name):
+        tmpfile = os.path.join(self.test_directory, name + '.tmp')
+        with open(tmpfile, 'w'):
+            pass
+        os.rename(tmpfile, os.path.join(self.test_directory, name))
+
+    def _watch(self, watcher):
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def test_timeout(self):
+        watcher = self._watch(watch_directory(self.test_directory))
+        self.assertEqual(watcher.wait(0), [])
+
+    def test_file_renamed_into(self):
+        watcher = self._watch(watch_directory(self.test_directory))
+        self._add_file('a.pck')
+        names = watcher.wait(1)
+        # The polling watcher can't tell which files were added.
+        if names is not None:
+            self.assertIn('a.pck', names)
+        self.assertEqual(watcher.wait(0), [])
+
+    def test_shared_inotify(self):
+        # All the watchers share one inotify instance, and each only gets the
+        # changes to its own directory.
+        other_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_directory)
+        watchers = [
+            self._watch(watch_directory(self.test_directory)),
+            self._watch(watch_directory(self.test_directory)),
+            self._watch(watch_directory(other_directory)),
+            ]
+        if isinstance(watchers[0], _PollingWatcher):
+            self.skipTest('inotify is not available')
+        self.assertIs(watchers[0]._inotify, watchers[2]._inotify)
+        self._add_file('a.pck')
+        self.assertEqual(watchers[2].wait(0.1), [])
+        self.assertIn('a.pck', watchers[0].wait(1))
+        self.assertIn('a.pck', watchers[1].wait(0))
+        # Closing one of a directory's watchers doesn't affect the other.
+        watchers[0].close()
+        self._add_file('b.pck')
+        self.assertIn('b.pck', watchers[1].wait(1))
+
+    def test_inotify_waiting_threads(self):
+        # A thread waiting for one directory hands out the changes to
+        # another, for which a second thread is waiting.
+        other_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_directory)
+        watcher = self._watch(watch_directory(self.test_directory))
+        if isinstance(watcher, _PollingWatcher):
+            self.skipTest('inotify is not available')
+        other_watcher = self._watch(watch_directory(other_directory))
+        thread = threading.Thread(target=other_watcher.wait, args=(5,))
+        thread.start()
+        names = []
+        waiter = threading.Thread(
+            target=lambda: names.append(watcher.wait(5)))
+        waiter.start()
+        # Only the file's arrival is reported.
+        staged = os.path.join(tempfile.mkdtemp(), 'a.pck')
+        with open(staged, 'w'):
+            pass
+        os.rename(staged, os.path.join(self.test_directory, 'a.pck'))
+        os.rmdir(os.path.dirname(staged))
+        waiter.join()
+        self.assertEqual(names[0], ['a.pck'])
+        with open(os.path.join(other_directory, 'b.pck'), 'w'):
+            pass
+        thread.join()
+
+    def test_polling(self):
+        watcher = self._watch(_PollingWatcher(self.test_directory))
+        self.assertEqual(watcher.wait(0), [])
+        # Make sure the modification time changes.
+        os.utime(self.test_directory, ns=(0, 0))
+        self.assertIsNone(watcher.wait(1))
+        self.assertEqual(watcher.wait(0), [])
+
+    def test_polling_sleeps_for_timeout(self):
+        # The directory isn't polled while waiting, only looked at again
+        # once the timeout expires.
+        watcher = self._watch(_PollingWatcher(self.test_directory))
+
+        def sleep(seconds):
+            os.utime(self.test_directory, ns=(0, 0))
+        with patch('mailman.utilities.filesystem.time.sleep',
+                   side_effect=sleep) as sleep_mock:
+            self.assertIsNone(watcher.wait(5))
+        sleep_mock.assert_called_once_with(5)
+
+    def test_polling_rescan_interval(self):
+        # A change is reported once the rescan interval has passed, even if
+        # the modification time is the same.
+        watcher = self._watch(_PollingWatcher(self.test_directory, 10))
+        self.assertEqual(watcher.wait(0), [])
+        with patch('mailman.utilities.filesystem.time.time',
+                   return_value=time.time() + 10):
+            self.assertIsNone(watcher.wait(0))
+            self.assertEqual(watcher.wait(0), [])
+
+    def test_polling_acknowledge(self):
+        watcher = self._watch(_PollingWatcher(self.test_directory))
+        os.utime(self.test_directory, ns=(0, 0))
+        watcher.acknowledge()
+        self.assertEqual(watcher.wait(0), [])
+
+    def test_no_inotify(self):
+        with patch('mailman.utilities.filesystem._inotify', None), \
+                patch('mailman.utilities.filesystem.ctypes.CDLL',
+                      side_effect=OSError):
+            watcher = self._watch(watch_directory(self.test_directory))
+        self.assertIsInstance(watcher, _PollingWatcher)
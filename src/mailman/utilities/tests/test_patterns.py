@@ -0,0 +1,39 @@
+# Copyright (C) 2018 by the Free Software Foundation, Inc.
+#
+# This file is part of GNU Mailman.
+#
+# GNU Mailman is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# GNU Mailman is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# GNU Mailman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the pattern helpers."""
+
+import unittest
+
+from mailman.utilities.patterns import combine_patterns
+
+
+class TestCombinePatterns(unittest.TestCase):
+    def test_combine(self):
+        combined, patterns = combine_patterns(['^anne@', 'bart', r'(\w)\1'])
+        self.assertEqual(patterns, {'^anne@', 'bart'})
+        self.assertIsNotNone(combined.search('ANNE@example.com'))
+        self.assertIsNotNone(combined.search('xbartx'))
+        self.assertIsNone(combined.search('cris'))
+
+    def test_not_combinable(self):
+        # Back references, inline global flags and invalid patterns are left
+        # out.
+        combined, patterns = combine_patterns(
+            [r'(?P<a>x)(?P=a)', '(?x) a', '(bad'])
+        self.assertIsNone(combined)
+        self.assertEqual(patterns, frozenset())
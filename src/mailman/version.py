@@ -41,7 +41,7 @@ HEX_VERSION = ((MAJOR_REV << 24) | (MINOR_REV << 16) | (MICRO_REV << 8) |
 
 
 # queue/*.pck schema version number.
-QFILE_SCHEMA_VERSION = 3
+QFILE_SCHEMA_VERSION = 4
 
 # Printable version string used by command line scripts.
 MAILMAN_VERSION = 'GNU Mailman ' + VERSION